@@ -1,18 +1,32 @@
 # agent/app/main.py
+import asyncio
 import logging
 import os
-from typing import Optional
-from fastapi import FastAPI, Header, HTTPException, status
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from fastapi import FastAPI, Header, HTTPException, Request, status, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from .utils import wg
+from .utils import digest, profiler, tracing, wg
+from .utils.shards import ShardSet, Shard, parse_spec
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
 
 AGENT_SHARED_SECRET = os.getenv("AGENT_SHARED_SECRET")
 WG_INTERFACE = os.getenv("WG_INTERFACE", "wg0")
+WG_LISTEN_PORT = int(os.getenv("WG_LISTEN_PORT", "51820"))
+WG_SUBNET = os.getenv("WG_SUBNET", "10.8.0.0/24")
+# Optional multi-interface sharding: "wg0:51820:10.8.0.0/24,wg1:51821:10.8.1.0/24"
+WG_INTERFACES = os.getenv("WG_INTERFACES")
+SHARD_STRATEGY = os.getenv("SHARD_STRATEGY", "least_load")  # least_load | hash
+WG_PUBLIC_HOST = os.getenv("WG_PUBLIC_HOST")  # host clients dial; port comes from the shard
 DRY_RUN = os.getenv("DRY_RUN", "true").lower() == "true"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+CHANNEL_PUSH_INTERVAL = float(os.getenv("CHANNEL_PUSH_INTERVAL", "10"))  # seconds between health pushes
+DIGEST_CACHE_SECONDS = float(os.getenv("DIGEST_CACHE_SECONDS", "2"))  # reuse one wg dump across a drift check
 
 logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO))
 log = logging.getLogger("agent")
@@ -22,7 +36,38 @@ if not AGENT_SHARED_SECRET:
 
 app = FastAPI(title="ArticVPN WireGuard Agent")
 
+SHARDS = ShardSet(
+    parse_spec(WG_INTERFACES) if WG_INTERFACES else [Shard(WG_INTERFACE, WG_LISTEN_PORT, WG_SUBNET)],
+    strategy=SHARD_STRATEGY,
+    public_host=WG_PUBLIC_HOST,
+)
+
+# Warmup state: /agent/ready answers 503 until the shard tables are loaded
+_warmup = {"ready": False, "duration_ms": None, "error": None}
+
+
+@app.on_event("startup")
+def load_shards():
+    started = time.perf_counter()
+    try:
+        SHARDS.load(dry_run=DRY_RUN)
+    except Exception as exc:
+        _warmup["error"] = str(exc)
+        log.exception("could not read existing peers; starting with empty shards")
+    _warmup["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    _warmup["ready"] = True
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Join the backend's trace when the call carries X-Trace-Id."""
+    if not tracing.start(request.headers.get(tracing.TRACE_HEADER), request.headers.get(tracing.PARENT_HEADER)):
+        return await call_next(request)
+    with tracing.span("agent.request", method=request.method, path=request.url.path):
+        return await call_next(request)
+
 def require_agent_secret(x_agent_secret: Optional[str]) -> None:
+    # Every handler starts here, so this is where queueing for a worker ends
+    tracing.dequeued()
     if not x_agent_secret or x_agent_secret != AGENT_SHARED_SECRET:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized agent request")
 
@@ -30,14 +75,57 @@ class AddPeerIn(BaseModel):
     public_key: str
     allowed_ips: str               # e.g., "10.8.0.12/32"
     persistent_keepalive: Optional[int] = None  # e.g., 25
+    interface: Optional[str] = None  # pin to a shard; otherwise the agent picks one
 
 class RemovePeerIn(BaseModel):
     public_key: str
 
+class ConfigureIn(BaseModel):
+    listen_port: Optional[int] = None
+    interface: Optional[str] = None  # defaults to the first shard
+
+class RotateKeyOut(BaseModel):
+    ok: bool
+    public_key: str
+    interfaces: list
+    dry_run: bool = False
+
+class AssignShardIn(BaseModel):
+    public_key: str
+
+class ShardOut(BaseModel):
+    interface: str
+    listen_port: int
+    subnet: str
+    endpoint: Optional[str] = None  # "host:port" when WG_PUBLIC_HOST is set
+
 class OpOut(BaseModel):
     ok: bool
     detail: Optional[str] = None
     dry_run: bool = False
+    shard: Optional[ShardOut] = None
+
+class DigestIn(BaseModel):
+    prefixes: List[str] = [""]  # "" is the root
+
+def _resolve_shard(public_key: str, allowed_ips: Optional[str] = None, interface: Optional[str] = None) -> Shard:
+    if interface:
+        shard = SHARDS.get(interface)
+        if shard is None:
+            raise HTTPException(status_code=400, detail=f"Unknown interface {interface}")
+        return shard
+    return SHARDS.pick(public_key, allowed_ips)
+
+@app.post("/agent/wg/assign-shard", response_model=ShardOut)
+def assign_shard(
+    body: AssignShardIn,
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Tell the backend which shard a new peer will land on, so it can allocate
+    from that shard's subnet and render the matching Endpoint port."""
+    require_agent_secret(x_agent_secret)
+    shard = _resolve_shard(body.public_key)
+    return ShardOut(**shard.describe(WG_PUBLIC_HOST))
 
 @app.post("/agent/wg/add-peer", response_model=OpOut)
 def add_peer(
@@ -45,15 +133,22 @@ def add_peer(
     x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
 ):
     require_agent_secret(x_agent_secret)
+    shard = _resolve_shard(body.public_key, body.allowed_ips, body.interface)
     try:
         res = wg.add_peer(
             public_key=body.public_key,
             allowed_ips=body.allowed_ips,
-            interface=WG_INTERFACE,
+            interface=shard.interface,
             persistent_keepalive=body.persistent_keepalive,
             dry_run=DRY_RUN,
         )
-        return OpOut(ok=True, dry_run=res.get("dry_run", False))
+        SHARDS.assign(body.public_key, shard)
+        _invalidate_digest()
+        return OpOut(
+            ok=True,
+            dry_run=res.get("dry_run", False),
+            shard=ShardOut(**shard.describe(WG_PUBLIC_HOST)),
+        )
     except Exception as e:
         log.exception("add-peer failed")
         raise HTTPException(status_code=500, detail=str(e))
@@ -65,22 +160,277 @@ def remove_peer(
 ):
     require_agent_secret(x_agent_secret)
     try:
-        res = wg.remove_peer(
-            public_key=body.public_key,
-            interface=WG_INTERFACE,
-            dry_run=DRY_RUN,
-        )
+        for shard in SHARDS.holders(body.public_key):
+            res = wg.remove_peer(
+                public_key=body.public_key,
+                interface=shard.interface,
+                dry_run=DRY_RUN,
+            )
+        SHARDS.release(body.public_key)
+        _invalidate_digest()
         return OpOut(ok=True, dry_run=res.get("dry_run", False))
     except Exception as e:
         log.exception("remove-peer failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/agent/wg/configure", response_model=OpOut)
+def configure(
+    body: ConfigureIn,
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Apply interface-level settings pushed by the backend (fleet fan-out)."""
+    require_agent_secret(x_agent_secret)
+    shard = SHARDS.get(body.interface) if body.interface else SHARDS.shards[0]
+    if shard is None:
+        raise HTTPException(status_code=400, detail=f"Unknown interface {body.interface}")
+    try:
+        res = wg.set_interface(
+            interface=shard.interface,
+            listen_port=body.listen_port,
+            dry_run=DRY_RUN,
+        )
+        if body.listen_port is not None:
+            shard.listen_port = body.listen_port
+        return OpOut(ok=True, dry_run=res.get("dry_run", False), shard=ShardOut(**shard.describe(WG_PUBLIC_HOST)))
+    except Exception as e:
+        log.exception("configure failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/agent/wg/rotate-key", response_model=RotateKeyOut)
+def rotate_key(
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Generate a new server keypair on the node and apply it to every shard.
+    Only the public key leaves the node."""
+    require_agent_secret(x_agent_secret)
+    try:
+        keys = wg.generate_keypair(dry_run=DRY_RUN)
+        for shard in SHARDS.shards:
+            wg.set_interface(interface=shard.interface, private_key=keys["private_key"], dry_run=DRY_RUN)
+        return RotateKeyOut(
+            ok=True,
+            public_key=keys["public_key"],
+            interfaces=[s.interface for s in SHARDS.shards],
+            dry_run=DRY_RUN,
+        )
+    except Exception as e:
+        log.exception("rotate-key failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/agent/wg/peers")
+def list_peers(
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Peers on every shard with their transfer counters (wg show dump)."""
+    require_agent_secret(x_agent_secret)
+    try:
+        peers = []
+        for shard in SHARDS.shards:
+            for peer in wg.list_peers(interface=shard.interface, dry_run=DRY_RUN):
+                peers.append(dict(peer, interface=shard.interface))
+        return {"peers": peers}
+    except Exception as e:
+        log.exception("list-peers failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/agent/wg/stats")
+def node_stats(
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Peer counts and rx/tx byte totals, per shard and for the whole node."""
+    require_agent_secret(x_agent_secret)
+    try:
+        interfaces = {
+            shard.interface: wg.interface_stats(interface=shard.interface, dry_run=DRY_RUN)
+            for shard in SHARDS.shards
+        }
+    except Exception as e:
+        log.exception("stats failed")
+        raise HTTPException(status_code=500, detail=str(e))
+    totals = {k: sum(s[k] for s in interfaces.values()) for k in ("peers", "active_peers", "rx_bytes", "tx_bytes")}
+    return {"at": time.time(), **totals, "interfaces": interfaces}
+
+
+# --- Drift detection ---
+# The backend compares a Merkle-style digest of the live peer set with one
+# built from its allocations and only fetches the buckets that differ.
+
+_digest_cache = {"at": 0.0, "peers": None, "tree": None}
+
+def _invalidate_digest() -> None:
+    _digest_cache["at"] = 0.0
+
+def _digest_state():
+    if _digest_cache["tree"] is None or time.monotonic() - _digest_cache["at"] > DIGEST_CACHE_SECONDS:
+        peers = []
+        for shard in SHARDS.shards:
+            for peer in wg.list_peers(interface=shard.interface, dry_run=DRY_RUN):
+                peers.append({
+                    "public_key": peer["public_key"],
+                    "allowed_ips": digest.normalize_ips(peer.get("allowed_ips", "")),
+                    "interface": shard.interface,
+                })
+        _digest_cache["peers"] = peers
+        _digest_cache["tree"] = digest.build_tree((p["public_key"], p["allowed_ips"]) for p in peers)
+        _digest_cache["at"] = time.monotonic()
+    return _digest_cache["peers"], _digest_cache["tree"]
+
+@app.post("/agent/wg/digest")
+def peer_digest(
+    body: DigestIn,
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Node hashes for the requested bucket prefixes (null = empty bucket)."""
+    require_agent_secret(x_agent_secret)
+    try:
+        _, tree = _digest_state()
+    except Exception as e:
+        log.exception("digest failed")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"depth": digest.DIGEST_DEPTH, "buckets": {p: tree.get(p) for p in body.prefixes}}
+
+@app.post("/agent/wg/bucket-peers")
+def bucket_peers(
+    body: DigestIn,
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Peers whose bucket starts with one of the given prefixes."""
+    require_agent_secret(x_agent_secret)
+    try:
+        peers, _ = _digest_state()
+    except Exception as e:
+        log.exception("bucket-peers failed")
+        raise HTTPException(status_code=500, detail=str(e))
+    prefixes = tuple(body.prefixes)
+    return {"peers": [p for p in peers if digest.bucket_of(p["public_key"]).startswith(prefixes)]}
+
+
 # Health endpoint
 @app.get("/agent/health")
 def health():
     return {
         "ok": True,
-        "interface": WG_INTERFACE,
+        "interface": SHARDS.shards[0].interface,
         "dry_run": DRY_RUN,
-    }
\ No newline at end of file
+        "strategy": SHARDS.strategy,
+        "shards": SHARDS.stats(),
+        "ready": _warmup["ready"],
+    }
+
+
+@app.get("/agent/debug/traces/{trace_id}")
+def trace_spans(
+    trace_id: str,
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """This agent's spans for a backend trace id."""
+    require_agent_secret(x_agent_secret)
+    return {"trace_id": trace_id, "spans": tracing.spans_for(trace_id)}
+
+
+@app.get("/agent/debug/profile")
+async def profile(
+    seconds: float = 10,
+    rate: int = 100,
+    idle: bool = False,
+    tasks: bool = False,
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Sample this agent's stacks for `seconds` (collapsed stacks as JSON)."""
+    require_agent_secret(x_agent_secret)
+    loop = asyncio.get_running_loop()
+    try:
+        return await run_in_threadpool(profiler.sample, seconds, rate, idle, tasks, loop)
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.get("/agent/ready")
+def ready():
+    return JSONResponse(status_code=200 if _warmup["ready"] else 503, content=_warmup)
+
+
+# --- Persistent command channel ---
+# One long-lived WebSocket per backend worker. The backend pipelines commands
+# tagged with request ids; the agent acks each one (out of order is fine) and
+# pushes health/shard stats on its own. The REST endpoints above stay as the
+# fallback and share the same op implementations.
+
+_ACK_CACHE_SIZE = 2048
+# Acks by request id, so a command re-sent after a reconnect is answered from
+# here instead of being applied twice.
+_recent_acks: "OrderedDict[str, dict]" = OrderedDict()
+
+_CHANNEL_OPS = {
+    "add_peer": lambda args: add_peer(AddPeerIn(**args), AGENT_SHARED_SECRET),
+    "remove_peer": lambda args: remove_peer(RemovePeerIn(**args), AGENT_SHARED_SECRET),
+    "assign_shard": lambda args: assign_shard(AssignShardIn(**args), AGENT_SHARED_SECRET),
+    "list_peers": lambda args: list_peers(AGENT_SHARED_SECRET),
+    "node_stats": lambda args: node_stats(AGENT_SHARED_SECRET),
+    "configure": lambda args: configure(ConfigureIn(**args), AGENT_SHARED_SECRET),
+    "rotate_key": lambda args: rotate_key(AGENT_SHARED_SECRET),
+    "peer_digest": lambda args: peer_digest(DigestIn(**args), AGENT_SHARED_SECRET),
+    "bucket_peers": lambda args: bucket_peers(DigestIn(**args), AGENT_SHARED_SECRET),
+    "health": lambda args: health(),
+}
+
+def _run_channel_op(op: str, args: dict) -> dict:
+    fn = _CHANNEL_OPS.get(op)
+    if fn is None:
+        raise HTTPException(status_code=400, detail=f"Unknown op {op}")
+    res = fn(args)
+    return res.model_dump() if isinstance(res, BaseModel) else res
+
+@app.websocket("/agent/ws")
+async def command_channel(websocket: WebSocket):
+    if websocket.headers.get("x-agent-secret") != AGENT_SHARED_SECRET:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    send_lock = asyncio.Lock()
+    inflight = set()
+
+    async def send(msg: dict) -> None:
+        async with send_lock:
+            await websocket.send_json(msg)
+
+    async def handle(msg: dict) -> None:
+        req_id = str(msg.get("id"))
+        ack = _recent_acks.get(req_id)
+        if ack is None:
+            trace = msg.get("trace") or {}
+            tracing.start(trace.get("trace_id"), trace.get("parent_span_id"))
+            try:
+                with tracing.span("agent.channel", op=msg.get("op")):
+                    result = await run_in_threadpool(_run_channel_op, msg.get("op"), msg.get("args") or {})
+                ack = {"id": req_id, "ok": True, "result": result}
+            except HTTPException as e:
+                ack = {"id": req_id, "ok": False, "status": e.status_code, "error": e.detail}
+            except Exception as e:
+                log.exception("channel op %s failed", msg.get("op"))
+                ack = {"id": req_id, "ok": False, "status": 500, "error": str(e)}
+            _recent_acks[req_id] = ack
+            while len(_recent_acks) > _ACK_CACHE_SIZE:
+                _recent_acks.popitem(last=False)
+        await send(ack)
+
+    async def push_health() -> None:
+        while True:
+            await send({"event": "health", "data": health()})
+            await asyncio.sleep(CHANNEL_PUSH_INTERVAL)
+
+    pusher = asyncio.create_task(push_health())
+    try:
+        while True:
+            msg = await websocket.receive_json()
+            task = asyncio.create_task(handle(msg))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        pusher.cancel()
+        for task in inflight:
+            task.cancel()
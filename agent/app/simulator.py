@@ -0,0 +1,338 @@
+# agent/app/simulator.py
+"""Fleet simulator: thousands of virtual agents in one process.
+
+Every virtual agent serves the agent API (the /agent/... routes of
+main.py) under /a/{agent_id}, on top of the same in-memory DRY_RUN driver
+(wg.py) with its own shard interfaces, so peers, shards, digests and
+stats behave per node. Point a vpn_servers row's agent_url at
+http://<host>:<port>/a/<id> and the backend treats it as a separate node;
+backend/scripts/register_sim_fleet.py creates those rows from /sim/fleet.
+
+Per-agent behaviour, from SIM_* settings (randomised per agent with
+SIM_SEED, so a run is repeatable):
+  - latency: SIM_LATENCY_MS mean, +/- SIM_JITTER as a fraction
+  - errors: SIM_ERROR_RATE of requests answer 500
+  - down: SIM_DOWN_RATE of agents hang for SIM_DOWN_SECONDS and then 503,
+    like a node that stopped answering
+  - capacity: SIM_CAPACITY peers per agent; add-peer beyond it answers 409
+Peers pass SIM_PEER_BPS bytes/s each way (with noise) and keep fresh
+handshakes, so stats and transfer counters move.
+
+/sim/fleet describes the fleet; POST /sim/agents/{id} changes one agent's
+faults at runtime (take it down, slow it, make it flaky).
+
+Run from agent/:
+    SIM_AGENTS=2000 AGENT_SHARED_SECRET=... uvicorn app.simulator:app --port 8100
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Path
+from pydantic import BaseModel
+
+from .main import (
+    AddPeerIn, AssignShardIn, ConfigureIn, DigestIn, OpOut, RemovePeerIn, RotateKeyOut, ShardOut,
+    require_agent_secret,
+)
+from .utils import digest, wg
+from .utils.shards import Shard, ShardSet
+
+SIM_AGENTS = int(os.getenv("SIM_AGENTS", "1000"))
+SIM_SHARDS = int(os.getenv("SIM_SHARDS", "1"))  # interfaces per agent
+SIM_LATENCY_MS = float(os.getenv("SIM_LATENCY_MS", "5"))
+SIM_JITTER = float(os.getenv("SIM_JITTER", "0.5"))
+SIM_ERROR_RATE = float(os.getenv("SIM_ERROR_RATE", "0"))
+SIM_DOWN_RATE = float(os.getenv("SIM_DOWN_RATE", "0"))
+SIM_DOWN_SECONDS = float(os.getenv("SIM_DOWN_SECONDS", "30"))
+SIM_CAPACITY = int(os.getenv("SIM_CAPACITY", "250"))
+SIM_PEER_BPS = float(os.getenv("SIM_PEER_BPS", "20000"))
+SIM_PUBLIC_HOST = os.getenv("SIM_PUBLIC_HOST")
+SIM_SEED = int(os.getenv("SIM_SEED", "1"))
+SIM_COUNTRIES = [c.strip() for c in os.getenv("SIM_COUNTRIES", "DE,NL,US,GB,FR,SE,JP,SG,CA,AU").split(",") if c.strip()]
+
+# One line per simulated wg command would drown everything else
+logging.getLogger(wg.__name__).setLevel(logging.WARNING)
+log = logging.getLogger("agent.simulator")
+
+
+class VirtualAgent:
+    def __init__(self, agent_id: int, rng: random.Random):
+        self.id = agent_id
+        self.country = SIM_COUNTRIES[agent_id % len(SIM_COUNTRIES)] if SIM_COUNTRIES else None
+        self.capacity = SIM_CAPACITY
+        self.latency = SIM_LATENCY_MS / 1000 * rng.uniform(0.5, 1.5)  # agents differ a little
+        self.error_rate = SIM_ERROR_RATE
+        self.down = rng.random() < SIM_DOWN_RATE
+        self.shards = ShardSet(
+            [Shard(f"wg{i}-a{agent_id}", 51820 + i, f"10.8.{i}.0/24") for i in range(max(1, SIM_SHARDS))],
+            public_host=SIM_PUBLIC_HOST,
+        )
+        self.public_key = wg.generate_keypair(dry_run=True)["public_key"]
+        self.requests: Counter = Counter()
+        self._rng = random.Random(rng.random())
+        self._ticked = time.time()
+        self._digest = {"at": 0.0, "peers": None, "tree": None}
+
+    @property
+    def peers(self) -> int:
+        return sum(len(s.peers) for s in self.shards.shards)
+
+    async def enter(self, op: str) -> None:
+        """Simulated network and node behaviour for one request."""
+        self.requests[op] += 1
+        if self.down:
+            await asyncio.sleep(SIM_DOWN_SECONDS)
+            raise HTTPException(status_code=503, detail="simulated node down")
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * (1 + self._rng.uniform(-SIM_JITTER, SIM_JITTER)))
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.requests["injected_error"] += 1
+            raise HTTPException(status_code=500, detail="simulated agent error")
+
+    def tick(self) -> None:
+        """Advance transfer counters and handshakes to now."""
+        now = time.time()
+        elapsed, self._ticked = now - self._ticked, now
+        for shard in self.shards.shards:
+            for peer in wg._FAKE_PEERS.get(shard.interface, {}).values():
+                peer["rx_bytes"] += int(SIM_PEER_BPS * elapsed * self._rng.uniform(0.5, 1.5))
+                peer["tx_bytes"] += int(SIM_PEER_BPS * elapsed * self._rng.uniform(0.5, 1.5))
+                peer["latest_handshake"] = int(now)
+
+    def digest_state(self):
+        cache = self._digest
+        if cache["tree"] is None or time.monotonic() - cache["at"] > 2:
+            peers = [
+                {
+                    "public_key": p["public_key"],
+                    "allowed_ips": digest.normalize_ips(p.get("allowed_ips", "")),
+                    "interface": s.interface,
+                }
+                for s in self.shards.shards
+                for p in wg.list_peers(interface=s.interface, dry_run=True)
+            ]
+            cache.update(peers=peers, tree=digest.build_tree((p["public_key"], p["allowed_ips"]) for p in peers),
+                         at=time.monotonic())
+        return cache["peers"], cache["tree"]
+
+    def invalidate_digest(self) -> None:
+        self._digest["at"] = 0.0
+
+    def describe(self) -> dict:
+        return {
+            "id": self.id,
+            "country": self.country,
+            "public_key": self.public_key,
+            "listen_port": self.shards.shards[0].listen_port,
+            "capacity": self.capacity,
+            "peers": self.peers,
+            "down": self.down,
+            "latency_ms": round(self.latency * 1000, 2),
+            "error_rate": self.error_rate,
+        }
+
+
+def build_fleet(count: int = SIM_AGENTS, seed: int = SIM_SEED) -> Dict[int, VirtualAgent]:
+    rng = random.Random(seed)
+    return {i: VirtualAgent(i, rng) for i in range(1, count + 1)}
+
+
+FLEET = build_fleet()
+app = FastAPI(title="ArticVPN agent fleet simulator")
+
+
+def _agent(agent_id: int = Path(...)) -> VirtualAgent:
+    agent = FLEET.get(agent_id)
+    if agent is None:
+        raise HTTPException(status_code=404, detail=f"No simulated agent {agent_id}")
+    return agent
+
+
+def _authed(
+    agent: VirtualAgent = Depends(_agent),
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+) -> VirtualAgent:
+    require_agent_secret(x_agent_secret)
+    return agent
+
+
+def _shard_out(agent: VirtualAgent, shard: Shard) -> ShardOut:
+    return ShardOut(**shard.describe(agent.shards.public_host))
+
+
+# --- agent API, per virtual agent ---
+
+@app.post("/a/{agent_id}/agent/wg/assign-shard", response_model=ShardOut)
+async def assign_shard(body: AssignShardIn, agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("assign_shard")
+    return _shard_out(agent, agent.shards.pick(body.public_key))
+
+
+@app.post("/a/{agent_id}/agent/wg/add-peer", response_model=OpOut)
+async def add_peer(body: AddPeerIn, agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("add_peer")
+    if agent.shards.owner_of(body.public_key) is None and agent.peers >= agent.capacity:
+        raise HTTPException(status_code=409, detail=f"Node at capacity ({agent.capacity} peers)")
+    if body.interface:
+        shard = agent.shards.get(body.interface)
+        if shard is None:
+            raise HTTPException(status_code=400, detail=f"Unknown interface {body.interface}")
+    else:
+        shard = agent.shards.pick(body.public_key, body.allowed_ips)
+    wg.add_peer(body.public_key, body.allowed_ips, interface=shard.interface,
+                persistent_keepalive=body.persistent_keepalive, dry_run=True)
+    agent.shards.assign(body.public_key, shard)
+    agent.invalidate_digest()
+    return OpOut(ok=True, dry_run=True, shard=_shard_out(agent, shard))
+
+
+@app.post("/a/{agent_id}/agent/wg/remove-peer", response_model=OpOut)
+async def remove_peer(body: RemovePeerIn, agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("remove_peer")
+    for shard in agent.shards.holders(body.public_key):
+        wg.remove_peer(body.public_key, interface=shard.interface, dry_run=True)
+    agent.shards.release(body.public_key)
+    agent.invalidate_digest()
+    return OpOut(ok=True, dry_run=True)
+
+
+@app.post("/a/{agent_id}/agent/wg/configure", response_model=OpOut)
+async def configure(body: ConfigureIn, agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("configure")
+    shard = agent.shards.get(body.interface) if body.interface else agent.shards.shards[0]
+    if shard is None:
+        raise HTTPException(status_code=400, detail=f"Unknown interface {body.interface}")
+    wg.set_interface(interface=shard.interface, listen_port=body.listen_port, dry_run=True)
+    if body.listen_port is not None:
+        shard.listen_port = body.listen_port
+    return OpOut(ok=True, dry_run=True, shard=_shard_out(agent, shard))
+
+
+@app.post("/a/{agent_id}/agent/wg/rotate-key", response_model=RotateKeyOut)
+async def rotate_key(agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("rotate_key")
+    keys = wg.generate_keypair(dry_run=True)
+    for shard in agent.shards.shards:
+        wg.set_interface(interface=shard.interface, private_key=keys["private_key"], dry_run=True)
+    agent.public_key = keys["public_key"]
+    return RotateKeyOut(ok=True, public_key=keys["public_key"],
+                        interfaces=[s.interface for s in agent.shards.shards], dry_run=True)
+
+
+@app.get("/a/{agent_id}/agent/wg/peers")
+async def list_peers(agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("list_peers")
+    agent.tick()
+    return {"peers": [
+        dict(p, interface=s.interface)
+        for s in agent.shards.shards
+        for p in wg.list_peers(interface=s.interface, dry_run=True)
+    ]}
+
+
+@app.get("/a/{agent_id}/agent/wg/stats")
+async def node_stats(agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("node_stats")
+    agent.tick()
+    interfaces = {s.interface: wg.interface_stats(interface=s.interface, dry_run=True) for s in agent.shards.shards}
+    totals = {k: sum(s[k] for s in interfaces.values()) for k in ("peers", "active_peers", "rx_bytes", "tx_bytes")}
+    return {"at": time.time(), **totals, "interfaces": interfaces}
+
+
+@app.post("/a/{agent_id}/agent/wg/digest")
+async def peer_digest(body: DigestIn, agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("peer_digest")
+    _, tree = agent.digest_state()
+    return {"depth": digest.DIGEST_DEPTH, "buckets": {p: tree.get(p) for p in body.prefixes}}
+
+
+@app.post("/a/{agent_id}/agent/wg/bucket-peers")
+async def bucket_peers(body: DigestIn, agent: VirtualAgent = Depends(_authed)):
+    await agent.enter("bucket_peers")
+    peers, _ = agent.digest_state()
+    prefixes = tuple(body.prefixes)
+    return {"peers": [p for p in peers if digest.bucket_of(p["public_key"]).startswith(prefixes)]}
+
+
+@app.get("/a/{agent_id}/agent/health")
+async def health(agent: VirtualAgent = Depends(_agent)):
+    await agent.enter("health")
+    return {
+        "ok": True,
+        "interface": agent.shards.shards[0].interface,
+        "dry_run": True,
+        "strategy": agent.shards.strategy,
+        "shards": agent.shards.stats(),
+        "ready": True,
+    }
+
+
+@app.get("/a/{agent_id}/agent/ready")
+async def ready(agent: VirtualAgent = Depends(_agent)):
+    await agent.enter("ready")
+    return {"ready": True, "duration_ms": 0.0, "error": None}
+
+
+@app.get("/a/{agent_id}/agent/debug/traces/{trace_id}")
+async def trace_spans(trace_id: str, agent: VirtualAgent = Depends(_authed)):
+    return {"trace_id": trace_id, "spans": []}
+
+
+# --- simulator control ---
+
+class AgentFaults(BaseModel):
+    down: Optional[bool] = None
+    latency_ms: Optional[float] = None
+    error_rate: Optional[float] = None
+    capacity: Optional[int] = None
+
+
+@app.get("/sim/fleet")
+def fleet(
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Every virtual agent (what register_sim_fleet.py turns into vpn_servers rows)."""
+    require_agent_secret(x_agent_secret)
+    return {"agents": [a.describe() for a in FLEET.values()]}
+
+
+@app.get("/sim/stats")
+def sim_stats(
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    require_agent_secret(x_agent_secret)
+    requests: Counter = Counter()
+    for a in FLEET.values():
+        requests.update(a.requests)
+    busiest: List[dict] = sorted((a.describe() for a in FLEET.values()), key=lambda d: d["peers"], reverse=True)[:10]
+    return {
+        "agents": len(FLEET),
+        "down": sum(a.down for a in FLEET.values()),
+        "peers": sum(a.peers for a in FLEET.values()),
+        "requests": dict(requests),
+        "busiest": busiest,
+    }
+
+
+@app.post("/sim/agents/{agent_id}")
+def set_faults(
+    body: AgentFaults,
+    agent: VirtualAgent = Depends(_agent),
+    x_agent_secret: Optional[str] = Header(None, alias="X-Agent-Secret"),
+):
+    """Change one agent's behaviour, e.g. {"down": true} to test health tracking."""
+    require_agent_secret(x_agent_secret)
+    if body.down is not None:
+        agent.down = body.down
+    if body.latency_ms is not None:
+        agent.latency = max(body.latency_ms, 0.0) / 1000
+    if body.error_rate is not None:
+        agent.error_rate = min(max(body.error_rate, 0.0), 1.0)
+    if body.capacity is not None:
+        agent.capacity = max(body.capacity, 0)
+    return agent.describe()
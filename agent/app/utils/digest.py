@@ -0,0 +1,54 @@
+"""Merkle-style digest of a peer set, for cheap drift checks.
+
+Peers are placed in buckets by the leading hex digits of sha256(public_key),
+so buckets stay evenly filled whatever the keys look like. A leaf bucket
+(DIGEST_DEPTH digits) hashes its sorted "public_key allowed_ips" lines; an
+inner node hashes its non-empty children. Empty buckets have no entry.
+
+The backend builds the same tree from wg_allocations (app/utils/peer_digest.py
+there must stay byte-for-byte compatible with this module, as
+backend/tests/test_peer_digest.py checks), compares the root, and only walks
+down into the buckets that differ.
+"""
+import hashlib
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+DIGEST_DEPTH = 3  # 16**3 = 4096 leaf buckets
+HASH_CHARS = 16   # 64-bit node hashes are plenty to spot a difference
+
+
+def _h(data: str) -> str:
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:HASH_CHARS]
+
+
+def bucket_of(public_key: str) -> str:
+    return hashlib.sha256(public_key.encode("utf-8")).hexdigest()[:DIGEST_DEPTH]
+
+
+def normalize_ips(allowed_ips: str) -> str:
+    if not allowed_ips or allowed_ips == "(none)":
+        return ""
+    return ",".join(sorted(ip.strip() for ip in allowed_ips.split(",") if ip.strip()))
+
+
+def build_tree(peers: Iterable[Tuple[str, str]]) -> Dict[str, str]:
+    """{prefix: hash} for every non-empty node; "" is the root."""
+    leaves: Dict[str, List[str]] = defaultdict(list)
+    for public_key, allowed_ips in peers:
+        leaves[bucket_of(public_key)].append(f"{public_key} {normalize_ips(allowed_ips)}")
+
+    tree = {prefix: _h("\n".join(sorted(lines))) for prefix, lines in leaves.items()}
+    level = list(tree)
+    for _ in range(DIGEST_DEPTH):
+        parents: Dict[str, List[str]] = defaultdict(list)
+        for prefix in level:
+            parents[prefix[:-1]].append(prefix)
+        for parent, children in parents.items():
+            tree[parent] = _h("".join(f"{c}:{tree[c]}" for c in sorted(children)))
+        level = list(parents)
+    return tree
+
+
+def children(prefix: str) -> List[str]:
+    return [prefix + c for c in "0123456789abcdef"]
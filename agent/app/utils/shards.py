@@ -0,0 +1,139 @@
+# agent/app/utils/shards.py
+"""Peer sharding across several WireGuard interfaces on one node.
+
+WireGuard does its crypto work per interface, so one `wg0` carrying tens of
+thousands of peers turns into a hotspot. The agent can instead manage N
+interfaces ("shards"), each with its own listen port and subnet slice, and
+spread peers over them.
+
+Spec format (WG_INTERFACES env):
+  "wg0:51820:10.8.0.0/24,wg1:51821:10.8.1.0/24"
+"""
+import bisect
+import hashlib
+from dataclasses import dataclass, field
+from ipaddress import ip_interface, ip_network
+from typing import Dict, List, Optional, Any
+
+from . import wg
+
+STRATEGIES = ("least_load", "hash")
+_VNODES = 64  # virtual nodes per shard on the hash ring
+
+
+@dataclass
+class Shard:
+    interface: str
+    listen_port: int
+    subnet: str
+    peers: set = field(default_factory=set)
+
+    def contains(self, allowed_ips: str) -> bool:
+        try:
+            addr = ip_interface(allowed_ips.split(",")[0].strip()).ip
+        except ValueError:
+            return False
+        return addr in ip_network(self.subnet)
+
+    def describe(self, public_host: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "interface": self.interface,
+            "listen_port": self.listen_port,
+            "subnet": self.subnet,
+            "endpoint": f"{public_host}:{self.listen_port}" if public_host else None,
+        }
+
+
+def parse_spec(spec: str) -> List[Shard]:
+    """Parse "iface:port:cidr,..." into Shard objects."""
+    shards: List[Shard] = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            name, port, subnet = item.split(":", 2)
+            shards.append(Shard(name, int(port), str(ip_network(subnet))))
+        except ValueError as exc:
+            raise RuntimeError(f"Invalid WG_INTERFACES entry: {item!r}") from exc
+    if not shards:
+        raise RuntimeError("WG_INTERFACES is empty")
+    return shards
+
+
+class ShardSet:
+    """Tracks which shard owns each peer and picks shards for new ones."""
+
+    def __init__(self, shards: List[Shard], strategy: str = "least_load", public_host: Optional[str] = None):
+        if strategy not in STRATEGIES:
+            raise RuntimeError(f"Unknown shard strategy {strategy!r} (expected one of {STRATEGIES})")
+        self.shards = shards
+        self.strategy = strategy
+        self.public_host = public_host
+        self._by_name = {s.interface: s for s in shards}
+        self._owner: Dict[str, Shard] = {}
+        points = sorted(
+            (self._hash(f"{s.interface}#{v}"), i)
+            for i, s in enumerate(shards)
+            for v in range(_VNODES)
+        )
+        self._ring: List[int] = [h for h, _ in points]
+        self._ring_shards: List[Shard] = [shards[i] for _, i in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def get(self, interface: str) -> Optional[Shard]:
+        return self._by_name.get(interface)
+
+    def owner_of(self, public_key: str) -> Optional[Shard]:
+        return self._owner.get(public_key)
+
+    def holders(self, public_key: str) -> List[Shard]:
+        """Shards a peer may be on: its owner, or every shard when ownership
+        is unknown (e.g. the peer was added before a restart and load() hasn't
+        seen it). Removing from a shard that lacks the peer is a no-op."""
+        owner = self._owner.get(public_key)
+        return [owner] if owner is not None else list(self.shards)
+
+    def pick(self, public_key: str, allowed_ips: Optional[str] = None) -> Shard:
+        """Choose a shard for a peer.
+
+        An existing owner always wins, then a shard whose subnet contains the
+        peer's address (the backend allocated from that slice), then the
+        configured strategy.
+        """
+        owner = self._owner.get(public_key)
+        if owner is not None:
+            return owner
+        if allowed_ips:
+            for s in self.shards:
+                if s.contains(allowed_ips):
+                    return s
+        if self.strategy == "hash":
+            idx = bisect.bisect(self._ring, self._hash(public_key)) % len(self._ring)
+            return self._ring_shards[idx]
+        return min(self.shards, key=lambda s: len(s.peers))
+
+    def assign(self, public_key: str, shard: Shard) -> None:
+        prev = self._owner.get(public_key)
+        if prev is not None and prev is not shard:
+            prev.peers.discard(public_key)
+        shard.peers.add(public_key)
+        self._owner[public_key] = shard
+
+    def release(self, public_key: str) -> Optional[Shard]:
+        shard = self._owner.pop(public_key, None)
+        if shard is not None:
+            shard.peers.discard(public_key)
+        return shard
+
+    def load(self, dry_run: bool) -> None:
+        """Rebuild ownership from the interfaces themselves (e.g. after restart)."""
+        for s in self.shards:
+            for peer in wg.list_peers(interface=s.interface, dry_run=dry_run):
+                self.assign(peer["public_key"], s)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [dict(s.describe(self.public_host), peers=len(s.peers)) for s in self.shards]
@@ -0,0 +1,115 @@
+"""Agent side of request tracing.
+
+The backend decides what gets sampled: a REST request carrying X-Trace-Id
+(or a channel command carrying a "trace" field) is traced here, its spans
+parented to the backend span that made the call. Spans cover time spent
+queued for a worker thread and each `wg` execution.
+
+Spans are kept per trace id in a bounded in-memory buffer, served by
+/agent/debug/traces/{trace_id} so the backend can stitch them into its own
+trace, and appended to TRACE_FILE as JSON lines when that is set.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+log = logging.getLogger("agent.tracing")
+
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "500"))  # traces kept in memory
+TRACE_FILE = os.getenv("TRACE_FILE")
+
+TRACE_HEADER = "x-trace-id"
+PARENT_HEADER = "x-parent-span-id"
+
+_trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+_span_id: ContextVar[Optional[str]] = ContextVar("trace_span_id", default=None)
+_queued_at: ContextVar[Optional[float]] = ContextVar("trace_queued_at", default=None)
+
+_spans: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _record(trace_id: str, entry: Dict[str, Any]) -> None:
+    with _lock:
+        _spans.setdefault(trace_id, []).append(entry)
+        _spans.move_to_end(trace_id)
+        while len(_spans) > TRACE_BUFFER_SIZE:
+            _spans.popitem(last=False)
+        if TRACE_FILE:
+            try:
+                with open(TRACE_FILE, "a", encoding="utf-8") as fh:
+                    fh.write(json.dumps(dict(entry, trace_id=trace_id)) + "\n")
+            except OSError:
+                log.exception("could not write span to %s", TRACE_FILE)
+
+
+def start(trace_id: Optional[str], parent_id: Optional[str]) -> bool:
+    """Join the caller's trace for the rest of this context. False if untraced."""
+    if not trace_id:
+        return False
+    _trace_id.set(trace_id)
+    _span_id.set(parent_id or None)
+    _queued_at.set(time.perf_counter())
+    return True
+
+
+@contextmanager
+def span(name: str, **attrs):
+    trace_id = _trace_id.get()
+    if trace_id is None:
+        yield
+        return
+    span_id = uuid.uuid4().hex[:16]
+    parent = _span_id.get()
+    token = _span_id.set(span_id)
+    started_at = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as exc:
+        error = exc.__class__.__name__
+        raise
+    finally:
+        _span_id.reset(token)
+        _record(trace_id, {
+            "span_id": span_id,
+            "parent_id": parent,
+            "name": name,
+            "service": "agent",
+            "start": started_at,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+            "attrs": attrs,
+            "error": error,
+        })
+
+
+def dequeued() -> None:
+    """Record how long the current request waited before a worker picked it up."""
+    trace_id, queued_at = _trace_id.get(), _queued_at.get()
+    if trace_id is None or queued_at is None:
+        return
+    _queued_at.set(None)
+    waited = time.perf_counter() - queued_at
+    _record(trace_id, {
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": _span_id.get(),
+        "name": "agent.queue",
+        "service": "agent",
+        "start": time.time() - waited,
+        "duration_ms": round(waited * 1000, 3),
+        "attrs": {},
+        "error": None,
+    })
+
+
+def spans_for(trace_id: str) -> List[Dict[str, Any]]:
+    with _lock:
+        return list(_spans.get(trace_id, []))
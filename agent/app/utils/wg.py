@@ -1,15 +1,30 @@
 # agent/app/utils/wg.py
+import base64
 import os
 import shutil
 import subprocess
 import logging
-from typing import Optional, Dict, Any
+import time
+from typing import Optional, Dict, Any, List
+
+from .tracing import span
 
 log = logging.getLogger(__name__)
 
+# In-memory peer tables used in DRY-RUN mode, keyed by interface then public key.
+# This is the "fake driver": it lets sharding, health and listing behave like a
+# real node without any WireGuard interface present.
+_FAKE_PEERS: Dict[str, Dict[str, Dict[str, Any]]] = {}
+_FAKE_INTERFACES: Dict[str, Dict[str, Any]] = {}
+
 def _has_wg() -> bool:
     return shutil.which("wg") is not None
 
+def _run(cmd: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run for wg, traced as a wg.exec span (no keys in the label)."""
+    with span("wg.exec", cmd=" ".join(cmd[:3])):
+        return subprocess.run(cmd, capture_output=True, text=True, **kwargs)
+
 def add_peer(
     public_key: str,
     allowed_ips: str,
@@ -27,10 +42,19 @@ def add_peer(
 
     if dry_run or not _has_wg():
         log.info("[DRY-RUN] %s", " ".join(cmd))
+        _FAKE_PEERS.setdefault(interface, {})[public_key] = {
+            "public_key": public_key,
+            "allowed_ips": allowed_ips,
+            "persistent_keepalive": persistent_keepalive,
+            "endpoint": None,
+            "latest_handshake": int(time.time()),
+            "rx_bytes": 0,
+            "tx_bytes": 0,
+        }
         return {"ok": True, "dry_run": True, "cmd": cmd}
 
     # real call
-    res = subprocess.run(cmd, capture_output=True, text=True)
+    res = _run(cmd)
     if res.returncode != 0:
         log.error("wg add-peer failed: %s", res.stderr.strip())
         raise RuntimeError(res.stderr.strip() or "wg set failed")
@@ -49,11 +73,118 @@ def remove_peer(
 
     if dry_run or not _has_wg():
         log.info("[DRY-RUN] %s", " ".join(cmd))
+        _FAKE_PEERS.get(interface, {}).pop(public_key, None)
         return {"ok": True, "dry_run": True, "cmd": cmd}
 
     # real call
-    res = subprocess.run(cmd, capture_output=True, text=True)
+    res = _run(cmd)
     if res.returncode != 0:
         log.error("wg remove-peer failed: %s", res.stderr.strip())
         raise RuntimeError(res.stderr.strip() or "wg set remove failed")
-    return {"ok": True, "dry_run": False, "stdout": res.stdout.strip()}
\ No newline at end of file
+    return {"ok": True, "dry_run": False, "stdout": res.stdout.strip()}
+
+def list_peers(
+    interface: str = "wg0",
+    dry_run: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Equivalent to:
+      wg show wg0 dump
+    Returns one dict per peer (public_key, allowed_ips, ...).
+    """
+    if dry_run or not _has_wg():
+        return [dict(p) for p in _FAKE_PEERS.get(interface, {}).values()]
+
+    res = _run(["wg", "show", interface, "dump"])
+    if res.returncode != 0:
+        log.error("wg show failed: %s", res.stderr.strip())
+        raise RuntimeError(res.stderr.strip() or "wg show failed")
+
+    peers: List[Dict[str, Any]] = []
+    # First line describes the interface itself; the rest are peers:
+    # public-key preshared-key endpoint allowed-ips latest-handshake rx tx keepalive
+    for line in res.stdout.strip().splitlines()[1:]:
+        fields = line.split("\t")
+        if len(fields) < 8:
+            continue
+        peers.append({
+            "public_key": fields[0],
+            "endpoint": None if fields[2] == "(none)" else fields[2],
+            "allowed_ips": fields[3],
+            "latest_handshake": int(fields[4]),
+            "rx_bytes": int(fields[5]),
+            "tx_bytes": int(fields[6]),
+            "persistent_keepalive": None if fields[7] == "off" else int(fields[7]),
+        })
+    return peers
+
+
+# A peer that is passing traffic re-handshakes at least every 2 minutes
+ACTIVE_HANDSHAKE_SECONDS = 180
+
+def interface_stats(
+    interface: str = "wg0",
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """
+    Peer counts and transfer totals for one interface, from one wg show dump.
+    rx/tx are sums of the per-peer counters, so they drop when a peer is
+    removed; callers computing rates treat a drop as a counter reset.
+    """
+    peers = list_peers(interface=interface, dry_run=dry_run)
+    cutoff = int(time.time()) - ACTIVE_HANDSHAKE_SECONDS
+    return {
+        "peers": len(peers),
+        "active_peers": sum(1 for p in peers if p["latest_handshake"] >= cutoff),
+        "rx_bytes": sum(p["rx_bytes"] for p in peers),
+        "tx_bytes": sum(p["tx_bytes"] for p in peers),
+    }
+
+
+def set_interface(
+    interface: str = "wg0",
+    listen_port: Optional[int] = None,
+    private_key: Optional[str] = None,
+    dry_run: bool = False,
+) -> Dict[str, Any]:
+    """
+    Equivalent to:
+      wg set wg0 [listen-port <N>] [private-key /dev/stdin]
+    The private key is fed on stdin so it never shows up in argv or logs.
+    """
+    cmd = ["wg", "set", interface]
+    if listen_port is not None:
+        cmd += ["listen-port", str(listen_port)]
+    if private_key is not None:
+        cmd += ["private-key", "/dev/stdin"]
+
+    if dry_run or not _has_wg():
+        log.info("[DRY-RUN] %s", " ".join(cmd))
+        state = _FAKE_INTERFACES.setdefault(interface, {})
+        if listen_port is not None:
+            state["listen_port"] = listen_port
+        if private_key is not None:
+            state["private_key"] = private_key
+        return {"ok": True, "dry_run": True, "cmd": cmd}
+
+    res = _run(cmd, input=private_key)
+    if res.returncode != 0:
+        log.error("wg set interface failed: %s", res.stderr.strip())
+        raise RuntimeError(res.stderr.strip() or "wg set failed")
+    return {"ok": True, "dry_run": False}
+
+
+def generate_keypair(dry_run: bool = False) -> Dict[str, str]:
+    """
+    Equivalent to:
+      wg genkey | tee private | wg pubkey
+    """
+    if dry_run or not _has_wg():
+        return {
+            "private_key": base64.standard_b64encode(os.urandom(32)).decode("ascii"),
+            "public_key": base64.standard_b64encode(os.urandom(32)).decode("ascii"),
+        }
+
+    priv = _run(["wg", "genkey"], check=True).stdout.strip()
+    pub = _run(["wg", "pubkey"], input=priv, check=True).stdout.strip()
+    return {"private_key": priv, "public_key": pub}
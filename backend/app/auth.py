@@ -1,21 +1,64 @@
-from jose import jwt, JWTError
-from fastapi import HTTPException, Depends
+import hmac
+from typing import Optional
+from fastapi import HTTPException, Depends, Request
 from fastapi.security import OAuth2PasswordBearer
 import os
 from dotenv import load_dotenv
-from app.models import users
+from sqlalchemy import select
+from app.models import users, twofa_secrets
 from app.database import database
+from app.utils.invalidation import cache
 
 load_dotenv()
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM")
+# Comma-separated usernames that get the "admin" role
+ADMIN_USERNAMES = {u.strip() for u in os.getenv("ADMIN_USERNAMES", "").split(",") if u.strip()}
+# Static bearer token for metrics scrapers (Prometheus); admins' JWTs work too
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+STREAM_TICKET_TTL = int(os.getenv("STREAM_TICKET_TTL", "30"))  # seconds
+STREAM_SCOPE = "stream"
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/login")
 
+# user_id -> the row fields below; publish("users", user_id) on changes to them
+_users = cache("users")
+
 def create_access_token(data: dict):
+    from jose import jwt
+
     return jwt.encode(data, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    return await _user_from_token(token)
+
+def create_stream_ticket(user_id: int, username: str) -> str:
+    """Short-lived token that only the SSE endpoint accepts.
+
+    EventSource cannot send an Authorization header, so the stream takes its
+    credential from the query string, where access logs and proxies record
+    it. A ticket limits that to STREAM_TICKET_TTL seconds and to the stream.
+    """
+    import time
+
+    return create_access_token({
+        "sub": username,
+        "user_id": user_id,
+        "scope": STREAM_SCOPE,
+        "exp": int(time.time()) + STREAM_TICKET_TTL,
+    })
+
+async def get_current_user_for_stream(request: Request, ticket: Optional[str] = None):
+    """Like get_current_user, but for EventSource: an Authorization header or a
+    ?ticket= from POST /users/me/connection/stream-ticket."""
+    auth = request.headers.get("Authorization", "")
+    if auth.lower().startswith("bearer "):
+        return await _user_from_token(auth[7:])
+    return await _user_from_token(ticket or "", scope=STREAM_SCOPE)
+
+async def _user_from_token(token: str, scope: Optional[str] = None):
+    from jose import jwt, JWTError
+
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -28,16 +71,56 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         user_id: int = payload.get("user_id")
         if username is None or user_id is None:
             raise credentials_exception
-        query = users.select().where(users.c.id == user_id)
-        user_record = await database.fetch_one(query)
-        
-        if not user_record:
+        # Scoped tokens (stream tickets) only work where that scope is asked for
+        if payload.get("scope") != scope:
             raise credentials_exception
+        # One round trip: the user row plus whether 2FA is set up, so handlers
+        # like /users/profile don't have to query again
+        query = (
+            select(
+                users.c.id,
+                users.c.email,
+                users.c.is_active,
+                users.c.created_at,
+                twofa_secrets.c.id.label("twofa_id"),
+            )
+            .select_from(users.outerjoin(twofa_secrets, twofa_secrets.c.user_id == users.c.id))
+            .where(users.c.id == user_id)
+            .limit(1)
+        )
+        user_record = _users.get(user_id)
+        if user_record is None:
+            row = await database.fetch_one(query)
+            if not row:
+                raise credentials_exception
+            user_record = dict(row)
+            _users.set(user_id, user_record)
         
         return {
             "username": username,
             "user_id": user_id,  
+            "role": "admin" if username in ADMIN_USERNAMES else "user",
+            "email": user_record["email"],
+            "is_active": user_record["is_active"],
+            "created_at": user_record["created_at"],
+            "twofa_enabled": user_record["twofa_id"] is not None,
         }
         
     except JWTError:
-        raise credentials_exception
\ No newline at end of file
+        raise credentials_exception
+
+async def require_admin(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return current_user
+
+async def require_metrics_access(request: Request):
+    """/metrics and other fleet-topology views: METRICS_TOKEN or an admin JWT."""
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:] if auth.lower().startswith("bearer ") else ""
+    if METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return None
+    user = await _user_from_token(token)
+    if user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return user
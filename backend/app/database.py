@@ -1,9 +1,12 @@
 import os
-from sqlalchemy import create_engine, MetaData
-from databases import Database
+from functools import lru_cache
+
+from sqlalchemy import MetaData
 from dotenv import load_dotenv
 from urllib.parse import quote_plus
 
+from app.utils.db_pool import BoundedDatabase
+
 load_dotenv()
 
 DB_USER = os.getenv("DB_USER")
@@ -18,7 +21,31 @@ SAFE_DB_PASSWORD = quote_plus(DB_PASSWORD or "")
 DATABASE_URL = f"mysql+aiomysql://{DB_USER}:{SAFE_DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 SYNC_DATABASE_URL = f"mysql+pymysql://{DB_USER}:{SAFE_DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-database = Database(DATABASE_URL)
+# Pool sizing. aiomysql has no separate overflow, so DB_MAX_OVERFLOW extra
+# connections are opened on demand above DB_POOL_SIZE and kept until idle-recycled.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "2"))  # max seconds to wait for a connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))  # MySQL max_execution_time (SELECTs)
+
+database = BoundedDatabase(
+    DATABASE_URL,
+    min_size=DB_POOL_SIZE,
+    max_size=DB_POOL_SIZE + DB_MAX_OVERFLOW,
+    pool_recycle=DB_POOL_RECYCLE,
+    acquire_timeout=DB_POOL_TIMEOUT,
+    init_command=f"SET SESSION max_execution_time={DB_STATEMENT_TIMEOUT_MS}",
+)
 metadata = MetaData()
 
-engine = create_engine(SYNC_DATABASE_URL)
\ No newline at end of file
+
+@lru_cache(maxsize=1)
+def get_sync_engine():
+    """Blocking engine for scripts and one-off admin tasks; request handlers use `database`.
+
+    Built on first use so API workers never pay for it.
+    """
+    from sqlalchemy import create_engine
+
+    return create_engine(SYNC_DATABASE_URL)
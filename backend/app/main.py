@@ -1,8 +1,15 @@
+import asyncio
 import os
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from app.auth import require_metrics_access
 from app.database import database
-from app.routes import user_routes, server_routes, security_routes, agent_routes
+from app.routes import user_routes, server_routes, security_routes, agent_routes, usage_routes, debug_routes, job_routes
+from app.utils import admission, agent_channel, agent_health, capture, invalidation, jobs, metrics, query_count, rate_limit, scheduler, session_buffer, timeseries, tracing, warmup
+from app.utils.agent_client import AGENT_URL, AGENT_SHARED_SECRET, AgentUnavailable
+from app.utils.db_pool import PoolTimeout, register_pool_metrics
+from app.utils.idempotency import IdempotencyKeyReused
 from fastapi.middleware.cors import CORSMiddleware
 
 load_dotenv()
@@ -11,6 +18,12 @@ FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
 
 app = FastAPI()
 
+# Registered before CORS so rejected requests still carry CORS headers
+app.middleware("http")(admission.admission_middleware)
+app.middleware("http")(query_count.query_count_middleware)
+app.middleware("http")(tracing.tracing_middleware)
+if capture.CAPTURE_FILE:
+    app.middleware("http")(capture.capture_middleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[FRONTEND_URL],  # your frontend
@@ -24,11 +37,85 @@ app.include_router(user_routes.router, prefix="/users", tags=["users"])
 app.include_router(server_routes.router)
 app.include_router(agent_routes.router)
 app.include_router(security_routes.router, prefix="/security", tags=["security"])
+app.include_router(usage_routes.router)
+app.include_router(debug_routes.router)
+app.include_router(job_routes.router)
+
+_background_tasks = []
+register_pool_metrics(database)
+
+
+@app.exception_handler(AgentUnavailable)
+async def agent_unavailable_handler(request: Request, exc: AgentUnavailable):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+@app.exception_handler(IdempotencyKeyReused)
+async def idempotency_key_reused_handler(request: Request, exc: IdempotencyKeyReused):
+    return JSONResponse(status_code=422, content={"detail": str(exc)})
+
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_metrics_access)])
+async def get_metrics():
+    return metrics.render()
+
+
+@app.get("/health")
+async def health():
+    pool = database.pool_stats()
+    saturated = pool["in_use"] >= pool["max_size"] > 0 and pool["waiting"] > 0
+    return {
+        "status": "degraded" if saturated else "ok",
+        "db_pool": pool,
+        "admission": admission.admission_state(),
+        "cache_invalidation": invalidation.invalidation_state(),
+        "timeseries": timeseries.store_state(),
+    }
+
+
+@app.get("/health/ready")
+async def ready():
+    state = warmup.warmup_state()
+    return JSONResponse(status_code=200 if state["ready"] else 503, content=state)
 
 @app.on_event("startup")
 async def startup():
     await database.connect()
+    session_buffer.init(database)
+    timeseries.load()
+    agent_channel.start_channel(AGENT_URL, AGENT_SHARED_SECRET)
+    _background_tasks.append(asyncio.create_task(warmup.run(database, AGENT_URL)))
+    _background_tasks.append(asyncio.create_task(invalidation.poll_forever(database)))
+    if rate_limit.RATE_LIMIT_STORE == "db":
+        _background_tasks.append(asyncio.create_task(rate_limit.sync_forever(database)))
+    _background_tasks.append(asyncio.create_task(agent_health.poll_forever(database, AGENT_URL)))
+    # Periodic maintenance: leader jobs run on one replica only
+    jobs.register(scheduler.scheduler, database)
+    scheduler.scheduler.start(database)
 
 @app.on_event("shutdown")
 async def shutdown():
+    for task in _background_tasks:
+        task.cancel()
+    await scheduler.scheduler.stop()
+    timeseries.save()
+    if capture.CAPTURE_FILE:
+        capture.close()
+    if tracing.TRACE_FILE:
+        tracing.close()
+    await agent_channel.stop_channels()
+    await session_buffer.shutdown()
     await database.disconnect()
\ No newline at end of file
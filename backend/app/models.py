@@ -1,4 +1,5 @@
-from sqlalchemy import Table, Column, Integer, String, Boolean, DateTime, ForeignKey, text, UniqueConstraint, Index
+from sqlalchemy import Table, Column, Integer, BigInteger, String, Boolean, Date, DateTime, Double, ForeignKey, Text, text, UniqueConstraint, Index
+from sqlalchemy.dialects.mysql import BINARY, INTEGER
 from sqlalchemy.sql import func
 from .database import metadata
 
@@ -31,10 +32,12 @@ vpn_servers = Table(
     Column("ip_address", String(100), nullable=False),
     Column("config_path", String(255)),  # path to OpenVPN/WireGuard config file
     Column("is_active", Boolean, server_default=text("1")),
-    Column("wg_public_key", String(64), nullable=True),
+    Column("wg_key", BINARY(32), nullable=True),  # raw public key; base64 at the edges
     Column("wg_endpoint", String(255), nullable=True),
     Column("wg_allowed_ips", String(255), nullable=True),
     Column("wg_dns", String(255), nullable=True),
+    Column("agent_url", String(255), nullable=True),  # defaults to AGENT_URL when empty
+    Column("capacity", Integer, nullable=True),  # max peers; NULL = unlimited
 )
 
 # New table for WireGuard allocations
@@ -44,11 +47,12 @@ wg_allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
     Column("server_id", Integer, ForeignKey("vpn_servers.id"), nullable=False),
-    Column("client_ip", String(32), nullable=False),  # e.g. "10.8.0.10/32"
-    Column("client_public_key", String(64), nullable=False),
+    Column("client_addr", INTEGER(unsigned=True), nullable=False),  # IPv4 as an int; API shows "10.8.0.10/32"
+    Column("client_key", BINARY(32), nullable=False),  # raw public key; base64 in the API
     Column("created_at", DateTime, server_default=func.now()),
     Column("revoked_at", DateTime, nullable=True),
-    UniqueConstraint("server_id", "client_ip", name="uq_wg_alloc_server_ip"),
+    UniqueConstraint("server_id", "client_addr", name="uq_wg_alloc_server_addr"),
+    UniqueConstraint("client_key", name="uq_wg_alloc_client_key"),
     Index("idx_wg_alloc_user", "user_id"),
     Index("idx_wg_alloc_server", "server_id"),
 )
@@ -61,6 +65,26 @@ connections = Table(
     Column("server_id", Integer, ForeignKey("vpn_servers.id")),
     Column("connected_at", DateTime, server_default=func.now()),
     Column("disconnected_at", DateTime, nullable=True),
+    Column("updated_at", DateTime, server_default=func.now(), onupdate=func.now()),
+    # Set once the usage rollup job has counted the closed session
+    Column("rolled_up", Boolean, nullable=False, server_default=text("0")),
+    Index("idx_connections_rollup", "rolled_up", "id"),
+    Index("idx_connections_user_open", "user_id", "disconnected_at"),
+)
+
+# Closed sessions older than the retention horizon, moved out of the hot
+# `connections` table in small batches by app/utils/archiver.py.
+connections_archive = Table(
+    "connections_archive",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("user_id", Integer),
+    Column("server_id", Integer),
+    Column("connected_at", DateTime),
+    Column("disconnected_at", DateTime),
+    Column("updated_at", DateTime),
+    Column("archived_at", DateTime, server_default=func.now()),
+    Index("idx_connections_archive_user", "user_id", "connected_at"),
 )
 
 
@@ -72,4 +96,106 @@ recovery_codes = Table(
     Column("code_hash", String(255), nullable=False),         
     Column("used_at", DateTime, nullable=True),
     Column("created_at", DateTime, server_default=func.now()),
-)
\ No newline at end of file
+)
+
+
+# --- Usage rollups (maintained incrementally by app/utils/rollups.py) ---
+
+usage_server_hourly = Table(
+    "usage_server_hourly",
+    metadata,
+    Column("server_id", Integer, primary_key=True),
+    Column("bucket_start", DateTime, primary_key=True),
+    Column("sessions", Integer, nullable=False, server_default=text("0")),
+    Column("connected_seconds", BigInteger, nullable=False, server_default=text("0")),
+)
+
+usage_server_daily = Table(
+    "usage_server_daily",
+    metadata,
+    Column("server_id", Integer, primary_key=True),
+    Column("day", Date, primary_key=True),
+    Column("sessions", Integer, nullable=False, server_default=text("0")),
+    Column("connected_seconds", BigInteger, nullable=False, server_default=text("0")),
+)
+
+usage_user_daily = Table(
+    "usage_user_daily",
+    metadata,
+    Column("user_id", Integer, primary_key=True),
+    Column("day", Date, primary_key=True),
+    Column("sessions", Integer, nullable=False, server_default=text("0")),
+    Column("connected_seconds", BigInteger, nullable=False, server_default=text("0")),
+)
+
+
+# Append-only log of cache invalidations, and of events relayed to every
+# worker (payload set); every worker polls it past the last id it has applied
+# (app/utils/invalidation.py). Old rows are pruned.
+cache_invalidations = Table(
+    "cache_invalidations",
+    metadata,
+    Column("id", BigInteger, primary_key=True, autoincrement=True),
+    Column("namespace", String(64), nullable=False),
+    Column("cache_key", String(128), nullable=True),  # NULL drops the whole namespace
+    Column("payload", Text, nullable=True),  # JSON for relayed events (see invalidation.relay)
+    Column("created_at", DateTime, server_default=func.now()),
+    Index("idx_cache_invalidations_created", "created_at"),
+)
+
+# Node counters sampled by the leader; every worker reads them past the last
+# id it has ingested into its own time-series store (app/utils/timeseries.py).
+# Rows older than TIMESERIES_SHARE_RETENTION are deleted by the sampler.
+node_samples = Table(
+    "node_samples",
+    metadata,
+    Column("id", BigInteger, primary_key=True, autoincrement=True),
+    Column("server_id", Integer, nullable=False),
+    Column("sampled_at", Double, nullable=False),  # epoch seconds, sampler's clock
+    Column("agent_at", Double, nullable=False),    # epoch seconds, agent's clock (for rates)
+    Column("peers", Integer, nullable=False),
+    Column("active_peers", Integer, nullable=False),
+    Column("rx_bytes", BigInteger, nullable=False),
+    Column("tx_bytes", BigInteger, nullable=False),
+    Index("idx_node_samples_sampled", "sampled_at"),
+)
+
+# Attempt counts per rate-limit key and fixed window, shared between workers
+# when RATE_LIMIT_STORE=db (app/utils/rate_limit.py)
+rate_limit_counters = Table(
+    "rate_limit_counters",
+    metadata,
+    Column("limiter", String(32), primary_key=True),
+    Column("bucket_key", String(191), primary_key=True),
+    Column("window_start", BigInteger, primary_key=True),  # window index: epoch seconds // window length
+    Column("attempts", Integer, nullable=False, server_default=text("0")),
+)
+
+
+# --- Background jobs (app/utils/scheduler.py) ---
+
+# One row per leader-only job: the replica allowed to run it until expires_at
+job_leases = Table(
+    "job_leases",
+    metadata,
+    Column("name", String(64), primary_key=True),
+    Column("owner", String(128), nullable=False),
+    Column("expires_at", DateTime, nullable=False),
+    Column("run_requested_at", DateTime, nullable=True),  # admin asked for a run; the owner picks it up
+)
+
+job_runs = Table(
+    "job_runs",
+    metadata,
+    Column("id", BigInteger, primary_key=True, autoincrement=True),
+    Column("job", String(64), nullable=False),
+    Column("replica", String(128), nullable=False),
+    Column("trigger", String(16), nullable=False),  # schedule | manual
+    Column("started_at", DateTime, nullable=False),
+    Column("finished_at", DateTime, nullable=True),
+    Column("duration_ms", Integer, nullable=True),
+    Column("status", String(16), nullable=False),  # ok | error | timeout | cancelled
+    Column("error", String(500), nullable=True),
+    Index("idx_job_runs_job", "job", "id"),
+    Index("idx_job_runs_started", "started_at"),
+)
@@ -1,8 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
-import httpx
 import os
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR, HTTP_401_UNAUTHORIZED
+from app.auth import require_metrics_access
+from app.utils import agent_client
+from app.utils.agent_channel import channel_states
+from app.utils.agent_health import health_table, breaker_state
 
 router = APIRouter()
 
@@ -26,25 +29,18 @@ class AddPeerIn(BaseModel):
 @router.post("/connect-to-vpn")
 async def connect_to_vpn(data: AddPeerIn):
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{AGENT_URL}/agent/wg/add-peer",
-                json=data.dict(),
-                headers={"X-Agent-Secret": AGENT_SHARED_SECRET}
-            )
-
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Agent error: {response.status_code} - {response.text}"
-            )
-
+        await agent_client.add_peer(
+            public_key=data.client_public_key,
+            allowed_ips=data.client_ip,
+        )
         return {"status": "success", "detail": "Peer added on server"}
 
-    except httpx.RequestError as e:
+    except agent_client.AgentUnavailable:
+        raise
+    except agent_client.AgentError as e:
         raise HTTPException(
             status_code=HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to reach agent: {str(e)}"
+            detail=str(e)
         )
 
 
@@ -56,23 +52,30 @@ class RemovePeerIn(BaseModel):
 @router.post("/disconnect-from-vpn")
 async def disconnect_from_vpn(data: RemovePeerIn):
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{AGENT_URL}/agent/wg/remove-peer",
-                json=data.dict(),
-                headers={"X-Agent-Secret": AGENT_SHARED_SECRET}
-            )
-
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Agent error: {response.status_code} - {response.text}"
-            )
-
+        await agent_client.remove_peer(public_key=data.client_public_key)
         return {"status": "success", "detail": "Peer removed from server"}
 
-    except httpx.RequestError as e:
+    except agent_client.AgentUnavailable:
+        raise
+    except agent_client.AgentError as e:
         raise HTTPException(
             status_code=HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to reach agent: {str(e)}"
-        )
\ No newline at end of file
+            detail=str(e)
+        )
+
+
+# Live node state pushed by agents over the persistent channel (no polling)
+@router.get("/agent-channels", dependencies=[Depends(require_metrics_access)])
+async def agent_channels():
+    return {"channels": channel_states()}
+
+
+# In-memory health table maintained by the background poller
+@router.get("/agent-health", dependencies=[Depends(require_metrics_access)])
+async def agent_health():
+    return {
+        "agents": [
+            {"agent_url": url, "breaker": breaker_state(url), **row}
+            for url, row in health_table.items()
+        ]
+    }
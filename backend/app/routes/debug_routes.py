@@ -0,0 +1,89 @@
+import asyncio
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from app.auth import require_admin
+from app.database import database
+from app.utils import agent_client, agent_health, profiler, tracing
+
+router = APIRouter(prefix="/debug", tags=["debug"])
+
+
+@router.get("/traces")
+async def list_traces(limit: int = 50, current_user: dict = Depends(require_admin)):
+    """Most recent sampled traces in this worker (summaries only)."""
+    return tracing.recent_traces(min(max(limit, 1), 500))
+
+
+@router.get("/traces/{trace_id}")
+async def get_trace(
+    trace_id: str,
+    include_agent: bool = True,
+    current_user: dict = Depends(require_admin),
+):
+    """One trace with all its spans; agent spans are fetched from each agent it called."""
+    trace = tracing.get_trace(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found (not sampled, or evicted)")
+
+    spans = list(trace["spans"])
+    if include_agent:
+        agent_urls = {s["attrs"].get("agent_url") for s in spans if s["name"].startswith("agent.")}
+        for url in filter(None, agent_urls):
+            try:
+                spans += await agent_client.trace_spans(trace_id, agent_url=url)
+            except agent_client.AgentError:
+                pass
+    return {**trace, "spans": sorted(spans, key=lambda s: s["start"])}
+
+
+def _profile_response(result: dict, format: str):
+    if format == "collapsed":
+        return PlainTextResponse(profiler.collapsed(result["stacks"]))
+    return {**result, "top": profiler.top_functions(result["stacks"])}
+
+
+@router.get("/profile")
+async def profile(
+    seconds: float = Query(10, gt=0, le=profiler.PROFILE_MAX_SECONDS),
+    rate: int = Query(100, ge=1, le=profiler.PROFILE_MAX_RATE, description="Samples per second"),
+    format: Literal["collapsed", "json"] = "collapsed",
+    idle: bool = Query(False, description="Keep samples of threads that are only waiting"),
+    tasks: bool = Query(False, description="Also sample the await chains of suspended asyncio tasks"),
+    current_user: dict = Depends(require_admin),
+):
+    """Sample this worker's stacks for `seconds`. `collapsed` is text for
+    flamegraph.pl / speedscope; `json` adds the top functions by self time.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        result = await run_in_threadpool(profiler.sample, seconds, rate, idle, tasks, loop)
+    except profiler.ProfilerBusy as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return _profile_response(result, format)
+
+
+@router.get("/profile/agent")
+async def profile_agent(
+    agent_url: Optional[str] = None,
+    seconds: float = Query(10, gt=0, le=profiler.PROFILE_MAX_SECONDS),
+    rate: int = Query(100, ge=1, le=profiler.PROFILE_MAX_RATE),
+    format: Literal["collapsed", "json"] = "collapsed",
+    idle: bool = False,
+    tasks: bool = False,
+    current_user: dict = Depends(require_admin),
+):
+    """The same profile taken on an agent (AGENT_URL when none is given).
+
+    Only agents that back an active server are profiled: the request carries
+    the agent shared secret, so it must not go to an arbitrary URL.
+    """
+    if agent_url is not None and agent_url not in await agent_health.known_agents(database, agent_client.AGENT_URL):
+        raise HTTPException(status_code=404, detail="Unknown agent")
+    try:
+        result = await agent_client.profile(seconds, rate, idle, tasks, agent_url)
+    except agent_client.AgentError as exc:
+        raise HTTPException(status_code=502, detail=str(exc))
+    return _profile_response(result, format)
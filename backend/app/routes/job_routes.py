@@ -0,0 +1,33 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from app.database import database
+from app.auth import require_admin
+from app.utils import scheduler
+
+router = APIRouter(prefix="/admin/jobs", tags=["jobs"])
+
+
+@router.get("")
+async def list_jobs(current_user: dict = Depends(require_admin)):
+    """Registered jobs as this replica sees them (triggers, leadership, last run)."""
+    return {"replica": scheduler.scheduler.replica_id, "jobs": scheduler.scheduler.state()}
+
+
+@router.get("/runs")
+async def job_runs(
+    job: Optional[str] = None,
+    limit: int = 50,
+    current_user: dict = Depends(require_admin),
+):
+    """Run history across all replicas, newest first."""
+    return await scheduler.recent_runs(database, job, min(limit, 500))
+
+
+@router.post("/{name}/run", status_code=202)
+async def run_job(name: str, current_user: dict = Depends(require_admin)):
+    """Start a job now. Leader-only jobs held by another replica are queued
+    for that replica, which starts them within a lease renewal period."""
+    try:
+        return await scheduler.scheduler.request_run(name)
+    except scheduler.JobNotFound:
+        raise HTTPException(status_code=404, detail="Job not found")
@@ -1,97 +1,271 @@
+import asyncio
+import os
+import time
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request, Response
 from sqlalchemy import select
 from app.models import vpn_servers, wg_allocations
 from app.database import database
 from app.auth import get_current_user
-from app.schemas import VPNServerCreate, VPNServerUpdate, VPNServerOut
-from app.utils.wireguard import generate_keypair, next_free_ip, render_client_config, config_to_qr_data_url
+from app.schemas import VPNServerCreate, VPNServerUpdate, VPNServerOut, FleetRollout, FleetConfigure
+from app.utils.wireguard import ConfigTemplate, compile_template, config_bundle, config_to_qr_data_url, config_to_qr_png, generate_keypair, ip_to_int, key_to_bytes, next_free_ip, shard_endpoint
+from app.utils import agent_client
+from app.utils.agent_health import breaker_state, servers_on_agent
+from app.utils import catalog, drift, fanout, invalidation, timeseries
+from app.utils.idempotency import idempotent
 from app.schemas import WGConfigResponse
 
 router = APIRouter(prefix="/servers", tags=["servers"])
 
+CONFIG_TEMPLATE_MAX_AGE = int(os.getenv("CONFIG_TEMPLATE_MAX_AGE", "60"))  # seconds clients may reuse a template
+
+# Server rows by id plus the catalog lists ("active"/"all"); any write to
+# vpn_servers publishes "servers" so every worker drops the lot
+_servers = invalidation.cache("servers")
+
+
+async def _server_list(only_active: bool) -> List[dict]:
+    key = "active" if only_active else "all"
+    rows = _servers.get(key)
+    if rows is None:
+        query = select(vpn_servers).order_by(vpn_servers.c.id)
+        if only_active:
+            query = query.where(vpn_servers.c.is_active == True)  # noqa: E712
+        rows = [dict(r) for r in await database.fetch_all(query)]
+        _servers.set(key, rows)
+    return rows
+
+
+def _template(server_row: dict) -> ConfigTemplate:
+    """The server's compiled config template; dropped with the rest of the cache."""
+    key = ("template", server_row["id"])
+    template = _servers.get(key)
+    if template is None:
+        template = compile_template(server_row)
+        _servers.set(key, template)
+    return template
+
+
+async def _server(server_id: int) -> Optional[dict]:
+    row = _servers.get(server_id)
+    if row is None:
+        found = await database.fetch_one(select(vpn_servers).where(vpn_servers.c.id == server_id))
+        if not found:
+            return None
+        row = dict(found)
+        _servers.set(server_id, row)
+    return row
+
 
 @router.get("", response_model=List[VPNServerOut])
-async def get_servers(only_active: bool = True) -> List[VPNServerOut]:
+async def get_servers(
+    only_active: bool = True,
+    country: Optional[str] = Query(None, description="Comma-separated countries, case-insensitive"),
+    active: Optional[bool] = Query(None, description="Filter on is_active; overrides only_active"),
+    min_capacity: Optional[int] = Query(None, ge=0, description="Servers with at least this capacity (no capacity = unlimited)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=catalog.MAX_PAGE_SIZE, description="Page size; all matches when omitted"),
+    fields: Optional[str] = Query(None, description="Comma-separated subset of fields; id is always included"),
+) -> Response:
     """List VPN servers. By default returns only active servers.
     Set `only_active=false` to retrieve all (admin UIs may use this).
+
+    Filtering happens server-side on the cached catalog. With `limit`, the
+    X-Next-Cursor response header carries the cursor for the next page and
+    is absent on the last one.
     """
-    query = select(vpn_servers)
-    if only_active:
-        query = query.where(vpn_servers.c.is_active == True)  # noqa: E712
-    results = await database.fetch_all(query)
-    return results  # FastAPI + Pydantic will coerce to VPNServerOut
+    try:
+        wanted = catalog.parse_fields(fields)
+        results = await _server_list(only_active and active is None)
+        results = catalog.filter_servers(
+            results,
+            countries=country.split(",") if country else None,
+            is_active=active,
+            min_capacity=min_capacity,
+        )
+        results, next_cursor = catalog.page(results, cursor, limit)
+    except catalog.InvalidCatalogQuery as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+    # Agent state is live, not cached, and only looked up when asked for
+    items = catalog.project(results, wanted, lambda r: breaker_state(r["agent_url"] or agent_client.AGENT_URL))
+    response = Response(content=catalog.dumps(items), media_type="application/json")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 
 @router.get("/{server_id}", response_model=Optional[VPNServerOut])
 async def get_server_by_id(server_id: int) -> Optional[VPNServerOut]:
-    row = await database.fetch_one(
-        select(vpn_servers).where(vpn_servers.c.id == server_id)
-    )
+    row = await _server(server_id)
     if not row:
         raise HTTPException(status_code=404, detail="Server not found")
     return row
 
 
+@router.get("/{server_id}/metrics")
+async def get_server_metrics(
+    server_id: int,
+    metric: Optional[str] = Query(None, description="Comma-separated; all metrics when omitted"),
+    since: int = Query(3600, ge=60, le=timeseries.MAX_RETENTION, description="Seconds back from now"),
+    step: Optional[int] = Query(None, ge=1, description="Minimum seconds per point"),
+    current_user: dict = Depends(get_current_user),
+):
+    """Throughput and peer-count graphs for one node, downsampled to the
+    finest tier that covers the range (10s up to 1h, 1m up to 6h, 10m up to
+    24h). Points are [unix_time, value]; null marks a gap.
+    """
+    if not await _server(server_id):
+        raise HTTPException(status_code=404, detail="Server not found")
+    names = [m.strip() for m in metric.split(",") if m.strip()] if metric else list(timeseries.METRICS)
+    unknown = sorted(set(names) - set(timeseries.METRICS))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown metric(s): {', '.join(unknown)}")
+
+    end = time.time()
+    width, series = timeseries.query(server_id, names, end - since, end, step)
+    body = {"server_id": server_id, "step": width, "since": since, "series": series}
+    return Response(content=catalog.dumps(body), media_type="application/json")
+
+
 # --- WireGuard config endpoint ---
 @router.post("/{server_id}/wireguard/config", response_model=WGConfigResponse)
 async def generate_wireguard_config(
     server_id: int,
+    response: Response,
+    format: Optional[str] = Query(None, pattern="^(conf|json|gzip)$", description="conf, json or gzip; default is the legacy JSON body"),
+    qr: bool = Query(True, description="Include the QR code (skipped for format=conf)"),
     current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
 ):
     """Allocate a /32, generate a client keypair, store public key, and return
     a WireGuard client config + QR (simulation mode).
+
+    `format` picks the download: a raw .conf, compact JSON for mobile
+    clients, or a .tar.gz bundle (.conf plus the QR as PNG). With `qr=false`
+    no QR is rendered at all.
+
+    Retries with the same Idempotency-Key get the first response back instead
+    of a new allocation.
     """
-    # 1) Fetch server and validate WG fields
-    server_row = await database.fetch_one(
-        select(vpn_servers).where(vpn_servers.c.id == server_id)
+    result, replayed = await idempotent(
+        idempotency_key,
+        "wireguard_config",
+        current_user["user_id"],
+        {"server_id": server_id},
+        lambda: _generate_wireguard_config(server_id, current_user),
     )
+    # The body carries a private key: never let anything cache it
+    headers = {"Cache-Control": "no-store"}
+    if replayed:
+        headers["Idempotent-Replayed"] = "true"
+
+    config_text = result["config_text"]
+    filename = f"wg-{server_id}-{result['allocated_ip'].split('/', 1)[0]}"
+    if format == "conf":
+        headers["Content-Disposition"] = f'attachment; filename="{filename}.conf"'
+        return Response(content=config_text, media_type="text/plain; charset=utf-8", headers=headers)
+    if format == "json":
+        body = dict(result["compact"], allocated_ip=result["allocated_ip"])
+        if qr:
+            body["qr_code_data_url"] = _qr_data_url(config_text)
+        return Response(content=catalog.dumps(body), media_type="application/json", headers=headers)
+    if format == "gzip":
+        png = _qr_png(config_text) if qr else None
+        headers["Content-Disposition"] = f'attachment; filename="{filename}.tar.gz"'
+        return Response(content=config_bundle(filename, config_text, png), media_type="application/gzip", headers=headers)
+
+    response.headers.update(headers)
+    return WGConfigResponse(
+        config_text=config_text,
+        qr_code_data_url=_qr_data_url(config_text) if qr else "",
+        allocated_ip=result["allocated_ip"],
+    )
+
+
+def _qr_png(config_text: str) -> Optional[bytes]:
+    try:
+        return config_to_qr_png(config_text)
+    except RuntimeError:
+        return None  # qrcode not installed: config only
+
+
+def _qr_data_url(config_text: str) -> str:
+    try:
+        return config_to_qr_data_url(config_text)
+    except RuntimeError:
+        return ""  # qrcode not installed: config only
+
+
+async def _generate_wireguard_config(server_id: int, current_user: dict) -> dict:
+    # 1) Fetch server and validate WG fields
+    server_row = await _server(server_id)
     if not server_row:
         raise HTTPException(status_code=404, detail="Server not found")
 
     if not server_row["is_active"]:
         raise HTTPException(status_code=400, detail="Server is inactive")
 
-    if not server_row.get("wg_public_key") or not server_row.get("wg_endpoint"):
+    if not server_row.get("wg_key") or not server_row.get("wg_endpoint"):
         raise HTTPException(
             status_code=400,
-            detail="Server missing WireGuard settings (wg_public_key/wg_endpoint)",
+            detail="Server missing WireGuard settings (public key/wg_endpoint)",
         )
 
-    # 2) Allocate next free client IP for this server
+    # 2) Generate simulated keypair and ask the agent which interface shard the
+    #    peer lands on (own subnet slice + listen port). Falls back to defaults.
+    client_priv, client_pub = generate_keypair()
+    shard = await agent_client.assign_shard(client_pub, agent_url=server_row["agent_url"])
+
+    # 3) Allocate next free client IP for this server (inside the shard's slice)
     try:
-        client_ip_with_prefix = await next_free_ip(database, server_id)
+        if shard and shard.get("subnet"):
+            client_ip_with_prefix = await next_free_ip(database, server_id, base_cidr=shard["subnet"])
+        else:
+            client_ip_with_prefix = await next_free_ip(database, server_id)
     except RuntimeError as exc:
         raise HTTPException(status_code=409, detail=str(exc)) from exc
 
-    # 3) Generate simulated keypair and persist allocation (store public only)
-    client_priv, client_pub = generate_keypair()
-
+    # Persist allocation (store public only)
     await database.execute(
         wg_allocations.insert().values(
-            user_id=current_user["id"],
+            user_id=current_user["user_id"],
             server_id=server_id,
-            client_ip=client_ip_with_prefix,
-            client_public_key=client_pub,
+            client_addr=ip_to_int(client_ip_with_prefix),
+            client_key=key_to_bytes(client_pub),
         )
     )
 
-    # 4) Render client config & QR
-    config_text = render_client_config(
-        dict(server_row), client_priv, client_ip_with_prefix
-    )
+    # 4) Render the client config from the server's compiled template; the
+    #    QR is left to the caller, which may not want one
+    template = _template(server_row)
+    endpoint = shard_endpoint(server_row["wg_endpoint"], shard)
+    return {
+        "config_text": template.render(client_priv, client_ip_with_prefix, endpoint),
+        "compact": template.compact(client_priv, client_ip_with_prefix, endpoint),
+        "allocated_ip": client_ip_with_prefix,
+    }
+
 
+@router.get("/{server_id}/wireguard/template")
+async def get_wireguard_template(server_id: int, request: Request):
+    """The server half of every client config (public key, endpoint, allowed
+    IPs, DNS), for clients that generate their own keys. Cacheable: send the
+    ETag back in If-None-Match to get a 304 while the server is unchanged.
+    """
+    server_row = await _server(server_id)
+    if not server_row:
+        raise HTTPException(status_code=404, detail="Server not found")
     try:
-        qr_data_url = config_to_qr_data_url(config_text)
-    except RuntimeError as exc:
-        # qrcode not installed: return config only with an informative message embedded
-        qr_data_url = ""
+        template = _template(server_row)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
 
-    return WGConfigResponse(
-        config_text=config_text,
-        qr_code_data_url=qr_data_url,
-        allocated_ip=client_ip_with_prefix,
-    )
+    headers = {"ETag": template.etag, "Cache-Control": f"max-age={CONFIG_TEMPLATE_MAX_AGE}"}
+    if template.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    body = {"server_id": server_id, "peer": template.peer(), "dns": template.dns}
+    return Response(content=catalog.dumps(body), media_type="application/json", headers=headers)
 
 
 @router.post("", status_code=201)
@@ -104,7 +278,9 @@ async def add_vpn_server(
 
     # Pydantic v2 -> model_dump(); v1 would be dict()
     values = server.model_dump()
-    server_id = await database.execute(vpn_servers.insert().values(**values))
+    async with database.transaction():
+        server_id = await database.execute(vpn_servers.insert().values(**values))
+        await invalidation.publish(database, "servers")
     return {"message": "Server added", "id": server_id}
 
 
@@ -129,10 +305,138 @@ async def update_vpn_server(
     if not exists:
         raise HTTPException(status_code=404, detail="Server not found")
 
-    await database.execute(
-        vpn_servers.update().where(vpn_servers.c.id == server_id).values(**update_fields)
+    async with database.transaction():
+        await database.execute(
+            vpn_servers.update().where(vpn_servers.c.id == server_id).values(**update_fields)
+        )
+        await invalidation.publish(database, "servers")
+
+    # Push node-side settings to the agent: the endpoint port is the listen port
+    push = None
+    port = _endpoint_port(update_fields.get("wg_endpoint"))
+    if port is not None:
+        targets = await _fleet_targets([server_id], only_active=False)
+        push = await fanout.fan_out(
+            targets, lambda t: agent_client.configure(listen_port=port, agent_url=t["agent_url"])
+        )
+    return {"message": f"Server {server_id} updated", "fields": update_fields, "push": push}
+
+
+def _endpoint_port(endpoint: Optional[str]) -> Optional[int]:
+    if not endpoint or ":" not in endpoint:
+        return None
+    try:
+        return int(endpoint.rsplit(":", 1)[1])
+    except ValueError:
+        return None
+
+
+async def _fleet_targets(server_ids: Optional[List[int]], only_active: bool = True) -> List[dict]:
+    query = select(vpn_servers.c.id, vpn_servers.c.agent_url).order_by(vpn_servers.c.id)
+    if only_active:
+        query = query.where(vpn_servers.c.is_active == True)  # noqa: E712
+    if server_ids:
+        query = query.where(vpn_servers.c.id.in_(server_ids))
+    rows = await database.fetch_all(query)
+    return [
+        {"server_id": r["id"], "agent_url": r["agent_url"] or agent_client.AGENT_URL}
+        for r in rows
+    ]
+
+
+async def _agent_targets(server_ids: Optional[List[int]]) -> List[dict]:
+    """_fleet_targets collapsed to one target per agent (servers can share one)."""
+    by_agent: dict = {}
+    for t in await _fleet_targets(server_ids):
+        by_agent.setdefault(t["agent_url"], {**t, "server_ids": []})["server_ids"].append(t["server_id"])
+    return list(by_agent.values())
+
+
+def _rollout_opts(body: FleetRollout) -> dict:
+    opts = {"canary": body.canary, "concurrency": body.concurrency, "timeout": body.timeout}
+    return {k: v for k, v in opts.items() if v is not None}
+
+
+@router.post("/fleet/configure")
+async def fleet_configure(
+    body: FleetConfigure,
+    current_user: dict = Depends(get_current_user),
+):
+    """Push a listen port change to many nodes at once (canary wave first)."""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    targets = await _fleet_targets(body.server_ids)
+    return await fanout.fan_out(
+        targets,
+        lambda t: agent_client.configure(listen_port=body.listen_port, agent_url=t["agent_url"]),
+        **_rollout_opts(body),
     )
-    return {"message": f"Server {server_id} updated", "fields": update_fields}
+
+
+@router.post("/fleet/rotate-keys")
+async def fleet_rotate_keys(
+    body: FleetRollout,
+    current_user: dict = Depends(get_current_user),
+):
+    """Rotate server keys across the fleet. Each node generates its own key
+    once, and its new public key is stored on every server row it backs as
+    soon as that node confirms."""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    async def store_key(agent_url: str, public_key: str) -> None:
+        async with database.transaction():
+            await database.execute(
+                vpn_servers.update().where(servers_on_agent(agent_url)).values(wg_key=key_to_bytes(public_key))
+            )
+            await invalidation.publish(database, "servers")
+
+    async def rotate(target: dict) -> dict:
+        res = await agent_client.rotate_key(agent_url=target["agent_url"])
+        # The node has switched keys: record it even if the fan-out timeout
+        # cancels us now, or the stored key stays stale
+        await asyncio.shield(store_key(target["agent_url"], res["public_key"]))
+        return {"public_key": res["public_key"], "server_ids": target["server_ids"]}
+
+    targets = await _agent_targets(body.server_ids)
+    return await fanout.fan_out(targets, rotate, **_rollout_opts(body))
+
+
+@router.post("/fleet/drift-check")
+async def fleet_drift_check(
+    repair: bool = False,
+    current_user: dict = Depends(get_current_user),
+):
+    """Compare every agent's live peers with the allocations of all servers it
+    backs (digest walk), once per agent."""
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    reports = await drift.check_fleet(database, auto_repair=repair)
+    return {"in_sync": all(r["in_sync"] for r in reports), "agents": reports}
+
+
+@router.post("/{server_id}/drift-check")
+async def server_drift_check(
+    server_id: int,
+    repair: bool = False,
+    current_user: dict = Depends(get_current_user),
+):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    server = await database.fetch_one(
+        select(vpn_servers.c.agent_url).where(vpn_servers.c.id == server_id)
+    )
+    if not server:
+        raise HTTPException(status_code=404, detail="Server not found")
+
+    # Checks the server's whole agent: peers of other servers on it aren't "leaked"
+    report = await drift.check_agent(database, server["agent_url"])
+    if repair and not report["in_sync"]:
+        report["repair"] = await drift.repair(report)
+    return report
 
 
 @router.delete("/{server_id}")
@@ -151,7 +455,9 @@ async def delete_vpn_server(
     if not exists:
         raise HTTPException(status_code=404, detail="Server not found")
 
-    await database.execute(
-        vpn_servers.update().where(vpn_servers.c.id == server_id).values(is_active=False)
-    )
+    async with database.transaction():
+        await database.execute(
+            vpn_servers.update().where(vpn_servers.c.id == server_id).values(is_active=False)
+        )
+        await invalidation.publish(database, "servers")
     return {"message": f"Server {server_id} marked as inactive"}
\ No newline at end of file
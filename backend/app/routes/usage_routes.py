@@ -0,0 +1,90 @@
+import datetime
+from typing import Optional, Literal
+from fastapi import APIRouter, Depends
+from sqlalchemy import select
+from app.models import usage_server_hourly, usage_server_daily, usage_user_daily
+from app.database import database
+from app.auth import get_current_user, require_admin
+from app.utils import rollups
+
+router = APIRouter(tags=["usage"])
+
+
+@router.get("/admin/usage/servers")
+async def server_usage(
+    granularity: Literal["hour", "day"] = "hour",
+    server_id: Optional[int] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    current_user: dict = Depends(require_admin),
+):
+    """Sessions and connected minutes per server, from the rollup tables.
+    Defaults to the last 24 hours (hourly) or last 30 days (daily).
+    """
+    now = datetime.datetime.utcnow()
+    if granularity == "hour":
+        table, bucket = usage_server_hourly, usage_server_hourly.c.bucket_start
+        start = start or now - datetime.timedelta(hours=24)
+        lo, hi = start, end or now
+    else:
+        table, bucket = usage_server_daily, usage_server_daily.c.day
+        start = start or now - datetime.timedelta(days=30)
+        lo, hi = start.date(), (end or now).date()
+
+    query = (
+        select(
+            table.c.server_id,
+            bucket.label("bucket"),
+            table.c.sessions,
+            (table.c.connected_seconds / 60).label("connected_minutes"),
+        )
+        .where(bucket >= lo)
+        .where(bucket <= hi)
+        .order_by(table.c.server_id, bucket)
+    )
+    if server_id is not None:
+        query = query.where(table.c.server_id == server_id)
+
+    rows = await database.fetch_all(query)
+    return {"granularity": granularity, "buckets": rows}
+
+
+@router.post("/admin/usage/rebuild")
+async def rebuild_usage(current_user: dict = Depends(require_admin)):
+    """Recompute every rollup from the raw connections table."""
+    processed = await rollups.rebuild(database)
+    return {"message": "Usage rollups rebuilt", "sessions": processed}
+
+
+@router.get("/users/me/usage")
+async def my_usage(
+    start: Optional[datetime.date] = None,
+    end: Optional[datetime.date] = None,
+    current_user: dict = Depends(get_current_user),
+):
+    """The current user's daily usage; defaults to the current month."""
+    today = datetime.datetime.utcnow().date()
+    start = start or today.replace(day=1)
+    end = end or today
+
+    days = await database.fetch_all(
+        select(
+            usage_user_daily.c.day,
+            usage_user_daily.c.sessions,
+            usage_user_daily.c.connected_seconds,
+        )
+        .where(usage_user_daily.c.user_id == current_user["user_id"])
+        .where(usage_user_daily.c.day >= start)
+        .where(usage_user_daily.c.day <= end)
+        .order_by(usage_user_daily.c.day)
+    )
+    return {
+        "start": start,
+        "end": end,
+        "sessions": sum(d["sessions"] for d in days),
+        "connected_minutes": sum(d["connected_seconds"] for d in days) // 60,
+        "days": [
+            {"day": d["day"], "sessions": d["sessions"], "connected_minutes": d["connected_seconds"] // 60}
+            for d in days
+        ],
+    }
@@ -1,17 +1,27 @@
-from fastapi import APIRouter, HTTPException, Depends
+import asyncio
+import json
+from fastapi import APIRouter, HTTPException, Depends, Request, Header, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from app.schemas import UserCreate, UserLogin, ConnectRequest
 from app.database import database
-from app.models import users, connections, twofa_secrets, vpn_servers
-import bcrypt
-from jose import jwt, JWTError
+from app.models import users, connections, connections_archive, twofa_secrets, vpn_servers
 from fastapi.security import OAuth2PasswordBearer
 import os
 from dotenv import load_dotenv
-from app.auth import get_current_user, create_access_token
+from app.auth import get_current_user, get_current_user_for_stream, create_access_token, create_stream_ticket, STREAM_TICKET_TTL
 import datetime
-import pyotp
-from sqlalchemy import select, join, and_
-import httpx
+from typing import Optional
+from sqlalchemy import select, join, and_, exists, union_all, text
+from app.utils import agent_client, rate_limit
+from app.utils.archiver import archive_horizon
+from app.utils.connection_events import publish, user_topic
+from app.utils.pubsub import broker
+from app.utils.session_buffer import get_session_buffer
+from app.utils.idempotency import idempotent
+from app.utils.tracing import span
+
+STREAM_KEEPALIVE_SECONDS = 15
 
 load_dotenv()
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
@@ -21,14 +31,21 @@ router = APIRouter()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 @router.post("/register")
-async def register_user(user: UserCreate):
+async def register_user(user: UserCreate, request: Request):
+    ip = rate_limit.client_ip(request)
+    rate_limit.enforce(("register_ip", ip))
+    rate_limit.record("register_ip", ip)
+
     query = users.select().where((users.c.username == user.username) | (users.c.email == user.email))
     existing_user = await database.fetch_one(query)
     
     if existing_user:
         raise HTTPException(status_code=400, detail="Username or email already exists")
     
-    hashed_pw = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
+    import bcrypt
+
+    with span("bcrypt.hashpw"):
+        hashed_pw = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
     insert_query = users.insert().values(
         username=user.username,
         email=user.email,
@@ -39,36 +56,57 @@ async def register_user(user: UserCreate):
 
 # Alias endpoint for /signup
 @router.post("/signup")
-async def signup_user(user: UserCreate):
-    return await register_user(user)
+async def signup_user(user: UserCreate, request: Request):
+    return await register_user(user, request)
 
 @router.post("/login")
-async def login_user(user: UserLogin):
-    # Look up user
-    query = users.select().where(users.c.username == user.username)
+async def login_user(user: UserLogin, request: Request):
+    # Shed over-limit attempts before any DB or bcrypt work. Only failures
+    # count against the username, and per client IP, so its owner isn't
+    # locked out by someone else guessing (see rate_limit.enforce_login)
+    ip = rate_limit.client_ip(request)
+    username_key = user.username.lower()
+    rate_limit.enforce_login(username_key, ip)
+    rate_limit.record("login_ip", ip)
+
+    # Look up the user and their 2FA secret (if any) in one round trip
+    query = (
+        select(users.c.id, users.c.hashed_password, twofa_secrets.c.secret_key)
+        .select_from(users.outerjoin(twofa_secrets, twofa_secrets.c.user_id == users.c.id))
+        .where(users.c.username == user.username)
+        .limit(1)
+    )
     db_user = await database.fetch_one(query)
 
     if not db_user:
+        rate_limit.record_login_failure(username_key, ip)
         raise HTTPException(status_code=400, detail="Invalid username or password")
 
     # Check password
-    if not bcrypt.checkpw(user.password.encode("utf-8"), db_user["hashed_password"].encode("utf-8")):
+    import bcrypt
+
+    with span("bcrypt.checkpw"):
+        password_ok = bcrypt.checkpw(user.password.encode("utf-8"), db_user["hashed_password"].encode("utf-8"))
+    if not password_ok:
+        rate_limit.record_login_failure(username_key, ip)
         raise HTTPException(status_code=400, detail="Invalid username or password")
 
     # Check if user has 2FA enabled
-    twofa_query = twofa_secrets.select().where(twofa_secrets.c.user_id == db_user["id"])
-    secret_record = await database.fetch_one(twofa_query)
-
-    if secret_record:
+    if db_user["secret_key"]:
         # User has 2FA, so they must provide a valid code
         if not user.twofa_code:
             raise HTTPException(status_code=401, detail="2FA code required")
 
-        totp = pyotp.TOTP(secret_record["secret_key"])
+        import pyotp
+
+        totp = pyotp.TOTP(db_user["secret_key"])
         if not totp.verify(user.twofa_code):
+            rate_limit.record_login_failure(username_key, ip)
             raise HTTPException(status_code=401, detail="Invalid 2FA code")
 
-    # Step 4: Generate token if all checks pass
+    # Step 4: Generate token if all checks pass. This IP keeps getting in
+    # while the username is under attack from elsewhere
+    rate_limit.record_login_success(username_key, ip)
     payload = {
         "sub": user.username,
         "user_id": db_user["id"],
@@ -79,81 +117,90 @@ async def login_user(user: UserLogin):
 
 @router.get("/profile")
 async def get_profile(current_user: dict = Depends(get_current_user)):
-    uid = current_user["user_id"]
-    row = await database.fetch_one(
-        users.select().where(users.c.id == uid)
-    )
-    if not row:
-        raise HTTPException(status_code=404, detail="User not found")
-    twofa = await database.fetch_one(
-        twofa_secrets.select().where(twofa_secrets.c.user_id == uid)
-    )
+    # get_current_user already loaded everything the profile shows
     return {
         "user" : {
-            "user_id": row["id"],
-            "username": row["username"],
-            "email": row["email"],
-            "is_active": row["is_active"],
-            "created_at": row["created_at"],
-            "twofa_enabled": bool(twofa)
+            "user_id": current_user["user_id"],
+            "username": current_user["username"],
+            "email": current_user["email"],
+            "is_active": current_user["is_active"],
+            "created_at": current_user["created_at"],
+            "twofa_enabled": current_user["twofa_enabled"],
         }
     }
 
 @router.post("/connect")
 async def connect_to_server(
     payload: ConnectRequest,
-    current_user: dict = Depends(get_current_user)
+    response: Response,
+    current_user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
 ):
-    # Ensure the server exists and is active
+    # Retries with the same Idempotency-Key replay the first result
+    result, replayed = await idempotent(
+        idempotency_key,
+        "connect",
+        current_user["user_id"],
+        payload,
+        lambda: _connect_to_server(payload, current_user),
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+async def _connect_to_server(payload: ConnectRequest, current_user: dict):
+    # Ensure the server exists and is active, and check for an open session
+    # in the same round trip
+    open_session = (
+        exists()
+        .where(connections.c.user_id == current_user["user_id"])
+        .where(connections.c.disconnected_at.is_(None))
+    )
     server = await database.fetch_one(
-        vpn_servers.select().where(vpn_servers.c.id == payload.server_id)
+        select(vpn_servers.c.is_active, vpn_servers.c.agent_url, open_session.label("already_connected"))
+        .where(vpn_servers.c.id == payload.server_id)
     )
     if not server:
         raise HTTPException(status_code=404, detail="Server not found")
     if not server["is_active"]:
         raise HTTPException(status_code=400, detail="Server is inactive")
 
-    # Check if the user is already connected
-    existing = await database.fetch_one(
-        connections.select().where(
-            (connections.c.user_id == current_user["user_id"]) &
-            (connections.c.disconnected_at.is_(None))
-        )
-    )
-    if existing:
+    # Fail fast (503) if this server's agent is known to be down
+    agent_client.ensure_available(server["agent_url"])
+
+    # Check if the user is already connected (unflushed buffered events first)
+    buffer = get_session_buffer()
+    pending = buffer.pending_state(current_user["user_id"]) if buffer else None
+    already_connected = pending["open"] if pending is not None else server["already_connected"]
+    if already_connected:
         raise HTTPException(status_code=400, detail="Already connected to a server")
 
-    # Insert a new connection record
-    insert_query = connections.insert().values(
-        user_id=current_user["user_id"],
-        server_id=payload.server_id,
-    )
-    await database.execute(insert_query)
+    # Insert a new connection record (or queue it when write-behind is on;
+    # the id is only known after the flush)
+    if buffer:
+        buffer.connect(current_user["user_id"], payload.server_id)
+        connection_id = None
+    else:
+        insert_query = connections.insert().values(
+            user_id=current_user["user_id"],
+            server_id=payload.server_id,
+        )
+        connection_id = await database.execute(insert_query)
+    await publish(database, current_user["user_id"], "connected", connection_id=connection_id, server_id=payload.server_id)
 
-    # Call VPN Agent to apply the peer
+    # Call VPN Agent to apply the peer (persistent channel, REST fallback)
     try:
-        AGENT_URL = os.getenv("AGENT_URL")
-        AGENT_SECRET = os.getenv("AGENT_SHARED_SECRET")
-
-        # Build peer payload
-        peer_payload = {
-            "public_key": payload.public_key,
-            "allowed_ips": payload.allowed_ips,
-            "persistent_keepalive": 25
-        }
-
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{AGENT_URL}/agent/wg/add-peer",
-                json=peer_payload,
-                headers={"X-Agent-Secret": AGENT_SECRET}
-            )
-
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail="Failed to apply peer on VPN agent")
-
-    except Exception as e:
+        await agent_client.add_peer(
+            public_key=payload.public_key,
+            allowed_ips=payload.client_ip,
+            persistent_keepalive=25,
+            agent_url=server["agent_url"],
+        )
+    except agent_client.AgentUnavailable:
+        raise
+    except agent_client.AgentError as e:
         raise HTTPException(status_code=500, detail=f"Agent error: {str(e)}")
+    await publish(database, current_user["user_id"], "peer_applied", connection_id=connection_id, server_id=payload.server_id)
 
     return {"message": f"Connected to server {payload.server_id}"}
 
@@ -161,21 +208,35 @@ async def connect_to_server(
 async def disconnect_from_vpn(
     current_user: dict = Depends(get_current_user)
 ):
-    # Find the latest active connection for this user
-    query = connections.select().where(
-        (connections.c.user_id == current_user["user_id"]) & 
-        (connections.c.disconnected_at.is_(None))
-    ).order_by(connections.c.connected_at.desc())
-
-    session = await database.fetch_one(query)
+    # Find the latest active connection for this user (unflushed buffered events first)
+    buffer = get_session_buffer()
+    pending = buffer.pending_state(current_user["user_id"]) if buffer else None
+    if pending is not None:
+        session = {"id": None, "server_id": pending["server_id"]} if pending["open"] else None
+    else:
+        query = connections.select().where(
+            (connections.c.user_id == current_user["user_id"]) & 
+            (connections.c.disconnected_at.is_(None))
+        ).order_by(connections.c.connected_at.desc())
+        session = await database.fetch_one(query)
     if not session:
         raise HTTPException(status_code=400, detail="No active connection found")
 
-    now_utc = datetime.datetime.utcnow()
-    update_query = connections.update().where(
-        connections.c.id == session["id"]
-    ).values(disconnected_at=now_utc)
-    await database.execute(update_query)
+    if buffer:
+        now_utc = buffer.disconnect(current_user["user_id"])
+    else:
+        now_utc = datetime.datetime.utcnow()
+        update_query = connections.update().where(
+            connections.c.id == session["id"]
+        ).values(disconnected_at=now_utc)
+        await database.execute(update_query)
+    await publish(
+        database,
+        current_user["user_id"],
+        "disconnected",
+        connection_id=session["id"],
+        server_id=session["server_id"],
+    )
 
     return {
         "message": f"Disconnected from server {session['server_id']}",
@@ -184,24 +245,39 @@ async def disconnect_from_vpn(
     }
     
 @router.get("/my-connections")
-async def list_user_connections(current_user: dict = Depends(get_current_user)):
-    # Perform a JOIN between connections and vpn_servers
-    j = join(connections, vpn_servers, connections.c.server_id == vpn_servers.c.id)
-
-    query = (
-        select(
-            connections.c.id.label("id"),
-            connections.c.server_id.label("server_id"),
-            connections.c.connected_at,
-            connections.c.disconnected_at,
-            vpn_servers.c.name.label("server_name"),
-            vpn_servers.c.country.label("country"),
-            vpn_servers.c.ip_address.label("server_ip")
+async def list_user_connections(
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    current_user: dict = Depends(get_current_user),
+):
+    """The user's sessions, newest first. Ranges reaching back past the
+    archive horizon also read from connections_archive."""
+    def sessions_query(table):
+        # Perform a JOIN between the sessions table and vpn_servers
+        j = join(table, vpn_servers, table.c.server_id == vpn_servers.c.id)
+        query = (
+            select(
+                table.c.id.label("id"),
+                table.c.server_id.label("server_id"),
+                table.c.connected_at,
+                table.c.disconnected_at,
+                vpn_servers.c.name.label("server_name"),
+                vpn_servers.c.country.label("country"),
+                vpn_servers.c.ip_address.label("server_ip")
+            )
+            .select_from(j)
+            .where(table.c.user_id == current_user["user_id"])
         )
-        .select_from(j)
-        .where(connections.c.user_id == current_user["user_id"])
-        .order_by(connections.c.connected_at.desc())
-    )
+        if start is not None:
+            query = query.where(table.c.connected_at >= start)
+        if end is not None:
+            query = query.where(table.c.connected_at < end)
+        return query
+
+    query = sessions_query(connections)
+    if start is not None and start < archive_horizon():
+        query = union_all(query, sessions_query(connections_archive))
+    query = query.order_by(text("connected_at DESC"))
 
     result = await database.fetch_all(query)
     return {"connections": result}
@@ -209,6 +285,20 @@ async def list_user_connections(current_user: dict = Depends(get_current_user)):
 
 @router.get("/me/connection")
 async def get_current_connection(current_user: dict = Depends(get_current_user)):
+    # Read our own buffered writes before they reach the table
+    buffer = get_session_buffer()
+    pending = buffer.pending_state(current_user["user_id"]) if buffer else None
+    if pending is not None:
+        if not pending["open"]:
+            return None
+        return {
+            "id": None,
+            "user_id": current_user["user_id"],
+            "server_id": pending["server_id"],
+            "connected_at": pending["connected_at"],
+            "disconnected_at": None,
+        }
+
     # Join connections with vpn_servers to include server details
     j = join(connections, vpn_servers, connections.c.server_id == vpn_servers.c.id)
 
@@ -239,4 +329,50 @@ async def get_current_connection(current_user: dict = Depends(get_current_user))
         "server_id": row["server_id"],
         "connected_at": row["connected_at"],
         "disconnected_at": None,
-    }
\ No newline at end of file
+    }
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+
+
+@router.post("/me/connection/stream-ticket")
+async def stream_ticket(current_user: dict = Depends(get_current_user)):
+    """A short-lived credential for /me/connection/stream?ticket=..., so the
+    access token never has to go in a URL."""
+    return {
+        "ticket": create_stream_ticket(current_user["user_id"], current_user["username"]),
+        "expires_in": STREAM_TICKET_TTL,
+    }
+
+
+@router.get("/me/connection/stream")
+async def stream_connection(
+    request: Request,
+    current_user: dict = Depends(get_current_user_for_stream),
+):
+    """Server-sent events for the current user's connection state.
+
+    Browsers authenticate with ?ticket= (see /me/connection/stream-ticket);
+    other clients can send the usual Authorization header.
+
+    Sends a `snapshot` (same shape as /me/connection) on open, then
+    `connected`, `peer_applied`, `disconnected` and periodic `transfer`
+    events as they happen, with a keepalive comment when idle.
+    """
+    async def events():
+        async with broker.subscribe(user_topic(current_user["user_id"])) as queue:
+            yield _sse("snapshot", await get_current_connection(current_user))
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(event["type"], event)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
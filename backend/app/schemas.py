@@ -43,6 +43,8 @@ class VPNServerCreate(BaseModel):
     ip_address: str
     config_path: str
     is_active: bool = True
+    agent_url: Optional[str] = None
+    capacity: Optional[int] = None  # max peers; None = unlimited
 
 
 class VPNServerUpdate(BaseModel):
@@ -51,6 +53,11 @@ class VPNServerUpdate(BaseModel):
     ip_address: Optional[str] = None
     config_path: Optional[str] = None
     is_active: Optional[bool] = None
+    agent_url: Optional[str] = None
+    wg_endpoint: Optional[str] = None
+    wg_allowed_ips: Optional[str] = None
+    wg_dns: Optional[str] = None
+    capacity: Optional[int] = None
 
 
 class VPNServerOut(BaseModel):
@@ -59,10 +66,23 @@ class VPNServerOut(BaseModel):
     country: Optional[str]
     ip_address: str
     is_active: bool
+    capacity: Optional[int] = None
+    agent_state: Optional[str] = None  # circuit breaker: closed / half_open / open
 
     model_config = {"from_attributes": True}
 
 
+class FleetRollout(BaseModel):
+    server_ids: Optional[List[int]] = None  # default: every active server
+    canary: Optional[int] = None
+    concurrency: Optional[int] = None
+    timeout: Optional[float] = None
+
+
+class FleetConfigure(FleetRollout):
+    listen_port: int
+
+
 # --- 2FA ---
 
 class TwoFAVerify(BaseModel):
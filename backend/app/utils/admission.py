@@ -0,0 +1,96 @@
+"""Per-route-class admission control.
+
+Requests are grouped into classes with their own in-flight limit, so a
+burst of logins (bcrypt + DB) can't use up every slot that server listing
+needs, and the other way round. A request that finds its class full waits
+up to ADMISSION_QUEUE_TIMEOUT seconds for a slot and is then rejected with
+503 + Retry-After instead of piling up behind the database pool.
+
+Long-lived streams and health/metrics endpoints are not counted.
+"""
+import asyncio
+import os
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from app.utils import metrics
+
+ADMISSION_AUTH_LIMIT = int(os.getenv("ADMISSION_AUTH_LIMIT", "32"))
+ADMISSION_LISTING_LIMIT = int(os.getenv("ADMISSION_LISTING_LIMIT", "64"))
+ADMISSION_DEFAULT_LIMIT = int(os.getenv("ADMISSION_DEFAULT_LIMIT", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0.5"))  # seconds
+
+_AUTH_PATHS = {"/users/login", "/users/register", "/users/signup", "/security/2fa/verify"}
+_LISTING_PREFIXES = ("/servers", "/users/my-connections", "/users/me/usage", "/admin/usage")
+_EXEMPT_PATHS = {"/metrics", "/health", "/health/ready", "/users/me/connection/stream"}
+
+
+def route_class(method: str, path: str) -> Optional[str]:
+    """The admission class for a request, or None if it is not limited."""
+    if path in _EXEMPT_PATHS or method == "OPTIONS":
+        return None
+    if path in _AUTH_PATHS:
+        return "auth"
+    if method == "GET" and path.startswith(_LISTING_PREFIXES):
+        return "listing"
+    return "default"
+
+
+class _Gate:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._sem = asyncio.Semaphore(limit)
+
+    async def acquire(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._sem.release()
+
+
+_gates: Dict[str, _Gate] = {
+    "auth": _Gate(ADMISSION_AUTH_LIMIT),
+    "listing": _Gate(ADMISSION_LISTING_LIMIT),
+    "default": _Gate(ADMISSION_DEFAULT_LIMIT),
+}
+
+
+def admission_state() -> Dict[str, dict]:
+    return {name: {"in_flight": g.in_flight, "limit": g.limit} for name, g in _gates.items()}
+
+
+def _collect() -> None:
+    for name, g in _gates.items():
+        metrics.set_gauge("admission_in_flight", g.in_flight, route_class=name)
+        metrics.set_gauge("admission_limit", g.limit, route_class=name)
+
+
+metrics.register_collector(_collect)
+
+
+async def admission_middleware(request: Request, call_next):
+    name = route_class(request.method, request.url.path)
+    if name is None:
+        return await call_next(request)
+
+    gate = _gates[name]
+    if not await gate.acquire(ADMISSION_QUEUE_TIMEOUT):
+        metrics.inc("admission_rejected_total", route_class=name)
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Server busy, retry shortly"},
+            headers={"Retry-After": "1"},
+        )
+    try:
+        return await call_next(request)
+    finally:
+        gate.release()
@@ -0,0 +1,201 @@
+"""Persistent WebSocket command channel to the WireGuard agent.
+
+Instead of one HTTP POST per peer operation, each backend worker keeps a single
+long-lived connection per agent. Commands are pipelined with request ids and
+acked asynchronously; the agent also pushes health/shard stats on its own, so
+`state` always holds the latest node view without polling.
+
+On disconnect the channel reconnects with backoff and re-sends every command
+that was not acked yet (the agent dedupes by id). While disconnected, or
+if the send itself fails, `request()` raises ChannelUnavailable and callers
+fall back to REST. A command that went out but wasn't acked in time raises
+ChannelTimeout instead: the agent may still be running it, and it doesn't
+dedupe across transports, so retrying over REST could apply it twice.
+
+Requires the optional `websockets` package; without it the channel stays off.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Dict, Any, Optional, Callable, List
+
+log = logging.getLogger(__name__)
+
+AGENT_CHANNEL = os.getenv("AGENT_CHANNEL", "false").lower() == "true"
+CHANNEL_TIMEOUT = float(os.getenv("AGENT_CHANNEL_TIMEOUT", "5"))  # seconds per command
+_BACKOFF_MAX = 30.0
+
+
+class ChannelUnavailable(RuntimeError):
+    """The command was not sent: no live channel to this agent. Use the REST fallback."""
+
+
+class ChannelTimeout(RuntimeError):
+    """The command was sent but not acked in time; the agent may still apply it."""
+
+
+class AgentChannel:
+    def __init__(self, agent_url: str, secret: str):
+        self.agent_url = agent_url
+        self.ws_url = agent_url.replace("http", "ws", 1).rstrip("/") + "/agent/ws"
+        self.secret = secret
+        self.state: Dict[str, Any] = {}  # last pushed event per type, e.g. state["health"]
+        self.last_event_at: Optional[float] = None
+        self._ws = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._sent: Dict[str, str] = {}  # id -> raw message, kept until acked
+        self._ids = itertools.count(1)
+        self._prefix = uuid.uuid4().hex[:8]
+        self._listeners: List[Callable[[str, dict], None]] = []
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+
+    def on_event(self, callback: Callable[[str, dict], None]) -> None:
+        self._listeners.append(callback)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(ChannelUnavailable("channel closed"))
+        self._pending.clear()
+        self._sent.clear()
+
+    async def request(
+        self, op: str, args: dict, timeout: float = CHANNEL_TIMEOUT, trace: Optional[Dict[str, str]] = None
+    ) -> dict:
+        """Send one command and wait for its ack. Raises ChannelUnavailable if
+        it could not be sent, ChannelTimeout if it was sent but not acked, and
+        RuntimeError if the agent rejected it.
+        `trace` is tracing.context(), so the agent's spans join the trace."""
+        if self._ws is None:
+            raise ChannelUnavailable(f"no channel to {self.agent_url}")
+
+        req_id = f"{self._prefix}-{next(self._ids)}"
+        msg = {"id": req_id, "op": op, "args": args}
+        if trace:
+            msg["trace"] = trace
+        raw = json.dumps(msg)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = fut
+        self._sent[req_id] = raw
+        try:
+            await self._ws.send(raw)
+        except Exception as exc:
+            # Not sent: drop it so a reconnect doesn't replay what the caller
+            # is about to send over REST
+            self._pending.pop(req_id, None)
+            self._sent.pop(req_id, None)
+            raise ChannelUnavailable(f"could not send {op} to {self.agent_url}: {exc}") from exc
+        try:
+            ack = await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError as exc:
+            raise ChannelTimeout(f"agent did not ack {op} within {timeout}s") from exc
+        finally:
+            self._pending.pop(req_id, None)
+            self._sent.pop(req_id, None)
+
+        if not ack.get("ok"):
+            raise RuntimeError(f"Agent error: {ack.get('status')} - {ack.get('error')}")
+        return ack.get("result") or {}
+
+    async def _run(self) -> None:
+        import websockets  # optional dependency, checked in start_channels()
+
+        backoff = 0.5
+        while True:
+            try:
+                async with websockets.connect(
+                    self.ws_url, additional_headers={"X-Agent-Secret": self.secret}
+                ) as ws:
+                    self._ws = ws
+                    backoff = 0.5
+                    log.info("agent channel connected: %s", self.ws_url)
+                    # Resume: replay everything that was sent but never acked
+                    for raw in list(self._sent.values()):
+                        await ws.send(raw)
+                    async for raw in ws:
+                        self._dispatch(json.loads(raw))
+            except asyncio.CancelledError:
+                self._ws = None
+                raise
+            except Exception as exc:
+                log.warning("agent channel %s dropped: %s", self.ws_url, exc)
+            self._ws = None
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, _BACKOFF_MAX)
+
+    def _dispatch(self, msg: dict) -> None:
+        if "event" in msg:
+            self.state[msg["event"]] = msg.get("data")
+            self.last_event_at = time.time()
+            for cb in self._listeners:
+                try:
+                    cb(msg["event"], msg.get("data") or {})
+                except Exception:
+                    log.exception("agent channel listener failed")
+            return
+        fut = self._pending.get(str(msg.get("id")))
+        if fut is not None and not fut.done():
+            fut.set_result(msg)
+
+
+# -----------------------------
+# Registry (one channel per agent URL per worker)
+# -----------------------------
+
+_channels: Dict[str, AgentChannel] = {}
+
+
+def get_channel(agent_url: str) -> Optional[AgentChannel]:
+    return _channels.get(agent_url)
+
+
+def start_channel(agent_url: str, secret: str) -> Optional[AgentChannel]:
+    if not AGENT_CHANNEL:
+        return None
+    try:
+        import websockets  # noqa: F401
+    except ImportError:
+        log.warning("AGENT_CHANNEL=true but 'websockets' is not installed; using REST only")
+        return None
+    channel = _channels.get(agent_url)
+    if channel is None:
+        channel = _channels[agent_url] = AgentChannel(agent_url, secret)
+        channel.start()
+    return channel
+
+
+async def stop_channels() -> None:
+    for channel in list(_channels.values()):
+        await channel.stop()
+    _channels.clear()
+
+
+def channel_states() -> List[Dict[str, Any]]:
+    return [
+        {
+            "agent_url": c.agent_url,
+            "connected": c.connected,
+            "last_event_at": c.last_event_at,
+            "health": c.state.get("health"),
+        }
+        for c in _channels.values()
+    ]
@@ -0,0 +1,212 @@
+"""Small async client for the WireGuard agent.
+
+Route handlers go through these helpers instead of building httpx requests
+inline, so the agent URL, shared secret and error handling live in one place.
+Peer operations use the persistent channel (see agent_channel.py) when it is
+up and fall back to the REST endpoints otherwise.
+"""
+import logging
+import os
+from typing import Optional, Dict, Any, List
+
+from app.utils import metrics, tracing
+from app.utils.agent_channel import get_channel, ChannelTimeout, ChannelUnavailable
+from app.utils.agent_health import HALF_OPEN, get_breaker
+
+log = logging.getLogger(__name__)
+
+AGENT_URL = os.getenv("AGENT_URL", "http://localhost:8001")
+AGENT_SHARED_SECRET = os.getenv("AGENT_SHARED_SECRET")
+AGENT_TIMEOUT = float(os.getenv("AGENT_TIMEOUT", "3"))  # seconds, per REST call
+
+
+class AgentError(RuntimeError):
+    """The agent could not be reached or rejected the request."""
+
+
+class AgentUnavailable(AgentError):
+    """The agent's circuit breaker is open; the call was not attempted."""
+
+    def __init__(self, agent_url: str, retry_after: int):
+        super().__init__(f"VPN agent unavailable ({agent_url}); retry in {retry_after}s")
+        self.agent_url = agent_url
+        self.retry_after = retry_after
+
+
+def ensure_available(agent_url: Optional[str] = None) -> None:
+    """Raise AgentUnavailable right away if the agent's breaker is open.
+
+    Handlers call this before doing any DB work for an operation that needs
+    the agent, so an outage costs a dict lookup instead of a timeout.
+    """
+    url = agent_url or AGENT_URL
+    breaker = get_breaker(url)
+    if breaker.state == "open":
+        metrics.inc("agent_requests_rejected_total", agent=url)
+        raise AgentUnavailable(url, breaker.retry_after())
+
+
+async def _request(
+    method: str,
+    path: str,
+    payload: Optional[dict],
+    agent_url: Optional[str] = None,
+    timeout: float = AGENT_TIMEOUT,
+) -> Dict[str, Any]:
+    import httpx  # deferred: only needed once a request actually goes out
+
+    url = f"{agent_url or AGENT_URL}{path}"
+    try:
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            response = await client.request(
+                method,
+                url,
+                json=payload,
+                headers={"X-Agent-Secret": AGENT_SHARED_SECRET or "", **tracing.propagation()},
+            )
+    except httpx.RequestError as exc:
+        raise AgentError(f"Failed to reach agent: {exc}") from exc
+
+    if response.status_code != 200:
+        raise AgentError(f"Agent error: {response.status_code} - {response.text}")
+    return response.json()
+
+
+async def _call(
+    op: str,
+    path: str,
+    payload: dict,
+    agent_url: Optional[str] = None,
+    method: str = "POST",
+) -> Dict[str, Any]:
+    """Run an agent op over the channel if one is live, otherwise via REST.
+
+    Every call goes through the agent's circuit breaker: it is rejected
+    immediately while open, and its outcome feeds the breaker otherwise.
+    Requests the agent answered with an error don't count as failures.
+    """
+    url = agent_url or AGENT_URL
+    breaker = get_breaker(url)
+    probe = breaker.state == HALF_OPEN
+    if not breaker.allow():
+        metrics.inc("agent_requests_rejected_total", agent=url)
+        raise AgentUnavailable(url, breaker.retry_after())
+
+    try:
+        channel = get_channel(url)
+        if channel is not None and channel.connected:
+            try:
+                with tracing.span("agent.channel", op=op, agent_url=url):
+                    result = await channel.request(op, payload, trace=tracing.context())
+                breaker.record_success()
+                return result
+            except ChannelUnavailable as exc:
+                log.info("channel unavailable for %s, falling back to REST: %s", op, exc)
+            except ChannelTimeout as exc:
+                # Sent but unacked: a REST retry could run the op a second time
+                raise AgentError(f"{exc}; not retried over REST") from exc
+            except RuntimeError as exc:
+                raise AgentError(str(exc)) from exc
+        with tracing.span("agent.http", op=op, agent_url=url):
+            result = await _request(method, path, payload if method == "POST" else None, url)
+    except AgentError as exc:
+        import httpx
+
+        if isinstance(exc.__cause__, (httpx.RequestError, ChannelTimeout)):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+    finally:
+        if probe:
+            breaker.release_probe()  # a cancelled probe records nothing; free the slot
+    breaker.record_success()
+    return result
+
+
+async def add_peer(
+    public_key: str,
+    allowed_ips: str,
+    persistent_keepalive: Optional[int] = 25,
+    agent_url: Optional[str] = None,
+) -> Dict[str, Any]:
+    payload = {
+        "public_key": public_key,
+        "allowed_ips": allowed_ips,
+        "persistent_keepalive": persistent_keepalive,
+    }
+    return await _call("add_peer", "/agent/wg/add-peer", payload, agent_url)
+
+
+async def remove_peer(public_key: str, agent_url: Optional[str] = None) -> Dict[str, Any]:
+    return await _call("remove_peer", "/agent/wg/remove-peer", {"public_key": public_key}, agent_url)
+
+
+async def list_peers(agent_url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """All peers on the node with transfer counters (rx_bytes/tx_bytes)."""
+    result = await _call("list_peers", "/agent/wg/peers", {}, agent_url, method="GET")
+    return result.get("peers", [])
+
+
+async def node_stats(agent_url: Optional[str] = None) -> Dict[str, Any]:
+    """Peer counts and rx/tx byte totals for the node, plus the agent's clock ("at")."""
+    return await _call("node_stats", "/agent/wg/stats", {}, agent_url, method="GET")
+
+
+async def peer_digest(prefixes: List[str], agent_url: Optional[str] = None) -> Dict[str, Optional[str]]:
+    """Digest node hashes for the given bucket prefixes; None means empty."""
+    result = await _call("peer_digest", "/agent/wg/digest", {"prefixes": prefixes}, agent_url)
+    return result.get("buckets", {})
+
+
+async def bucket_peers(prefixes: List[str], agent_url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Live peers in the given digest buckets."""
+    result = await _call("bucket_peers", "/agent/wg/bucket-peers", {"prefixes": prefixes}, agent_url)
+    return result.get("peers", [])
+
+
+async def trace_spans(trace_id: str, agent_url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """The agent's spans for a trace (debug only, REST, bypasses the breaker)."""
+    result = await _request("GET", f"/agent/debug/traces/{trace_id}", None, agent_url)
+    return result.get("spans", [])
+
+
+async def profile(
+    seconds: float, rate: int, idle: bool = False, tasks: bool = False, agent_url: Optional[str] = None
+) -> Dict[str, Any]:
+    """Run the agent's sampling profiler (debug only, REST, bypasses the breaker)."""
+    path = (
+        f"/agent/debug/profile?seconds={seconds}&rate={rate}"
+        f"&idle={str(idle).lower()}&tasks={str(tasks).lower()}"
+    )
+    return await _request("GET", path, None, agent_url, timeout=seconds + AGENT_TIMEOUT)
+
+
+async def configure(
+    listen_port: Optional[int] = None,
+    interface: Optional[str] = None,
+    agent_url: Optional[str] = None,
+) -> Dict[str, Any]:
+    payload = {"listen_port": listen_port, "interface": interface}
+    return await _call("configure", "/agent/wg/configure", payload, agent_url)
+
+
+async def rotate_key(agent_url: Optional[str] = None) -> Dict[str, Any]:
+    """Have the node generate and apply a new server keypair; returns its public key."""
+    return await _call("rotate_key", "/agent/wg/rotate-key", {}, agent_url)
+
+
+async def assign_shard(public_key: str, agent_url: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Ask the agent which interface shard a new peer should use.
+
+    Returns {"interface", "listen_port", "subnet", "endpoint"} or None when the
+    agent is unavailable; callers then fall back to the server's defaults.
+    """
+    try:
+        return await _call("assign_shard", "/agent/wg/assign-shard", {"public_key": public_key}, agent_url)
+    except AgentError as exc:
+        log.warning("shard assignment unavailable: %s", exc)
+        return None
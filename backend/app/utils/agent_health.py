@@ -0,0 +1,174 @@
+"""Agent health monitoring and per-agent circuit breakers.
+
+A background task polls every known agent's `/agent/health` and keeps an
+in-memory health table. Each agent also has a circuit breaker fed by both
+the poller and real agent calls:
+
+  closed    -> calls go through; N consecutive failures open it
+  open      -> calls fail immediately (503) until `reset_timeout` elapses
+  half_open -> one probe is let through; success closes, failure re-opens
+
+So when an agent is down, user requests fail in microseconds instead of each
+one waiting for an HTTP timeout.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, Dict, Any, Optional, Set
+
+from sqlalchemy import or_, select
+
+from app.models import vpn_servers
+from app.utils import metrics
+
+if TYPE_CHECKING:
+    import httpx
+
+log = logging.getLogger(__name__)
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("AGENT_BREAKER_FAILURES", "3"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("AGENT_BREAKER_RESET_SECONDS", "15"))
+HEALTH_INTERVAL = float(os.getenv("AGENT_HEALTH_INTERVAL", "5"))
+HEALTH_TIMEOUT = float(os.getenv("AGENT_HEALTH_TIMEOUT", "2"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        if self.opened_at is None:
+            return 0
+        return max(1, int(self.reset_timeout - (time.monotonic() - self.opened_at) + 0.999))
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release_probe(self) -> None:
+        """End a half-open probe that finished without an outcome (cancelled),
+        so the next call can probe instead of being rejected forever."""
+        self._probing = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+# agent_url -> {"ok", "checked_at", "latency_ms", "error", "health"}
+health_table: Dict[str, Dict[str, Any]] = {}
+
+
+def get_breaker(agent_url: str) -> CircuitBreaker:
+    breaker = _breakers.get(agent_url)
+    if breaker is None:
+        breaker = _breakers[agent_url] = CircuitBreaker()
+    return breaker
+
+
+def breaker_state(agent_url: str) -> str:
+    breaker = _breakers.get(agent_url)
+    return breaker.state if breaker else CLOSED
+
+
+def _collect() -> None:
+    for url, breaker in _breakers.items():
+        metrics.set_gauge("agent_circuit_state", _STATE_VALUE[breaker.state], agent=url)
+        metrics.set_gauge("agent_consecutive_failures", breaker.failures, agent=url)
+    for url, row in health_table.items():
+        metrics.set_gauge("agent_up", 1 if row.get("ok") else 0, agent=url)
+
+
+metrics.register_collector(_collect)
+
+
+# -----------------------------
+# Poller
+# -----------------------------
+
+async def check_agent(client: "httpx.AsyncClient", agent_url: str) -> None:
+    breaker = get_breaker(agent_url)
+    probe = breaker.state == HALF_OPEN
+    if not breaker.allow():
+        return  # open: wait for reset_timeout, then probe once while half-open
+    started = time.perf_counter()
+    row: Dict[str, Any] = {"checked_at": time.time()}
+    try:
+        response = await client.get(f"{agent_url}/agent/health", timeout=HEALTH_TIMEOUT)
+        response.raise_for_status()
+        row.update(ok=True, health=response.json(), error=None)
+        breaker.record_success()
+    except Exception as exc:
+        row.update(ok=False, error=str(exc) or exc.__class__.__name__)
+        breaker.record_failure()
+    finally:
+        if probe:
+            breaker.release_probe()
+    row["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    health_table[agent_url] = {**health_table.get(agent_url, {}), **row}
+
+
+def servers_on_agent(agent_url: str):
+    """WHERE clause for the vpn_servers rows an agent backs; rows without an
+    agent_url use AGENT_URL (imported lazily: agent_client imports this module)."""
+    from app.utils.agent_client import AGENT_URL
+
+    if agent_url == AGENT_URL:
+        return or_(vpn_servers.c.agent_url.is_(None), vpn_servers.c.agent_url == agent_url)
+    return vpn_servers.c.agent_url == agent_url
+
+
+async def known_agents(database, default_url: str) -> Set[str]:
+    urls = {default_url}
+    rows = await database.fetch_all(
+        select(vpn_servers.c.agent_url)
+        .where(vpn_servers.c.is_active == True)  # noqa: E712
+        .where(vpn_servers.c.agent_url.is_not(None))
+        .distinct()
+    )
+    urls.update(r[0] for r in rows)
+    return urls
+
+
+async def poll_forever(database, default_url: str, interval: float = HEALTH_INTERVAL) -> None:
+    import httpx
+
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                urls = await known_agents(database, default_url)
+                await asyncio.gather(*(check_agent(client, u) for u in urls))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("agent health poll failed")
+            await asyncio.sleep(interval)
@@ -0,0 +1,70 @@
+"""Moves old closed sessions from `connections` to `connections_archive`.
+
+The hot table only has to hold open sessions and recent history, which keeps
+its indexes small enough to stay in memory. Rows are moved in bounded
+batches (INSERT ... SELECT + DELETE by primary key, one short transaction
+each) with a pause in between, so no long locks are held.
+
+Only rows the usage rollup job has already folded in (rolled_up = 1) are
+moved, so rollups never miss an archived session.
+"""
+import asyncio
+import datetime
+import logging
+import os
+
+from sqlalchemy import select
+
+from app.models import connections, connections_archive
+from app.utils import metrics
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_BATCH_PAUSE = float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.5"))  # seconds between batches
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))  # seconds between runs
+
+_COLUMNS = ("id", "user_id", "server_id", "connected_at", "disconnected_at", "updated_at")
+
+
+def archive_horizon() -> datetime.datetime:
+    return datetime.datetime.utcnow() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+
+
+async def archive_batch(database, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Move one batch; returns how many rows were moved."""
+    rows = await database.fetch_all(
+        select(connections.c.id)
+        .where(connections.c.disconnected_at.is_not(None))
+        .where(connections.c.disconnected_at < archive_horizon())
+        .where(connections.c.rolled_up == True)  # noqa: E712
+        .order_by(connections.c.id)
+        .limit(batch_size)
+    )
+    ids = [r["id"] for r in rows]
+    if not ids:
+        return 0
+
+    async with database.transaction():
+        await database.execute(
+            connections_archive.insert()
+            .prefix_with("IGNORE")
+            .from_select(
+                list(_COLUMNS),
+                select(*(connections.c[c] for c in _COLUMNS)).where(connections.c.id.in_(ids)),
+            )
+        )
+        await database.execute(connections.delete().where(connections.c.id.in_(ids)))
+    metrics.inc("connections_archived_total", len(ids))
+    return len(ids)
+
+
+async def run_once(database) -> int:
+    total = 0
+    while True:
+        n = await archive_batch(database)
+        total += n
+        if n < ARCHIVE_BATCH_SIZE:
+            return total
+        await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
@@ -0,0 +1,180 @@
+"""Opt-in capture of request shapes and timing, for replay (scripts/replay.py).
+
+Enabled by setting CAPTURE_FILE. Each sampled request appends one compact
+JSON line:
+
+  t  arrival time (epoch seconds)     m  method
+  r  route template                   p  path parameters
+  q  query parameters                 b  body shape
+  a  actor: keyed hash of the user    s  status
+  d  duration in ms                   n  response size in bytes
+
+Nothing secret is written. Body fields are recorded as their type and
+length ("str:12"); only the ids and knobs listed in KEEP_VALUES keep their
+value, because replay needs them to hit the same servers the same way.
+Query parameters follow the same rule. The actor is an HMAC of the username
+(from the login/register body or the bearer token's subject) with
+CAPTURE_SALT, so replay can group requests per user without learning who
+they were. Tokens, passwords, codes and keys never reach the file.
+
+CAPTURE_MAX_MB caps the file; capture stops once it is reached. Lines are
+buffered in memory and appended by a writer thread every
+CAPTURE_FLUSH_SECONDS, so no request waits on file I/O; close() writes what
+is left at shutdown.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from fastapi import Request
+
+log = logging.getLogger(__name__)
+
+CAPTURE_FILE = os.getenv("CAPTURE_FILE")  # unset = capture off
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "1.0"))
+CAPTURE_MAX_MB = float(os.getenv("CAPTURE_MAX_MB", "512"))
+CAPTURE_FLUSH_SECONDS = float(os.getenv("CAPTURE_FLUSH_SECONDS", "1"))
+CAPTURE_SALT = os.getenv("CAPTURE_SALT") or os.urandom(16).hex()  # set it to keep actors stable across restarts
+
+_SKIP_PATHS = {"/metrics", "/health", "/health/ready"}
+KEEP_VALUES = {
+    "server_id", "server_ids", "user_id", "listen_port", "canary", "concurrency", "timeout",
+    "only_active", "active", "country", "min_capacity", "limit", "fields", "repair",
+    "days", "format", "qr", "include_agent",
+}
+_lock = threading.Lock()        # guards _state and _pending
+_file_lock = threading.Lock()   # keeps batches in order between the writer thread and close()
+_stop = threading.Event()
+_pending: List[str] = []
+_state: Dict[str, Any] = {"written_bytes": 0, "stopped": False, "writer": None}
+
+
+def actor(username: str) -> str:
+    return hmac.new(CAPTURE_SALT.encode(), username.encode("utf-8"), hashlib.sha256).hexdigest()[:12]
+
+
+def _token_subject(auth_header: str) -> Optional[str]:
+    """The `sub` claim of a bearer JWT, read without verifying it."""
+    if not auth_header.lower().startswith("bearer "):
+        return None
+    parts = auth_header[7:].split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+    except ValueError:
+        return None
+    sub = payload.get("sub") if isinstance(payload, dict) else None
+    return sub if isinstance(sub, str) else None
+
+
+def _shape(value: Any) -> Any:
+    if isinstance(value, bool) or value is None:
+        return type(value).__name__
+    if isinstance(value, (int, float)):
+        return type(value).__name__
+    if isinstance(value, str):
+        return f"str:{len(value)}"
+    if isinstance(value, list):
+        return f"list:{len(value)}"
+    if isinstance(value, dict):
+        return {k: _shape(v) for k, v in value.items()}
+    return type(value).__name__
+
+
+def sanitize(fields: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: (v if k in KEEP_VALUES else _shape(v)) for k, v in fields.items()}
+
+
+def _write(record: Dict[str, Any]) -> None:
+    line = json.dumps(record, separators=(",", ":")) + "\n"
+    with _lock:
+        if _state["stopped"]:
+            return
+        if _state["written_bytes"] + len(line) > CAPTURE_MAX_MB * 1024 * 1024:
+            _state["stopped"] = True
+            log.warning("capture file %s reached CAPTURE_MAX_MB; capture stopped", CAPTURE_FILE)
+            return
+        _state["written_bytes"] += len(line)
+        _pending.append(line)
+        if _state["writer"] is None and not _stop.is_set():
+            _state["writer"] = threading.Thread(target=_writer_loop, name="capture-writer", daemon=True)
+            _state["writer"].start()
+
+
+def flush() -> None:
+    """Append the buffered lines to CAPTURE_FILE in one write."""
+    with _file_lock:
+        with _lock:
+            lines = _pending[:]
+            _pending.clear()
+        if not lines:
+            return
+        try:
+            with open(CAPTURE_FILE, "a", encoding="utf-8") as fh:
+                fh.writelines(lines)
+        except OSError:
+            log.exception("could not write %d capture lines to %s", len(lines), CAPTURE_FILE)
+
+
+def _writer_loop() -> None:
+    while not _stop.wait(CAPTURE_FLUSH_SECONDS):
+        flush()
+
+
+def close() -> None:
+    """Stop the writer thread and write what is still buffered."""
+    _stop.set()
+    writer = _state["writer"]
+    if writer is not None:
+        writer.join(timeout=5)
+    flush()
+
+
+async def capture_middleware(request: Request, call_next):
+    path = request.url.path
+    if path in _SKIP_PATHS or _state["stopped"] or random.random() >= CAPTURE_SAMPLE_RATE:
+        return await call_next(request)
+
+    body_fields: Optional[Dict[str, Any]] = None
+    if request.method in ("POST", "PUT", "PATCH") and request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            parsed = json.loads(await request.body() or b"null")
+            body_fields = parsed if isinstance(parsed, dict) else None
+        except ValueError:
+            body_fields = None
+
+    username = _token_subject(request.headers.get("authorization", ""))
+    if username is None and body_fields and isinstance(body_fields.get("username"), str):
+        username = body_fields["username"]
+
+    arrived = time.time()
+    started = time.perf_counter()
+    status, size = 500, None
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        size = response.headers.get("content-length")
+        return response
+    finally:
+        route = request.scope.get("route")
+        record = {
+            "t": round(arrived, 4),
+            "m": request.method,
+            "r": getattr(route, "path", path),
+            "p": request.path_params or None,
+            "q": sanitize(dict(request.query_params)) or None,
+            "b": sanitize(body_fields) if body_fields else None,
+            "a": actor(username) if username else None,
+            "s": status,
+            "d": round((time.perf_counter() - started) * 1000, 2),
+            "n": int(size) if size is not None else None,
+        }
+        _write({k: v for k, v in record.items() if v is not None})
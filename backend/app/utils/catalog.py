@@ -0,0 +1,105 @@
+"""Filtering, paging and serialization for the server catalog.
+
+GET /servers works on the cached server list (see invalidation.py), so a
+filtered page costs no DB round trip: rows are filtered in memory, paged by
+id with an opaque cursor, trimmed to the requested fields and written
+straight to JSON bytes. orjson is used when installed; the stdlib encoder is
+the fallback. Either way the per-row pydantic validation of response_model
+is skipped, which is most of the cost for thousands of rows.
+"""
+import base64
+import bisect
+import json
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+# Public fields of a catalog entry, in output order (VPNServerOut)
+SERVER_FIELDS = ("id", "name", "country", "ip_address", "is_active", "capacity", "agent_state")
+MAX_PAGE_SIZE = 1000
+
+
+class InvalidCatalogQuery(ValueError):
+    """Bad cursor or unknown field name (400)."""
+
+
+def parse_fields(fields: Optional[str]) -> Tuple[str, ...]:
+    if not fields:
+        return SERVER_FIELDS
+    wanted = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in wanted if f not in SERVER_FIELDS]
+    if unknown:
+        raise InvalidCatalogQuery(f"Unknown field(s): {', '.join(unknown)}")
+    # id always comes along so clients can page and refer back
+    return wanted if "id" in wanted else ("id",) + wanted
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCatalogQuery("Invalid cursor") from None
+
+
+def filter_servers(
+    rows: Iterable[Dict[str, Any]],
+    countries: Optional[Sequence[str]] = None,
+    is_active: Optional[bool] = None,
+    min_capacity: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Rows matching every given filter. NULL capacity means unlimited."""
+    wanted = {c.strip().lower() for c in countries if c.strip()} if countries else None
+    out = []
+    for r in rows:
+        if wanted is not None and (r["country"] or "").lower() not in wanted:
+            continue
+        if is_active is not None and bool(r["is_active"]) != is_active:
+            continue
+        if min_capacity is not None and r["capacity"] is not None and r["capacity"] < min_capacity:
+            continue
+        out.append(r)
+    return out
+
+
+def page(rows: List[Dict[str, Any]], cursor: Optional[str], limit: Optional[int]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Rows (sorted by id) after `cursor`, at most `limit`; plus the next cursor."""
+    start = 0
+    if cursor:
+        start = bisect.bisect_right([r["id"] for r in rows], decode_cursor(cursor))
+    if limit is None:
+        return rows[start:], None
+    chunk = rows[start:start + limit]
+    more = start + limit < len(rows)
+    return chunk, encode_cursor(chunk[-1]["id"]) if more and chunk else None
+
+
+def project(
+    rows: Iterable[Dict[str, Any]],
+    fields: Sequence[str],
+    agent_state: Optional[Callable[[Dict[str, Any]], Optional[str]]] = None,
+) -> List[Dict[str, Any]]:
+    """Keep only `fields`; agent_state is computed per row only when asked for."""
+    plain = [f for f in fields if f != "agent_state"]
+    with_state = "agent_state" in fields and agent_state is not None
+    out = []
+    for r in rows:
+        item = {f: r[f] for f in plain}
+        if "is_active" in item:
+            item["is_active"] = bool(item["is_active"])  # MySQL hands back 0/1
+        if with_state:
+            item["agent_state"] = agent_state(r)
+        out.append(item)
+    return out
+
+
+def dumps(items: List[Dict[str, Any]]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(items)
+    return json.dumps(items, separators=(",", ":"), default=str).encode("utf-8")
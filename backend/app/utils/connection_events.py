@@ -0,0 +1,114 @@
+"""Connection state events for the live status stream.
+
+Handlers publish connect / peer_applied / disconnect events, and a
+background sampler pushes transfer counters for users that currently have a
+stream open. Users without an open stream cost nothing: the sampler only
+looks at subscribed topics.
+
+The broker is per worker, and a user's stream may be served by any worker
+on any host, so state events are relayed through the invalidation log
+(invalidation.relay): every worker's poller, the publisher's included, puts
+them on the user's topic on its own broker, within
+INVALIDATION_POLL_INTERVAL. Transfer samples stay local, since every worker
+samples for its own subscribers.
+"""
+import datetime
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+from sqlalchemy import select, and_
+
+from app.models import connections, vpn_servers, wg_allocations
+from app.utils import agent_client, invalidation
+from app.utils.pubsub import broker
+from app.utils.wireguard import bytes_to_key
+
+log = logging.getLogger(__name__)
+
+TRANSFER_PUSH_INTERVAL = float(os.getenv("TRANSFER_PUSH_INTERVAL", "10"))  # seconds
+
+
+def user_topic(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+STREAM_NAMESPACE = "stream"
+
+
+def _event(event_type: str, data: dict) -> dict:
+    return {"type": event_type, "at": datetime.datetime.utcnow().isoformat(), **data}
+
+
+async def publish(database, user_id: int, event_type: str, **data) -> None:
+    """Send an event to the user's streams on every worker.
+
+    Best effort: a failed relay is logged, not raised, so it can't fail the
+    request that already made the change.
+    """
+    try:
+        await invalidation.relay(database, STREAM_NAMESPACE, user_id, json.dumps(_event(event_type, data), default=str))
+    except Exception:
+        log.exception("could not relay %s event for user %s", event_type, user_id)
+
+
+def _deliver(key: Optional[str], payload: Optional[str]) -> None:
+    if key is not None and payload is not None:
+        broker.publish(user_topic(int(key)), json.loads(payload))
+
+
+invalidation.on_event(STREAM_NAMESPACE, _deliver)
+
+
+async def sample_transfers(database) -> None:
+    """Push rx/tx counters to every user with an open stream and an active session."""
+    user_ids = [int(t.split(":", 1)[1]) for t in broker.topics("user:")]
+    if not user_ids:
+        return
+
+    j = connections.join(vpn_servers, connections.c.server_id == vpn_servers.c.id).join(
+        wg_allocations,
+        and_(
+            wg_allocations.c.user_id == connections.c.user_id,
+            wg_allocations.c.server_id == connections.c.server_id,
+            wg_allocations.c.revoked_at.is_(None),
+        ),
+    )
+    rows = await database.fetch_all(
+        select(
+            connections.c.user_id,
+            connections.c.server_id,
+            vpn_servers.c.agent_url,
+            wg_allocations.c.client_key,
+        )
+        .select_from(j)
+        .where(connections.c.user_id.in_(user_ids))
+        .where(connections.c.disconnected_at.is_(None))
+    )
+
+    # agent_url -> {public_key: (user_id, server_id)}
+    by_agent: Dict[str, Dict[str, tuple]] = {}
+    for r in rows:
+        url = r["agent_url"] or agent_client.AGENT_URL
+        by_agent.setdefault(url, {})[bytes_to_key(r["client_key"])] = (r["user_id"], r["server_id"])
+
+    for url, keys in by_agent.items():
+        try:
+            peers = await agent_client.list_peers(url)
+        except agent_client.AgentError as exc:
+            log.debug("transfer sample skipped for %s: %s", url, exc)
+            continue
+        for peer in peers:
+            owner = keys.get(peer["public_key"])
+            if owner is None:
+                continue
+            broker.publish(user_topic(owner[0]), _event(
+                "transfer",
+                {
+                    "server_id": owner[1],
+                    "rx_bytes": peer.get("rx_bytes", 0),
+                    "tx_bytes": peer.get("tx_bytes", 0),
+                    "latest_handshake": peer.get("latest_handshake"),
+                },
+            ))
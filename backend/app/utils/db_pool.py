@@ -0,0 +1,123 @@
+"""Bounded connection pool for the async database.
+
+`databases` hands out pooled aiomysql connections, and a caller that finds
+the pool empty waits for one with no limit. Under overload that turns into
+an ever-growing queue and client timeouts. BoundedDatabase waits at most
+DB_POOL_TIMEOUT seconds for a connection and then raises PoolTimeout,
+which the app turns into 503 + Retry-After so clients back off.
+"""
+import asyncio
+import math
+import time
+from typing import Dict
+
+from databases import Database
+from databases.backends.mysql import MySQLBackend, MySQLConnection
+
+from app.utils import metrics, query_count, tracing
+
+
+class PoolTimeout(Exception):
+    def __init__(self, waited: float, retry_after: int = 1):
+        self.waited = waited
+        self.retry_after = retry_after
+        super().__init__(f"Database busy: no connection available after {waited:.1f}s")
+
+
+class _BoundedConnection(MySQLConnection):
+    async def acquire(self) -> None:
+        backend: "BoundedMySQLBackend" = self._database
+        assert self._connection is None, "Connection is already acquired"
+        assert backend._pool is not None, "DatabaseBackend is not running"
+
+        started = time.perf_counter()
+        backend.waiting += 1
+        try:
+            with tracing.span("db.acquire", waiting=backend.waiting):
+                self._connection = await asyncio.wait_for(backend._pool.acquire(), backend.acquire_timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("db_pool_timeouts_total")
+            raise PoolTimeout(backend.acquire_timeout, backend.retry_after) from None
+        finally:
+            backend.waiting -= 1
+            metrics.inc("db_pool_wait_seconds_total", time.perf_counter() - started)
+        metrics.inc("db_pool_acquired_total")
+
+    # Statement round trips, counted per request (see query_count.py) and
+    # traced as db.* spans
+
+    async def fetch_all(self, query):
+        query_count.record()
+        with tracing.span("db.fetch_all", table=_table_name(query)):
+            return await super().fetch_all(query)
+
+    async def fetch_one(self, query):
+        query_count.record()
+        with tracing.span("db.fetch_one", table=_table_name(query)):
+            return await super().fetch_one(query)
+
+    async def execute(self, query):
+        query_count.record()
+        with tracing.span("db.execute", table=_table_name(query)):
+            return await super().execute(query)
+
+    async def execute_many(self, queries):
+        query_count.record(len(queries))
+        with tracing.span("db.execute_many", statements=len(queries)):
+            return await super().execute_many(queries)
+
+    async def iterate(self, query):
+        query_count.record()
+        with tracing.span("db.iterate", table=_table_name(query)):
+            async for record in super().iterate(query):
+                yield record
+
+
+def _table_name(query) -> str:
+    """Main table of a statement, for span labels."""
+    table = getattr(query, "table", None)
+    if table is None:
+        froms = getattr(query, "get_final_froms", lambda: [])()
+        table = froms[0] if froms else None
+    return str(getattr(table, "name", None) or getattr(table, "description", None) or "")
+
+
+class BoundedMySQLBackend(MySQLBackend):
+    def __init__(self, database_url, acquire_timeout: float = 5.0, **options):
+        super().__init__(database_url, **options)
+        self.acquire_timeout = acquire_timeout
+        self.retry_after = max(1, math.ceil(acquire_timeout))
+        self.waiting = 0
+
+    def connection(self) -> MySQLConnection:
+        return _BoundedConnection(self, self._dialect)
+
+    def stats(self) -> Dict[str, int]:
+        pool = self._pool
+        if pool is None:
+            return {"size": 0, "max_size": 0, "in_use": 0, "free": 0, "waiting": self.waiting}
+        return {
+            "size": pool.size,
+            "max_size": pool.maxsize,
+            "in_use": pool.size - pool.freesize,
+            "free": pool.freesize,
+            "waiting": self.waiting,
+        }
+
+
+class BoundedDatabase(Database):
+    SUPPORTED_BACKENDS = {
+        **Database.SUPPORTED_BACKENDS,
+        "mysql+aiomysql": "app.utils.db_pool:BoundedMySQLBackend",
+    }
+
+    def pool_stats(self) -> Dict[str, int]:
+        return self._backend.stats()
+
+
+def register_pool_metrics(database: BoundedDatabase) -> None:
+    def collect():
+        for name, value in database.pool_stats().items():
+            metrics.set_gauge(f"db_pool_{name}", value)
+
+    metrics.register_collector(collect)
@@ -0,0 +1,149 @@
+"""Drift detection between wg_allocations and the peers live on each node.
+
+Checks run per agent, not per server: several vpn_servers rows can point at
+one agent (every row without an agent_url uses AGENT_URL), and the agent
+reports all of its peers. The peers an agent should have are the
+non-revoked allocations of every server it backs. Instead of shipping full peer lists, both sides build the same
+bucketed digest tree (peer_digest.py) and the backend walks it top-down:
+
+  1. ask for the root hash; equal -> in sync, done (a few hundred bytes)
+  2. otherwise ask for the 16 children of every differing node, down to
+     the leaf buckets
+  3. fetch the live peers of the differing leaf buckets only and diff them
+     against the allocations in those buckets
+
+The result lists missing peers (allocated but not on the node), leaked
+peers (on the node but not allocated) and mismatched allowed IPs. `repair`
+re-adds the missing/mismatched ones and removes the leaked ones.
+"""
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from app.models import vpn_servers, wg_allocations
+from app.utils import agent_client, metrics
+from app.utils.agent_health import servers_on_agent
+from app.utils.peer_digest import DIGEST_DEPTH, bucket_of, build_tree, children
+from app.utils.wireguard import bytes_to_key, int_to_ip
+
+log = logging.getLogger(__name__)
+
+DRIFT_INTERVAL = float(os.getenv("DRIFT_INTERVAL", "900"))  # seconds between fleet checks
+DRIFT_AUTO_REPAIR = os.getenv("DRIFT_AUTO_REPAIR", "false").lower() == "true"
+
+
+def _resolve(agent_url: Optional[str]) -> str:
+    return agent_url or agent_client.AGENT_URL
+
+
+async def expected_peers(database, agent_url: str) -> Dict[str, str]:
+    """public_key -> allowed IPs for non-revoked allocations on every server the agent backs."""
+    rows = await database.fetch_all(
+        select(wg_allocations.c.client_key, wg_allocations.c.client_addr)
+        .select_from(wg_allocations.join(vpn_servers, vpn_servers.c.id == wg_allocations.c.server_id))
+        .where(servers_on_agent(agent_url))
+        .where(wg_allocations.c.revoked_at.is_(None))
+    )
+    return {bytes_to_key(r["client_key"]): f"{int_to_ip(r['client_addr'])}/32" for r in rows}
+
+
+async def check_agent(database, agent_url: Optional[str] = None) -> Dict[str, Any]:
+    """Diff one agent's live peers against the allocations of every server it backs."""
+    agent_url = _resolve(agent_url)
+    server_ids = [
+        r["id"] for r in await database.fetch_all(
+            select(vpn_servers.c.id).where(servers_on_agent(agent_url)).order_by(vpn_servers.c.id)
+        )
+    ]
+    expected = await expected_peers(database, agent_url)
+    local = await run_in_threadpool(build_tree, list(expected.items()))  # CPU-bound for big servers
+
+    # Walk down only into nodes whose hashes differ
+    level, round_trips = [""], 0
+    while True:
+        remote = await agent_client.peer_digest(level, agent_url)
+        round_trips += 1
+        differing = [p for p in level if remote.get(p) != local.get(p)]
+        if not differing or len(differing[0]) == DIGEST_DEPTH:
+            break
+        level = [c for p in differing for c in children(p)]
+
+    missing: List[Dict[str, str]] = []
+    leaked: List[str] = []
+    mismatched: List[Dict[str, str]] = []
+    if differing:
+        live = {
+            p["public_key"]: p["allowed_ips"]
+            for p in await agent_client.bucket_peers(differing, agent_url)
+        }
+        round_trips += 1
+        buckets = set(differing)
+        for public_key, ips in expected.items():
+            if bucket_of(public_key) not in buckets:
+                continue
+            if public_key not in live:
+                missing.append({"public_key": public_key, "allowed_ips": ips})
+            elif live[public_key] != ips:
+                mismatched.append({"public_key": public_key, "allowed_ips": ips, "live_allowed_ips": live[public_key]})
+        leaked = [pk for pk in live if pk not in expected]
+
+    metrics.set_gauge("drift_missing_peers", len(missing), agent=agent_url)
+    metrics.set_gauge("drift_leaked_peers", len(leaked), agent=agent_url)
+    metrics.set_gauge("drift_mismatched_peers", len(mismatched), agent=agent_url)
+    return {
+        "agent_url": agent_url,
+        "server_ids": server_ids,
+        "in_sync": not (missing or leaked or mismatched),
+        "expected_peers": len(expected),
+        "round_trips": round_trips,
+        "differing_buckets": len(differing),
+        "missing": missing,
+        "leaked": leaked,
+        "mismatched": mismatched,
+    }
+
+
+async def repair(report: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a check_agent report: re-add missing/mismatched peers, remove leaked ones."""
+    agent_url = report["agent_url"]
+    added, removed, errors = 0, 0, []
+    for peer in report["missing"] + report["mismatched"]:
+        try:
+            await agent_client.add_peer(peer["public_key"], allowed_ips=peer["allowed_ips"], agent_url=agent_url)
+            added += 1
+        except agent_client.AgentError as exc:
+            errors.append({"public_key": peer["public_key"], "error": str(exc)})
+    for public_key in report["leaked"]:
+        try:
+            await agent_client.remove_peer(public_key, agent_url=agent_url)
+            removed += 1
+        except agent_client.AgentError as exc:
+            errors.append({"public_key": public_key, "error": str(exc)})
+    metrics.inc("drift_repaired_peers_total", added + removed)
+    return {"added": added, "removed": removed, "errors": errors}
+
+
+async def check_fleet(database, auto_repair: bool = DRIFT_AUTO_REPAIR) -> List[Dict[str, Any]]:
+    """Check every agent that backs an active server, once per agent."""
+    servers = await database.fetch_all(
+        select(vpn_servers.c.agent_url).where(vpn_servers.c.is_active == True)  # noqa: E712
+    )
+    reports = []
+    for agent_url in sorted({_resolve(s["agent_url"]) for s in servers}):
+        try:
+            report = await check_agent(database, agent_url)
+        except agent_client.AgentError as exc:
+            log.warning("drift check for agent %s skipped: %s", agent_url, exc)
+            continue
+        if not report["in_sync"]:
+            log.warning(
+                "agent %s drifted: %d missing, %d leaked, %d mismatched",
+                agent_url, len(report["missing"]), len(report["leaked"]), len(report["mismatched"]),
+            )
+            if auto_repair:
+                report["repair"] = await repair(report)
+        reports.append(report)
+    return reports
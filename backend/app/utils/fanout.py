@@ -0,0 +1,80 @@
+"""Concurrent fan-out of a command to many agents.
+
+Used for fleet-wide changes (listen port updates, server key rotation):
+
+  - rollout waves: the first `canary` nodes go first; if any of them fails,
+    the rest of the fleet is skipped instead of being broken too
+  - bounded parallelism inside each wave (`concurrency`)
+  - a per-node timeout, so one slow node never holds up the others
+  - one aggregated result with a row per node
+"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Any, List
+
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "32"))
+FANOUT_TIMEOUT = float(os.getenv("FANOUT_TIMEOUT", "10"))  # seconds per node
+FANOUT_CANARY = int(os.getenv("FANOUT_CANARY", "1"))
+
+NodeOp = Callable[[dict], Awaitable[Dict[str, Any]]]
+
+
+async def _run_node(target: dict, op: NodeOp, sem: asyncio.Semaphore, timeout: float, wave: str) -> Dict[str, Any]:
+    async with sem:
+        started = time.perf_counter()
+        row = {"server_id": target.get("server_id"), "agent_url": target.get("agent_url"), "wave": wave}
+        try:
+            result = await asyncio.wait_for(op(target), timeout)
+            row.update(status="ok", result=result)
+        except asyncio.TimeoutError:
+            row.update(status="timeout", detail=f"No response within {timeout}s")
+        except Exception as exc:
+            row.update(status="failed", detail=str(exc))
+        row["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return row
+
+
+async def fan_out(
+    targets: List[dict],
+    op: NodeOp,
+    concurrency: int = FANOUT_CONCURRENCY,
+    timeout: float = FANOUT_TIMEOUT,
+    canary: int = FANOUT_CANARY,
+) -> Dict[str, Any]:
+    """Run `op(target)` for every target; see the module docstring for rollout rules.
+
+    Each target is a dict with at least "server_id" and "agent_url".
+    """
+    started = time.perf_counter()
+    sem = asyncio.Semaphore(max(1, concurrency))
+    canaries, rest = targets[:canary], targets[canary:]
+
+    results = list(await asyncio.gather(*(_run_node(t, op, sem, timeout, "canary") for t in canaries)))
+    if all(r["status"] == "ok" for r in results):
+        results += await asyncio.gather(*(_run_node(t, op, sem, timeout, "main") for t in rest))
+    else:
+        results += [
+            {
+                "server_id": t.get("server_id"),
+                "agent_url": t.get("agent_url"),
+                "wave": "main",
+                "status": "skipped",
+                "detail": "Canary wave failed",
+            }
+            for t in rest
+        ]
+
+    counts = {"ok": 0, "failed": 0, "timeout": 0, "skipped": 0}
+    for r in results:
+        counts[r["status"]] += 1
+    return {
+        "ok": counts["ok"] == len(results),
+        "total": len(results),
+        "succeeded": counts["ok"],
+        "failed": counts["failed"],
+        "timeout": counts["timeout"],
+        "skipped": counts["skipped"],
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+        "results": results,
+    }
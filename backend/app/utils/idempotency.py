@@ -0,0 +1,116 @@
+"""Idempotency-Key support for expensive, retry-prone endpoints.
+
+Mobile clients retry config generation and connect on flaky networks. With
+an `Idempotency-Key` header, the first successful response is kept in a
+bounded TTL store and replayed for retries; a retry that arrives while the
+first request is still running waits for it instead of racing it. Failures
+are not stored, so a retry after an error does the work again.
+
+Keys are scoped per user and endpoint. Reusing a key with a different
+request body raises IdempotencyKeyReused (422). The store is per worker.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+
+from app.utils import metrics
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+
+
+class IdempotencyKeyReused(ValueError):
+    """The key was already used for a request with a different body."""
+
+
+def fingerprint(payload: Any) -> str:
+    raw = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        # key -> (expires_at, fingerprint, result); insertion order == expiry order
+        self._done: "OrderedDict[tuple, Tuple[float, str, Any]]" = OrderedDict()
+        self._inflight: Dict[tuple, Tuple[str, asyncio.Future]] = {}
+
+    def _purge(self, now: float) -> None:
+        while self._done:
+            key, (expires_at, _, _) = next(iter(self._done.items()))
+            if expires_at > now and len(self._done) <= self.max_keys:
+                break
+            self._done.popitem(last=False)
+
+    async def run(
+        self,
+        key: tuple,
+        request_fingerprint: str,
+        fn: Callable[[], Awaitable[Any]],
+    ) -> Tuple[Any, bool]:
+        """Return (result, replayed). `fn` runs at most once per live key."""
+        now = time.monotonic()
+        self._purge(now)
+
+        done = self._done.get(key)
+        if done is not None:
+            if done[1] != request_fingerprint:
+                raise IdempotencyKeyReused("Idempotency-Key was already used with a different request")
+            metrics.inc("idempotency_replays_total")
+            return done[2], True
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            if inflight[0] != request_fingerprint:
+                raise IdempotencyKeyReused("Idempotency-Key was already used with a different request")
+            metrics.inc("idempotency_waits_total")
+            try:
+                return await asyncio.shield(inflight[1]), True
+            except asyncio.CancelledError:
+                if not inflight[1].cancelled():
+                    raise  # this waiter itself was cancelled
+                # The original request was cancelled (client went away): take over
+                return await self.run(key, request_fingerprint, fn)
+
+        fut = asyncio.get_running_loop().create_future()
+        # Retrieve the exception ourselves so an error with no waiters isn't logged as unhandled
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = (request_fingerprint, fut)
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as exc:
+            fut.set_exception(exc)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        self._done[key] = (time.monotonic() + self.ttl, request_fingerprint, result)
+        self._purge(time.monotonic())
+        fut.set_result(result)
+        return result, False
+
+
+store = IdempotencyStore()
+
+
+async def idempotent(
+    idempotency_key: Optional[str],
+    scope: str,
+    user_id: int,
+    payload: Any,
+    fn: Callable[[], Awaitable[Any]],
+) -> Tuple[Any, bool]:
+    """Run `fn` under the given key, or just run it when no key was sent."""
+    if not idempotency_key:
+        return await fn(), False
+    return await store.run((scope, user_id, idempotency_key), fingerprint(payload), fn)
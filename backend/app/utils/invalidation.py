@@ -0,0 +1,229 @@
+"""Per-process caches that stay coherent across workers and hosts.
+
+Every uvicorn worker keeps its own TTLCache instances (the server catalog,
+validated users). A write that makes cached data stale calls `publish`,
+which drops the entry locally and appends an event to the
+cache_invalidations table - inside the writer's transaction when there is
+one, so the event exists exactly when the change does. Each worker polls
+that table for ids past the last one it applied (`poll_forever`) and drops
+the named entries, so all workers converge within about
+INVALIDATION_POLL_INTERVAL of the commit.
+
+Event ids are assigned at insert but become visible at commit, so they can
+show up out of order: id N+1 may commit while N's transaction is still
+open. A poller that sees N+1 first remembers N as a gap and keeps asking for
+it, alongside the ids past the highest one seen, for up to
+INVALIDATION_GAP_SECONDS, which should exceed the longest writer
+transaction. Gaps aren't kept forever because a rolled-back insert leaves a
+permanent hole.
+Workers also apply their own events when they come back from the poll,
+which clears anything refilled from a not-yet-committed read in between.
+If polling stops (DB trouble), entries still expire after their TTL, so
+staleness is bounded by CACHE_TTL in the worst case.
+
+The same log relays events that every worker must see, such as connection
+state for streams served by another worker: `relay` appends an event with a
+payload to a namespace that has a handler (`on_event`), and each worker's
+poller, the sender's included, hands it to that handler.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from sqlalchemy import func, or_, select, text
+
+from app.models import cache_invalidations
+from app.utils import metrics
+
+log = logging.getLogger(__name__)
+
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))  # fallback bound on staleness
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+INVALIDATION_POLL_INTERVAL = float(os.getenv("INVALIDATION_POLL_INTERVAL", "1"))
+INVALIDATION_RETENTION = int(os.getenv("INVALIDATION_RETENTION_SECONDS", "3600"))
+INVALIDATION_GAP_SECONDS = float(os.getenv("INVALIDATION_GAP_SECONDS", "10"))  # how long a skipped id may still commit
+_POLL_BATCH = 1000
+_MAX_GAPS = 1000
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, namespace: str, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (expires_at, value); insertion order == expiry order
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING or entry[0] <= time.monotonic():
+            if entry is not _MISSING:
+                del self._data[key]
+            metrics.inc("cache_misses_total", cache=self.namespace)
+            return default
+        metrics.inc("cache_hits_total", cache=self.namespace)
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data.pop(key, None)
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Drop one entry, or everything when `key` is None."""
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_caches: Dict[str, TTLCache] = {}
+# namespace -> handler(key, payload) for relayed events
+_handlers: Dict[str, Callable[[Optional[str], Optional[str]], None]] = {}
+# gaps: ids skipped over by last_id that may still commit -> give-up deadline
+_state: Dict[str, Any] = {"last_id": None, "last_poll": None, "applied": 0, "gaps": {}}
+
+
+def cache(namespace: str, ttl: float = CACHE_TTL) -> TTLCache:
+    """The worker's cache for `namespace`, created on first use."""
+    if namespace not in _caches:
+        _caches[namespace] = TTLCache(namespace, ttl)
+    return _caches[namespace]
+
+
+def on_event(namespace: str, handler: Callable[[Optional[str], Optional[str]], None]) -> None:
+    """Hand events relayed on `namespace` to `handler(key, payload)` in this worker."""
+    _handlers[namespace] = handler
+
+
+def _apply(namespace: str, key: Optional[str], payload: Optional[str] = None) -> None:
+    handler = _handlers.get(namespace)
+    if handler is not None:
+        try:
+            handler(key, payload)
+        except Exception:
+            log.exception("handler for %s events failed", namespace)
+        return
+    target = _caches.get(namespace)
+    if target is None:
+        return
+    if key is None:
+        target.invalidate()
+        return
+    # Keys travel as strings; cached keys may be ints (ids)
+    target.invalidate(key)
+    if key.lstrip("-").isdigit():
+        target.invalidate(int(key))
+
+
+async def publish(database, namespace: str, key: Optional[Hashable] = None) -> None:
+    """Invalidate `namespace` (or one key in it) in this worker and all others.
+
+    Call it inside the writer's transaction where there is one.
+    """
+    cache_key = None if key is None else str(key)
+    _apply(namespace, cache_key)
+    await database.execute(cache_invalidations.insert().values(namespace=namespace, cache_key=cache_key))
+    metrics.inc("cache_invalidations_published_total", cache=namespace)
+
+
+async def relay(database, namespace: str, key: Optional[Hashable], payload: Optional[str]) -> None:
+    """Deliver an event to the `namespace` handler of every worker, this one
+    included, within a poll interval."""
+    await database.execute(cache_invalidations.insert().values(
+        namespace=namespace, cache_key=None if key is None else str(key), payload=payload,
+    ))
+    metrics.inc("events_relayed_total", namespace=namespace)
+
+
+async def poll_once(database) -> int:
+    """Apply events past the last seen id, and any that filled a gap; returns how many were applied."""
+    if _state["last_id"] is None:
+        # New worker: its caches are empty, so history doesn't matter
+        _state["last_id"] = await database.fetch_val(select(func.coalesce(func.max(cache_invalidations.c.id), 0)))
+        _state["last_poll"] = time.monotonic()
+        return 0
+
+    now = time.monotonic()
+    gaps: Dict[int, float] = _state["gaps"]
+    for gap in [g for g, deadline in gaps.items() if deadline <= now]:
+        del gaps[gap]
+        metrics.inc("cache_invalidation_gaps_expired_total")
+
+    wanted = cache_invalidations.c.id > _state["last_id"]
+    if gaps:
+        wanted = or_(wanted, cache_invalidations.c.id.in_(list(gaps)))
+    rows = await database.fetch_all(
+        select(
+            cache_invalidations.c.id, cache_invalidations.c.namespace,
+            cache_invalidations.c.cache_key, cache_invalidations.c.payload,
+        )
+        .where(wanted)
+        .order_by(cache_invalidations.c.id)
+        .limit(_POLL_BATCH)
+    )
+    for row in rows:
+        _apply(row["namespace"], row["cache_key"], row["payload"])
+        event_id = row["id"]
+        if gaps.pop(event_id, None) is not None:
+            continue  # a late commit below last_id
+        for skipped in range(_state["last_id"] + 1, min(event_id, _state["last_id"] + 1 + _MAX_GAPS - len(gaps))):
+            gaps[skipped] = now + INVALIDATION_GAP_SECONDS
+        _state["last_id"] = event_id
+    _state["last_poll"] = now
+    _state["applied"] += len(rows)
+    if rows:
+        metrics.inc("cache_invalidations_applied_total", len(rows))
+    return len(rows)
+
+
+async def prune(database, retention: int = INVALIDATION_RETENTION) -> None:
+    """Delete events every worker has long applied (a scheduled leader job)."""
+    await database.execute(
+        cache_invalidations.delete().where(
+            cache_invalidations.c.created_at < func.date_sub(func.now(), text(f"INTERVAL {int(retention)} SECOND"))
+        )
+    )
+
+
+async def poll_forever(database, interval: float = INVALIDATION_POLL_INTERVAL) -> None:
+    while True:
+        try:
+            # Drain a backlog without sleeping between full batches
+            while await poll_once(database) == _POLL_BATCH:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("cache invalidation poll failed; entries fall back to their TTL")
+        await asyncio.sleep(interval)
+
+
+def invalidation_state() -> Dict[str, Any]:
+    last_poll = _state["last_poll"]
+    return {
+        "last_id": _state["last_id"],
+        "open_gaps": len(_state["gaps"]),
+        "applied": _state["applied"],
+        "seconds_since_poll": None if last_poll is None else round(time.monotonic() - last_poll, 3),
+        "caches": {name: len(c) for name, c in _caches.items()},
+    }
+
+
+def _collect() -> None:
+    for name, c in _caches.items():
+        metrics.set_gauge("cache_entries", len(c), cache=name)
+    if _state["last_poll"] is not None:
+        metrics.set_gauge("cache_invalidation_poll_age_seconds", time.monotonic() - _state["last_poll"])
+
+
+metrics.register_collector(_collect)
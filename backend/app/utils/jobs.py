@@ -0,0 +1,67 @@
+"""The backend's periodic jobs, registered on the scheduler at startup.
+
+Maintenance that must happen once per fleet (rollups, archiving, drift
+checks, pruning, node sampling) runs as leader jobs on one replica.
+Per-worker duties run as local jobs on every replica. Each interval can be
+replaced by a cron expression through the matching *_CRON variable, e.g.
+ARCHIVE_CRON="15 3 * * *" to archive at 03:15 UTC.
+
+Loops that keep this worker's own state in sync every second or so (cache
+invalidation polling, rate-limit sync, agent health probes) and the
+one-shot warmup stay as their own tasks; see main.py.
+"""
+import logging
+import os
+
+from app.utils import archiver, connection_events, drift, invalidation, rate_limit, rollups, scheduler, timeseries
+
+log = logging.getLogger(__name__)
+
+PRUNE_INTERVAL = float(os.getenv("PRUNE_INTERVAL", "3600"))
+
+
+def _jitter(interval: float) -> float:
+    return min(interval * 0.1, 60.0)
+
+
+def _trigger(interval: float, cron_env: str):
+    return scheduler.trigger(interval, os.getenv(cron_env), jitter=_jitter(interval))
+
+
+def register(sched: "scheduler.Scheduler", database) -> None:
+    async def usage_rollup():
+        n = await rollups.run_once(database)
+        if n:
+            log.info("usage rollup folded in %d sessions", n)
+
+    async def archive_connections():
+        n = await archiver.run_once(database)
+        if n:
+            log.info("archived %d closed sessions", n)
+
+    async def prune():
+        await invalidation.prune(database)
+        await rate_limit.prune(database)
+        await scheduler.prune_history(database)
+
+    sched.add("usage_rollup", usage_rollup, _trigger(rollups.ROLLUP_INTERVAL, "ROLLUP_CRON"), run_at_start=True)
+    sched.add("archive_connections", archive_connections, _trigger(archiver.ARCHIVE_INTERVAL, "ARCHIVE_CRON"), run_at_start=True)
+    sched.add("drift_check", lambda: drift.check_fleet(database), _trigger(drift.DRIFT_INTERVAL, "DRIFT_CRON"))
+    sched.add("prune", prune, _trigger(PRUNE_INTERVAL, "PRUNE_CRON"))
+    sched.add(
+        "sample_transfers",
+        lambda: connection_events.sample_transfers(database),
+        scheduler.Interval(connection_events.TRANSFER_PUSH_INTERVAL),
+        leader=False,  # pushes to this worker's own stream subscribers
+    )
+    sched.add(
+        "timeseries_sample",
+        lambda: timeseries.sample_nodes(database),
+        scheduler.Interval(timeseries.TIMESERIES_SAMPLE_INTERVAL),
+    )
+    sched.add(
+        "timeseries_pull",
+        lambda: timeseries.pull(database),
+        scheduler.Interval(timeseries.TIMESERIES_SAMPLE_INTERVAL / 2),
+        leader=False,  # each worker serves graphs from its own store
+    )
@@ -0,0 +1,52 @@
+"""Tiny in-process metrics registry rendered in Prometheus text format.
+
+Counters and gauges are plain dict entries keyed by (name, labels). Modules
+that own live state (circuit breakers, pools, ...) register a collector that
+refreshes their gauges right before `/metrics` is rendered.
+"""
+from typing import Callable, Dict, List, Tuple
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_counters: Dict[_Key, float] = {}
+_gauges: Dict[_Key, float] = {}
+_collectors: List[Callable[[], None]] = []
+
+
+def _key(name: str, labels: dict) -> _Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    k = _key(name, labels)
+    _counters[k] = _counters.get(k, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    _gauges[_key(name, labels)] = value
+
+
+def register_collector(fn: Callable[[], None]) -> None:
+    _collectors.append(fn)
+
+
+def _fmt(key: _Key, value: float) -> str:
+    name, labels = key
+    if labels:
+        inner = ",".join(f'{k}="{v}"' for k, v in labels)
+        return f"{name}{{{inner}}} {value:g}"
+    return f"{name} {value:g}"
+
+
+def render() -> str:
+    for fn in _collectors:
+        fn()
+    lines = []
+    for kind, store in (("counter", _counters), ("gauge", _gauges)):
+        seen = set()
+        for key in sorted(store):
+            if key[0] not in seen:
+                seen.add(key[0])
+                lines.append(f"# TYPE {key[0]} {kind}")
+            lines.append(_fmt(key, store[key]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,171 @@
+"""On-demand sampling profiler (/debug/profile).
+
+Nothing runs until a profile is requested. Then the calling worker thread
+wakes up `rate` times a second for `seconds`, grabs every other thread's
+current frame with sys._current_frames() and counts the stack, root first.
+The event loop thread is one of those threads, so a coroutine hogging the
+CPU shows up under it. With `tasks=True`, each sample also walks the await
+chain of every suspended asyncio task, which shows where requests are
+waiting rather than where the CPU goes.
+
+Sampling takes the GIL, so under a CPU-bound worker the achieved rate can
+be lower than asked; the result reports both. Stacks whose leaf is an idle
+wait (selector, lock, queue) are dropped unless `idle=True`.
+
+Output is {stack: count}, with stacks as "frame;frame;frame" and frames
+as "module:function". `collapsed` turns that into the text format that
+flamegraph.pl, speedscope and inferno read.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_MAX_RATE = int(os.getenv("PROFILE_MAX_RATE", "1000"))  # samples per second
+_MAX_DEPTH = 128
+
+# Leaves that mean "this thread is waiting", as (file name, function)
+_IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),  # concurrent.futures worker blocked on its queue
+    ("socket.py", "accept"),
+}
+
+_lock = threading.Lock()  # one profile at a time per process
+_labels: Dict[Any, str] = {}
+
+
+class ProfilerBusy(RuntimeError):
+    """Another profile is already running in this process (409)."""
+
+
+def _label(code) -> str:
+    label = _labels.get(code)
+    if label is None:
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        label = _labels[code] = f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+    return label
+
+
+def _is_idle(code) -> bool:
+    return (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES
+
+
+def _thread_stack(frame, idle: bool) -> Optional[str]:
+    if not idle and _is_idle(frame.f_code):
+        return None
+    labels = []
+    while frame is not None and len(labels) < _MAX_DEPTH:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _task_stack(task: "asyncio.Task") -> Optional[str]:
+    """The await chain of a suspended task, outermost coroutine first."""
+    labels = []
+    coro = task.get_coro()
+    while coro is not None and len(labels) < _MAX_DEPTH:
+        code = getattr(coro, "cr_code", None) or getattr(coro, "gi_code", None)
+        if code is None:
+            break
+        labels.append(_label(code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    if not labels:
+        return None
+    return f"task:{task.get_name()};" + ";".join(labels)
+
+
+def _loop_tasks(loop: Optional[asyncio.AbstractEventLoop]) -> List["asyncio.Task"]:
+    if loop is None:
+        return []
+    # all_tasks() isn't thread-safe; a set changing under us just skips the sample
+    try:
+        return [t for t in asyncio.all_tasks(loop) if not t.done()]
+    except RuntimeError:
+        return []
+
+
+def sample(
+    seconds: float,
+    rate: int = 100,
+    idle: bool = False,
+    tasks: bool = False,
+    loop: Optional[asyncio.AbstractEventLoop] = None,
+) -> Dict[str, Any]:
+    """Profile every other thread in the process for `seconds`; blocks the caller.
+
+    Run it in a worker thread, not on the event loop. `loop` is needed for
+    `tasks=True`.
+    """
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    rate = min(max(rate, 1), PROFILE_MAX_RATE)
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("a profile is already running in this process")
+    try:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks: Counter = Counter()
+        interval = 1.0 / rate
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        next_at = started
+        while True:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = _thread_stack(frame, idle)
+                if stack is not None:
+                    stacks[f"thread:{names.get(ident, ident)};{stack}"] += 1
+            if tasks:
+                for task in _loop_tasks(loop):
+                    stack = _task_stack(task)
+                    if stack is not None:
+                        stacks[stack] += 1
+            samples += 1
+            next_at += interval
+            now = time.perf_counter()
+            if next_at >= deadline:
+                break
+            if next_at > now:
+                time.sleep(next_at - now)
+            else:
+                next_at = now  # fell behind (GIL contention): don't burst to catch up
+        elapsed = time.perf_counter() - started
+    finally:
+        _lock.release()
+
+    return {
+        "seconds": round(elapsed, 3),
+        "rate": rate,
+        "achieved_rate": round(samples / elapsed, 1) if elapsed else 0.0,
+        "samples": samples,
+        "pid": os.getpid(),
+        "stacks": dict(stacks.most_common()),
+    }
+
+
+def collapsed(stacks: Dict[str, int]) -> str:
+    """Brendan Gregg's folded format: one "frame;frame;frame count" per line."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.items())
+
+
+def top_functions(stacks: Dict[str, int], limit: int = 20) -> List[Dict[str, Any]]:
+    """Functions by self samples (leaf) and total samples (anywhere on the stack)."""
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    ranked = sorted(total, key=lambda f: (own[f], total[f]), reverse=True)[:limit]
+    return [{"function": f, "self": own[f], "total": total[f]} for f in ranked]
@@ -0,0 +1,55 @@
+"""In-process publish/subscribe for pushing events to streaming clients.
+
+Each subscriber owns a small bounded queue; publishing is a dict lookup plus
+a put_nowait per subscriber, and an idle subscriber costs nothing but its
+queue. A slow consumer never blocks publishers: when its queue is full the
+oldest event is dropped.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Set, AsyncIterator
+
+from app.utils import metrics
+
+_QUEUE_SIZE = 64
+
+
+class Broker:
+    def __init__(self, queue_size: int = _QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subs: Dict[str, Set[asyncio.Queue]] = {}
+
+    def publish(self, topic: str, event: dict) -> int:
+        """Deliver `event` to every subscriber of `topic`; returns how many."""
+        queues = self._subs.get(topic)
+        if not queues:
+            return 0
+        for q in queues:
+            if q.full():
+                q.get_nowait()
+                metrics.inc("pubsub_dropped_total")
+            q.put_nowait(event)
+        return len(queues)
+
+    @asynccontextmanager
+    async def subscribe(self, topic: str) -> AsyncIterator[asyncio.Queue]:
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subs.setdefault(topic, set()).add(q)
+        try:
+            yield q
+        finally:
+            subs = self._subs.get(topic)
+            if subs is not None:
+                subs.discard(q)
+                if not subs:
+                    del self._subs[topic]
+
+    def topics(self, prefix: str = "") -> Set[str]:
+        return {t for t in self._subs if t.startswith(prefix)}
+
+    def subscriber_count(self) -> int:
+        return sum(len(s) for s in self._subs.values())
+
+
+broker = Broker()
+metrics.register_collector(lambda: metrics.set_gauge("pubsub_subscribers", broker.subscriber_count()))
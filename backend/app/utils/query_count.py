@@ -0,0 +1,38 @@
+"""Per-request database round-trip counter.
+
+The pooled connection (db_pool._BoundedConnection) calls `record()` for
+every statement it sends. The middleware gives each request its own
+counter through a ContextVar and reports the total in an X-DB-Queries
+response header, which makes a handler that drifts back into serial round
+trips easy to spot (tests/test_query_counts.py checks the hot endpoints).
+"""
+from contextvars import ContextVar
+from typing import List, Optional
+
+from fastapi import Request
+
+from app.utils import metrics
+
+# A one-element list so that tasks spawned by the request (which get a copy
+# of the context) still add to the same counter.
+_current: ContextVar[Optional[List[int]]] = ContextVar("db_query_count", default=None)
+
+
+def record(n: int = 1) -> None:
+    counter = _current.get()
+    if counter is not None:
+        counter[0] += n
+    metrics.inc("db_queries_total", n)
+
+
+def start() -> List[int]:
+    counter = [0]
+    _current.set(counter)
+    return counter
+
+
+async def query_count_middleware(request: Request, call_next):
+    counter = start()
+    response = await call_next(request)
+    response.headers["X-DB-Queries"] = str(counter[0])
+    return response
@@ -0,0 +1,284 @@
+"""Sliding-window attempt limits for login, registration and 2FA.
+
+Checked at the very top of the handlers, so a rejected attempt costs a dict
+lookup: no DB query, no bcrypt. Each limiter counts attempts per key
+(username, client IP or both) in fixed windows and estimates the sliding window
+as `previous * (1 - elapsed fraction) + current`. Keys are spread over
+RATE_LIMIT_SHARDS shards, each an LRU capped at RATE_LIMIT_MAX_KEYS /
+shards entries, so memory stays bounded however many usernames an attacker
+sprays; the least recently seen keys are forgotten first.
+
+Counts are per worker by default. With RATE_LIMIT_STORE=db, `sync_forever`
+pushes each worker's new attempts into rate_limit_counters every
+RATE_LIMIT_SYNC_INTERVAL seconds and reads back the fleet totals for the
+keys it tracks. The decision itself still never waits on the database;
+it uses the last synced totals plus the attempts made since.
+
+Failed logins count per (username, client IP), so guessing at an account
+from one place doesn't lock its owner out. A looser per-username cap across
+all IPs is the backstop against guesses spread one per IP; while it is hit,
+only IPs that logged in to that username successfully within
+LOGIN_TRUSTED_SECONDS still get through, so the owner keeps access from
+where they usually log in.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app.models import rate_limit_counters
+from app.utils import metrics
+
+log = logging.getLogger(__name__)
+
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "local")  # "local" or "db"
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", "1"))
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() == "true"
+
+# "<attempts>/<seconds>"
+LOGIN_USER_IP_LIMIT = os.getenv("LOGIN_USER_IP_LIMIT", "10/300")  # failed logins per username and client IP
+LOGIN_USER_LIMIT = os.getenv("LOGIN_USER_LIMIT", "100/300")     # failed logins per username, any IP (backstop)
+LOGIN_TRUSTED_SECONDS = os.getenv("LOGIN_TRUSTED_SECONDS", "604800")  # a successful login exempts its IP this long
+LOGIN_IP_LIMIT = os.getenv("LOGIN_IP_LIMIT", "60/60")           # login attempts per client IP
+REGISTER_IP_LIMIT = os.getenv("REGISTER_IP_LIMIT", "10/3600")   # registrations per client IP
+TWOFA_USER_LIMIT = os.getenv("TWOFA_USER_LIMIT", "5/300")       # failed 2FA codes per user
+TWOFA_IP_LIMIT = os.getenv("TWOFA_IP_LIMIT", "30/60")           # 2FA attempts per client IP
+
+_SYNC_CHUNK = 500
+_KEY_CHARS = 191   # bucket_key column width
+
+
+def _parse(spec: str) -> Tuple[int, float]:
+    attempts, seconds = spec.split("/", 1)
+    return int(attempts), float(seconds)
+
+
+class _Counts:
+    """Per-key counts for the current and previous window."""
+    __slots__ = ("window", "local", "flushed", "remote")
+
+    def __init__(self, window: int):
+        self.window = window
+        # [previous, current] for each
+        self.local = [0, 0]     # attempts seen by this worker
+        self.flushed = [0, 0]   # of those, already pushed to the shared store
+        self.remote = [0, 0]    # fleet totals from the last sync (includes flushed)
+
+    def roll(self, window: int) -> None:
+        shift = window - self.window
+        if shift <= 0:
+            return
+        for pair in (self.local, self.flushed, self.remote):
+            pair[0], pair[1] = (pair[1] if shift == 1 else 0), 0
+        self.window = window
+
+    def total(self, i: int) -> int:
+        return max(self.remote[i], self.flushed[i]) + self.local[i] - self.flushed[i]
+
+
+class SlidingWindowLimiter:
+    def __init__(self, name: str, limit: int, window: float,
+                 shards: int = RATE_LIMIT_SHARDS, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self._per_shard = max(1, max_keys // shards)
+        self._shards: List["OrderedDict[str, _Counts]"] = [OrderedDict() for _ in range(shards)]
+
+    def _shard(self, key: str) -> "OrderedDict[str, _Counts]":
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=2).digest()
+        return self._shards[int.from_bytes(digest, "big") % len(self._shards)]
+
+    def _counts(self, key: str, now: float, create: bool) -> Optional[_Counts]:
+        shard = self._shard(key)
+        window = int(now // self.window)
+        counts = shard.get(key)
+        if counts is None:
+            if not create:
+                return None
+            counts = shard[key] = _Counts(window)
+            if len(shard) > self._per_shard:
+                shard.popitem(last=False)
+                metrics.inc("rate_limit_evictions_total", limiter=self.name)
+        else:
+            shard.move_to_end(key)
+            counts.roll(window)
+        return counts
+
+    def _estimate(self, counts: _Counts, now: float) -> float:
+        elapsed = (now % self.window) / self.window
+        return counts.total(0) * (1 - elapsed) + counts.total(1)
+
+    def retry_after(self, key: str, now: Optional[float] = None) -> Optional[float]:
+        """Seconds until `key` may try again, or None if it is under the limit."""
+        now = time.time() if now is None else now
+        counts = self._counts(key, now, create=False)
+        if counts is None or self._estimate(counts, now) < self.limit:
+            return None
+        return self.window - (now % self.window)
+
+    def seen(self, key: str, now: Optional[float] = None) -> bool:
+        """Whether `key` has any attempts in the sliding window."""
+        now = time.time() if now is None else now
+        counts = self._counts(key, now, create=False)
+        return counts is not None and self._estimate(counts, now) > 0
+
+    def hit(self, key: str, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        self._counts(key, now, create=True).local[1] += 1
+
+    def __len__(self) -> int:
+        return sum(len(s) for s in self._shards)
+
+    # --- shared store ---
+
+    def pending(self) -> List[Tuple[str, int, int]]:
+        """(key, window_start, delta) for attempts not yet pushed; marks them pushed."""
+        out = []
+        for shard in self._shards:
+            for key, counts in shard.items():
+                for i in (0, 1):
+                    delta = counts.local[i] - counts.flushed[i]
+                    if delta:
+                        out.append((key, counts.window - 1 + i, delta))
+                        counts.flushed[i] = counts.local[i]
+        return out
+
+    def tracked(self) -> List[str]:
+        return [key for shard in self._shards for key in shard]
+
+    def apply_remote(self, totals: Dict[Tuple[str, int], int]) -> None:
+        for shard in self._shards:
+            for key, counts in shard.items():
+                for i in (0, 1):
+                    counts.remote[i] = totals.get((key[:_KEY_CHARS], counts.window - 1 + i), counts.remote[i])
+
+
+def _limiter(name: str, spec: str) -> SlidingWindowLimiter:
+    limit, window = _parse(spec)
+    return SlidingWindowLimiter(name, limit, window)
+
+
+limiters: Dict[str, SlidingWindowLimiter] = {
+    l.name: l for l in (
+        _limiter("login_user_ip", LOGIN_USER_IP_LIMIT),
+        _limiter("login_user", LOGIN_USER_LIMIT),
+        _limiter("login_trusted", f"1/{LOGIN_TRUSTED_SECONDS}"),  # successful logins per username and IP
+        _limiter("login_ip", LOGIN_IP_LIMIT),
+        _limiter("register_ip", REGISTER_IP_LIMIT),
+        _limiter("twofa_user", TWOFA_USER_LIMIT),
+        _limiter("twofa_ip", TWOFA_IP_LIMIT),
+    )
+}
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",", 1)[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def enforce(*checks: Tuple[str, str]) -> None:
+    """Raise 429 if any (limiter, key) is over its limit. Counts nothing."""
+    now = time.time()
+    for name, key in checks:
+        wait = limiters[name].retry_after(key, now)
+        if wait is not None:
+            metrics.inc("rate_limit_shed_total", limiter=name)
+            raise HTTPException(
+                status_code=429,
+                detail="Too many attempts, try again later",
+                headers={"Retry-After": str(max(1, int(wait + 0.999)))},
+            )
+
+
+def record(name: str, key: str) -> None:
+    limiters[name].hit(key)
+
+
+def enforce_login(username: str, ip: str) -> None:
+    """429 if the IP is over its attempt limit, or over its failure limit
+    for this username, or the username is over its failure cap across all
+    IPs (unless this IP logged in to it successfully not long ago)."""
+    pair = f"{username}|{ip}"
+    checks = [("login_ip", ip), ("login_user_ip", pair)]
+    if not limiters["login_trusted"].seen(pair):
+        checks.append(("login_user", username))
+    enforce(*checks)
+
+
+def record_login_success(username: str, ip: str) -> None:
+    record("login_trusted", f"{username}|{ip}")
+
+
+def record_login_failure(username: str, ip: str) -> None:
+    record("login_user_ip", f"{username}|{ip}")
+    record("login_user", username)
+
+
+async def sync_once(database) -> None:
+    for limiter in limiters.values():
+        deltas = limiter.pending()
+        for i in range(0, len(deltas), _SYNC_CHUNK):
+            rows = [
+                {"limiter": limiter.name, "bucket_key": key[:_KEY_CHARS], "window_start": window, "attempts": delta}
+                for key, window, delta in deltas[i:i + _SYNC_CHUNK]
+            ]
+            stmt = mysql_insert(rate_limit_counters).values(rows)
+            await database.execute(
+                stmt.on_duplicate_key_update(attempts=rate_limit_counters.c.attempts + stmt.inserted.attempts)
+            )
+
+        keys = limiter.tracked()
+        window = int(time.time() // limiter.window)
+        totals: Dict[Tuple[str, int], int] = {}
+        for i in range(0, len(keys), _SYNC_CHUNK):
+            rows = await database.fetch_all(
+                select(rate_limit_counters.c.bucket_key, rate_limit_counters.c.window_start, rate_limit_counters.c.attempts)
+                .where(rate_limit_counters.c.limiter == limiter.name)
+                .where(rate_limit_counters.c.window_start.in_([window - 1, window]))
+                .where(rate_limit_counters.c.bucket_key.in_([k[:_KEY_CHARS] for k in keys[i:i + _SYNC_CHUNK]]))
+            )
+            totals.update({(r["bucket_key"], r["window_start"]): r["attempts"] for r in rows})
+        limiter.apply_remote(totals)
+
+
+async def prune(database) -> None:
+    """Drop windows older than the previous one; they no longer count (a scheduled leader job)."""
+    now = time.time()
+    for limiter in limiters.values():
+        await database.execute(
+            rate_limit_counters.delete()
+            .where(rate_limit_counters.c.limiter == limiter.name)
+            .where(rate_limit_counters.c.window_start < int(now // limiter.window) - 1)
+        )
+
+
+async def sync_forever(database, interval: float = RATE_LIMIT_SYNC_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sync_once(database)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("rate limit sync failed; limits stay per worker until it recovers")
+
+
+def _collect() -> None:
+    for name, limiter in limiters.items():
+        metrics.set_gauge("rate_limit_keys", len(limiter), limiter=name)
+
+
+metrics.register_collector(_collect)
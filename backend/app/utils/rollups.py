@@ -0,0 +1,203 @@
+"""Incremental usage rollups over the `connections` table.
+
+Dashboards read pre-aggregated buckets instead of scanning `connections`:
+  - usage_server_hourly: sessions / connected seconds per server per hour
+  - usage_server_daily:  same per server per day
+  - usage_user_daily:    same per user per day
+
+Only closed sessions are aggregated, each exactly once: a batch claims
+closed rows with rolled_up = 0 (FOR UPDATE SKIP LOCKED), folds them and sets
+rolled_up = 1 in the same transaction. Later writes to a closed row (a late
+transfer update, the archiver) don't bring it back, and concurrent runs on
+other workers or replicas take disjoint rows instead of double-counting.
+A session's connected time is split over every hour/day it spans.
+
+Everything here is derived from raw rows, so `rebuild()` can always wipe the
+rollups and replay from the beginning, including `connections_archive`.
+"""
+import asyncio
+import datetime
+import logging
+import os
+from collections import defaultdict
+from typing import Dict, Iterator, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from app.models import (
+    connections,
+    connections_archive,
+    usage_server_hourly,
+    usage_server_daily,
+    usage_user_daily,
+)
+
+log = logging.getLogger(__name__)
+
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "5000"))
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "60"))  # seconds between runs
+
+_HOUR = datetime.timedelta(hours=1)
+_DAY = datetime.timedelta(days=1)
+
+# Serializes incremental runs and rebuilds within this worker
+_lock = asyncio.Lock()
+
+
+def _floor_hour(ts: datetime.datetime) -> datetime.datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _floor_day(ts: datetime.datetime) -> datetime.datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def split_seconds(
+    start: datetime.datetime,
+    end: datetime.datetime,
+    step: datetime.timedelta,
+) -> Iterator[Tuple[datetime.datetime, int]]:
+    """Yield (bucket_start, seconds) for every bucket the interval overlaps."""
+    floor = _floor_hour if step == _HOUR else _floor_day
+    cur = floor(start)
+    while cur < end:
+        nxt = cur + step
+        secs = int((min(end, nxt) - max(start, cur)).total_seconds())
+        if secs > 0:
+            yield cur, secs
+        cur = nxt
+
+
+async def _add(database, table, key_cols: Tuple[str, str], deltas: Dict[tuple, list]) -> None:
+    if not deltas:
+        return
+    rows = [
+        {key_cols[0]: k[0], key_cols[1]: k[1], "sessions": v[0], "connected_seconds": v[1]}
+        for k, v in deltas.items()
+    ]
+    stmt = mysql_insert(table).values(rows)
+    stmt = stmt.on_duplicate_key_update(
+        sessions=table.c.sessions + stmt.inserted.sessions,
+        connected_seconds=table.c.connected_seconds + stmt.inserted.connected_seconds,
+    )
+    await database.execute(stmt)
+
+
+def _fold(rows) -> Tuple[Dict[tuple, list], Dict[tuple, list], Dict[tuple, list]]:
+    """Aggregate closed session rows into (server_hourly, server_daily, user_daily) deltas."""
+    server_hourly: Dict[tuple, list] = defaultdict(lambda: [0, 0])
+    server_daily: Dict[tuple, list] = defaultdict(lambda: [0, 0])
+    user_daily: Dict[tuple, list] = defaultdict(lambda: [0, 0])
+
+    for r in rows:
+        start = r["connected_at"]
+        end = max(r["disconnected_at"], start)
+        sid, uid = r["server_id"], r["user_id"]
+        if sid is not None:
+            server_hourly[(sid, _floor_hour(start))][0] += 1
+            server_daily[(sid, _floor_day(start).date())][0] += 1
+            for bucket, secs in split_seconds(start, end, _HOUR):
+                server_hourly[(sid, bucket)][1] += secs
+        if uid is not None:
+            user_daily[(uid, _floor_day(start).date())][0] += 1
+        for bucket, secs in split_seconds(start, end, _DAY):
+            if sid is not None:
+                server_daily[(sid, bucket.date())][1] += secs
+            if uid is not None:
+                user_daily[(uid, bucket.date())][1] += secs
+    return server_hourly, server_daily, user_daily
+
+
+async def _apply(database, deltas) -> None:
+    server_hourly, server_daily, user_daily = deltas
+    await _add(database, usage_server_hourly, ("server_id", "bucket_start"), server_hourly)
+    await _add(database, usage_server_daily, ("server_id", "day"), server_daily)
+    await _add(database, usage_user_daily, ("user_id", "day"), user_daily)
+
+
+async def process_batch(database, batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+    """Fold the next batch of closed, not yet rolled-up sessions into the rollups.
+
+    Returns the number of rows processed (0 when caught up).
+    """
+    async with database.transaction():
+        rows = await database.fetch_all(
+            select(
+                connections.c.id,
+                connections.c.user_id,
+                connections.c.server_id,
+                connections.c.connected_at,
+                connections.c.disconnected_at,
+            )
+            .where(connections.c.rolled_up == False)  # noqa: E712
+            .where(connections.c.disconnected_at.is_not(None))
+            .order_by(connections.c.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        if not rows:
+            return 0
+        await _apply(database, _fold(rows))
+        await database.execute(
+            connections.update()
+            .where(connections.c.id.in_([r["id"] for r in rows]))
+            # keep updated_at: marking a row isn't a change to the session
+            .values(rolled_up=True, updated_at=connections.c.updated_at)
+        )
+    return len(rows)
+
+
+async def _catch_up(database) -> int:
+    total = 0
+    while True:
+        n = await process_batch(database)
+        total += n
+        if n < ROLLUP_BATCH_SIZE:
+            return total
+
+
+async def run_once(database) -> int:
+    """Process batches until caught up; returns total rows folded in."""
+    async with _lock:
+        return await _catch_up(database)
+
+
+async def _fold_archive(database) -> int:
+    """Replay every archived session (see archiver.py); they never change again."""
+    total, last_id = 0, 0
+    while True:
+        rows = await database.fetch_all(
+            select(
+                connections_archive.c.id,
+                connections_archive.c.user_id,
+                connections_archive.c.server_id,
+                connections_archive.c.connected_at,
+                connections_archive.c.disconnected_at,
+            )
+            .where(connections_archive.c.id > last_id)
+            .order_by(connections_archive.c.id)
+            .limit(ROLLUP_BATCH_SIZE)
+        )
+        if not rows:
+            return total
+        await _apply(database, _fold(rows))
+        total += len(rows)
+        last_id = rows[-1]["id"]
+
+
+async def rebuild(database) -> int:
+    """Drop all rollups and unmark every session, then replay from raw
+    sessions (archived ones first, then the hot connections table)."""
+    async with _lock:
+        async with database.transaction():
+            await database.execute(usage_server_hourly.delete())
+            await database.execute(usage_server_daily.delete())
+            await database.execute(usage_user_daily.delete())
+            await database.execute(
+                connections.update()
+                .where(connections.c.rolled_up == True)  # noqa: E712
+                .values(rolled_up=False, updated_at=connections.c.updated_at)
+            )
+        archived = await _fold_archive(database)
+        return archived + await _catch_up(database)
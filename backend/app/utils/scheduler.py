@@ -0,0 +1,404 @@
+"""In-process job scheduler with single-leader execution across replicas.
+
+Jobs fire on an interval or a cron expression ("*/5 * * * *": minute, hour,
+day of month, month, day of week; UTC), with optional random jitter so
+replicas don't hit the database in lockstep. At most
+SCHEDULER_MAX_CONCURRENCY jobs run at once per replica, and a job that is
+still running when it fires again is skipped rather than stacked.
+
+Leader jobs (the default) run on exactly one replica. Each replica tries to
+take or renew a lease per leader job in job_leases every
+SCHEDULER_LEASE_SECONDS / 3; a lease is only taken over once it has expired,
+using the database clock, so a dead leader is replaced within
+SCHEDULER_LEASE_SECONDS. A replica only starts a leader job while its own
+view of the lease (renewal time + TTL - margin) is still valid, and cancels
+a run in progress as soon as that view lapses without a renewal, which is
+before the database would let another replica take over. So a leader job
+never runs past its lease, however long it takes; work it had not committed
+is rolled back. Local jobs (leader=False) run on every replica, for
+per-worker state.
+
+Every run is recorded in job_runs with its replica, trigger, duration and
+outcome. `request_run` starts a job now; for a leader job held by another
+replica it flags the lease row and the holder starts it on its next renewal.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from sqlalchemy import select, text
+
+from app.models import job_leases, job_runs
+from app.utils import metrics
+
+log = logging.getLogger(__name__)
+
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "4"))
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", "30"))
+SCHEDULER_HISTORY_DAYS = int(os.getenv("SCHEDULER_HISTORY_DAYS", "14"))
+_LEASE_MARGIN = 0.2  # fraction of the TTL we don't trust our own lease for
+
+
+# --- triggers ---
+
+class Interval:
+    def __init__(self, seconds: float, jitter: float = 0.0):
+        self.seconds = seconds
+        self.jitter = jitter
+
+    def next_fire(self, after: float) -> float:
+        return after + self.seconds + random.uniform(0, self.jitter)
+
+    def __str__(self) -> str:
+        return f"every {self.seconds:g}s"
+
+
+def _cron_field(spec: str, lo: int, hi: int) -> Set[int]:
+    values: Set[int] = set()
+    for part in spec.split(","):
+        body, _, step = part.partition("/")
+        if body == "*":
+            start, end = lo, hi
+        elif "-" in body:
+            start, end = (int(v) for v in body.split("-", 1))
+        else:
+            start = end = int(body)
+        if not (lo <= start <= end <= hi):
+            raise ValueError(f"cron field {spec!r} out of range {lo}-{hi}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+class Cron:
+    """Five-field cron expression evaluated in UTC."""
+
+    def __init__(self, expr: str, jitter: float = 0.0):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields: {expr!r}")
+        self.expr = expr
+        self.jitter = jitter
+        self.minutes = _cron_field(fields[0], 0, 59)
+        self.hours = _cron_field(fields[1], 0, 23)
+        self.days = _cron_field(fields[2], 1, 31)
+        self.months = _cron_field(fields[3], 1, 12)
+        self.weekdays = {d % 7 for d in _cron_field(fields[4], 0, 7)}  # 0 and 7 are Sunday
+        # Like classic cron: when both day fields are restricted, either may match
+        self._any_day = fields[2] == "*" or fields[4] == "*"
+
+    def _day_ok(self, dt: datetime.datetime) -> bool:
+        dom = dt.day in self.days
+        dow = (dt.isoweekday() % 7) in self.weekdays
+        return (dom and dow) if self._any_day else (dom or dow)
+
+    def next_fire(self, after: float) -> float:
+        dt = datetime.datetime.utcfromtimestamp(after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        for _ in range(366 * 24 * 60):
+            if dt.month not in self.months or not self._day_ok(dt):
+                dt = (dt + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if dt.hour not in self.hours:
+                dt = (dt + datetime.timedelta(hours=1)).replace(minute=0)
+                continue
+            if dt.minute in self.minutes:
+                fire = dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+                return fire + random.uniform(0, self.jitter)
+            dt += datetime.timedelta(minutes=1)
+        raise ValueError(f"cron expression never fires: {self.expr!r}")
+
+    def __str__(self) -> str:
+        return f"cron {self.expr}"
+
+
+def trigger(interval: float, cron: Optional[str] = None, jitter: float = 0.0):
+    """Cron when an expression is given (e.g. from an env var), else an interval."""
+    return Cron(cron, jitter) if cron else Interval(interval, jitter)
+
+
+# --- jobs ---
+
+class Job:
+    def __init__(self, name: str, fn: Callable[[], Awaitable[Any]], trigger, leader: bool = True,
+                 timeout: Optional[float] = None, run_at_start: bool = False):
+        self.name = name
+        self.fn = fn
+        self.trigger = trigger
+        self.leader = leader
+        self.timeout = timeout
+        self.run_at_start = run_at_start
+        self.next_fire: Optional[float] = None
+        self.running = False
+        self.last_run: Optional[Dict[str, Any]] = None
+
+
+class JobNotFound(KeyError):
+    pass
+
+
+class LeaseLost(Exception):
+    """A leader job was cancelled because this replica's lease lapsed."""
+
+
+class DbLeaseStore:
+    """Leases in the job_leases table, on the database clock."""
+
+    def __init__(self, database):
+        self.database = database
+
+    async def acquire(self, name: str, owner: str, ttl: float) -> Optional[Dict[str, Any]]:
+        """Take or renew the lease; returns the row (owner, run_requested_at) as it now stands."""
+        # Assignments run left to right: once owner is ours, the expiry is ours to extend
+        await self.database.execute(
+            text(
+                "INSERT INTO job_leases (name, owner, expires_at) "
+                "VALUES (:name, :owner, NOW() + INTERVAL :ttl SECOND) "
+                "ON DUPLICATE KEY UPDATE "
+                "owner = IF(owner = VALUES(owner) OR expires_at < NOW(), VALUES(owner), owner), "
+                "expires_at = IF(owner = VALUES(owner), VALUES(expires_at), expires_at)"
+            ).bindparams(name=name, owner=owner, ttl=int(ttl))
+        )
+        row = await self.database.fetch_one(
+            select(job_leases.c.owner, job_leases.c.run_requested_at).where(job_leases.c.name == name)
+        )
+        return dict(row) if row is not None else None
+
+    async def clear_request(self, name: str) -> None:
+        await self.database.execute(
+            job_leases.update().where(job_leases.c.name == name).values(run_requested_at=None)
+        )
+
+    async def request_run(self, name: str) -> Optional[str]:
+        """Flag the lease for a run; returns the current owner."""
+        await self.database.execute(
+            job_leases.update().where(job_leases.c.name == name).values(run_requested_at=datetime.datetime.utcnow())
+        )
+        row = await self.database.fetch_one(select(job_leases.c.owner).where(job_leases.c.name == name))
+        return row["owner"] if row else None
+
+    async def release(self, names: List[str], owner: str) -> None:
+        await self.database.execute(
+            job_leases.update()
+            .where(job_leases.c.name.in_(names))
+            .where(job_leases.c.owner == owner)
+            .values(expires_at=datetime.datetime(1970, 1, 2))
+        )
+
+
+class Scheduler:
+    def __init__(self, replica_id: Optional[str] = None, max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+                 lease_seconds: float = SCHEDULER_LEASE_SECONDS, lease_store=None):
+        self.replica_id = replica_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:4]}"
+        self.lease_seconds = lease_seconds
+        self.jobs: Dict[str, Job] = {}
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._leases: Dict[str, float] = {}  # job -> monotonic time until which we trust our lease
+        self._tasks: List[asyncio.Task] = []
+        self._runs: Set[asyncio.Task] = set()
+        self._leases_checked = asyncio.Event()
+        self.lease_store = lease_store  # DbLeaseStore over the database unless given
+        self.database = None
+
+    def add(self, name: str, fn: Callable[[], Awaitable[Any]], trigger, **kwargs) -> Job:
+        if name in self.jobs:
+            raise ValueError(f"job {name!r} already registered")
+        job = self.jobs[name] = Job(name, fn, trigger, **kwargs)
+        return job
+
+    # --- leases ---
+
+    def is_leader(self, job: Job) -> bool:
+        if not job.leader:
+            return True
+        return self._leases.get(job.name, 0.0) > time.monotonic()
+
+    async def _acquire(self, job: Job) -> Optional[Dict[str, Any]]:
+        """Take or renew the job's lease; returns the lease row as it now stands."""
+        started = time.monotonic()
+        try:
+            row = await self.lease_store.acquire(job.name, self.replica_id, self.lease_seconds)
+        except Exception:
+            self._leases.pop(job.name, None)
+            raise
+        if row is not None and row["owner"] == self.replica_id:
+            # Measured from before the statement, so our view never outlives the DB's
+            self._leases[job.name] = started + self.lease_seconds * (1 - _LEASE_MARGIN)
+        else:
+            self._leases.pop(job.name, None)
+        return row
+
+    async def _lease_loop(self) -> None:
+        while True:
+            for job in [j for j in self.jobs.values() if j.leader]:
+                try:
+                    lease = await self._acquire(job)
+                    if lease and lease["run_requested_at"] is not None and self.is_leader(job):
+                        await self.lease_store.clear_request(job.name)
+                        self._start(job, "manual")
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception("lease renewal for job %s failed", job.name)
+            self._leases_checked.set()
+            for name in list(self._leases):
+                metrics.set_gauge("scheduler_leader", 1 if self.is_leader(self.jobs[name]) else 0, job=name)
+            await asyncio.sleep(self.lease_seconds / 3)
+
+    async def release(self) -> None:
+        """Give up our leases so another replica takes over without waiting for expiry."""
+        names = [n for n in self._leases]
+        self._leases.clear()
+        if names and self.lease_store is not None:
+            await self.lease_store.release(names, self.replica_id)
+
+    # --- running ---
+
+    def _start(self, job: Job, how: str) -> bool:
+        if job.running:
+            metrics.inc("scheduler_skipped_total", job=job.name, reason="still_running")
+            return False
+        job.running = True
+        task = asyncio.create_task(self._run(job, how))
+        self._runs.add(task)
+        task.add_done_callback(self._runs.discard)
+        return True
+
+    async def _run(self, job: Job, how: str) -> None:
+        try:
+            async with self._sem:
+                started_at = datetime.datetime.utcnow()
+                started = time.perf_counter()
+                status, error = "ok", None
+                try:
+                    await self._call(job)
+                except asyncio.TimeoutError:
+                    status, error = "timeout", f"exceeded {job.timeout}s"
+                except LeaseLost:
+                    status, error = "lease_lost", "cancelled when this replica's lease lapsed"
+                    log.warning("job %s cancelled: lease lapsed", job.name)
+                except asyncio.CancelledError:
+                    status, error = "cancelled", None
+                    raise
+                except Exception as exc:
+                    status, error = "error", f"{type(exc).__name__}: {exc}"[:500]
+                    log.exception("job %s failed", job.name)
+                finally:
+                    duration_ms = int((time.perf_counter() - started) * 1000)
+                    job.last_run = {
+                        "started_at": started_at.isoformat(), "duration_ms": duration_ms,
+                        "status": status, "error": error, "trigger": how,
+                    }
+                    metrics.inc("scheduler_runs_total", job=job.name, status=status)
+                    metrics.set_gauge("scheduler_last_duration_ms", duration_ms, job=job.name)
+                    await self._record(job, how, started_at, duration_ms, status, error)
+        finally:
+            job.running = False
+
+    async def _call(self, job: Job) -> None:
+        run = asyncio.wait_for(job.fn(), job.timeout) if job.timeout else job.fn()
+        if not job.leader:
+            await run
+            return
+        # Watch the lease while the job runs; each renewal pushes the deadline out
+        task = asyncio.ensure_future(run)
+        try:
+            while True:
+                remaining = self._leases.get(job.name, 0.0) - time.monotonic()
+                if remaining <= 0:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    raise LeaseLost(job.name)
+                done, _ = await asyncio.wait({task}, timeout=remaining)
+                if done:
+                    task.result()
+                    return
+        finally:
+            task.cancel()
+
+    async def _record(self, job: Job, how: str, started_at, duration_ms: int, status: str, error: Optional[str]) -> None:
+        try:
+            await self.database.execute(
+                job_runs.insert().values(
+                    job=job.name, replica=self.replica_id, trigger=how, started_at=started_at,
+                    finished_at=datetime.datetime.utcnow(), duration_ms=duration_ms, status=status, error=error,
+                )
+            )
+        except Exception:
+            log.exception("could not record run of job %s", job.name)
+
+    async def _fire_loop(self) -> None:
+        await self._leases_checked.wait()  # so run_at_start leader jobs know if they lead
+        now = time.time()
+        for job in self.jobs.values():
+            job.next_fire = now if job.run_at_start else job.trigger.next_fire(now)
+        while True:
+            now = time.time()
+            for job in self.jobs.values():
+                if job.next_fire > now:
+                    continue
+                job.next_fire = job.trigger.next_fire(now)
+                if self.is_leader(job):
+                    self._start(job, "schedule")
+            upcoming = min((j.next_fire for j in self.jobs.values()), default=now + 60)
+            await asyncio.sleep(min(max(upcoming - time.time(), 0.05), 5.0))
+
+    async def request_run(self, name: str) -> Dict[str, Any]:
+        """Run a job now: here if we may, else flag it for the lease holder."""
+        job = self.jobs.get(name)
+        if job is None:
+            raise JobNotFound(name)
+        if self.is_leader(job):
+            started = self._start(job, "manual")
+            return {"job": name, "started": started, "replica": self.replica_id, "already_running": not started}
+        owner = await self.lease_store.request_run(name)
+        return {"job": name, "started": False, "queued_for": owner}
+
+    def start(self, database) -> None:
+        self.database = database
+        if self.lease_store is None:
+            self.lease_store = DbLeaseStore(database)
+        self._tasks = [asyncio.create_task(self._lease_loop()), asyncio.create_task(self._fire_loop())]
+
+    async def stop(self) -> None:
+        for task in self._tasks + list(self._runs):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._runs, return_exceptions=True)
+        try:
+            await self.release()
+        except Exception:
+            log.exception("could not release job leases")
+
+    def state(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "name": job.name,
+                "trigger": str(job.trigger),
+                "leader_only": job.leader,
+                "leader_here": self.is_leader(job),
+                "running": job.running,
+                "next_fire": datetime.datetime.utcfromtimestamp(job.next_fire).isoformat() if job.next_fire else None,
+                "last_run": job.last_run,
+            }
+            for job in self.jobs.values()
+        ]
+
+
+async def recent_runs(database, name: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    query = select(job_runs).order_by(job_runs.c.id.desc()).limit(limit)
+    if name:
+        query = query.where(job_runs.c.job == name)
+    return [dict(r) for r in await database.fetch_all(query)]
+
+
+async def prune_history(database, days: int = SCHEDULER_HISTORY_DAYS) -> None:
+    await database.execute(
+        job_runs.delete().where(job_runs.c.started_at < datetime.datetime.utcnow() - datetime.timedelta(days=days))
+    )
+
+
+scheduler = Scheduler()
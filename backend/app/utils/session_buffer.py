@@ -0,0 +1,211 @@
+"""Optional write-behind buffer for connection session events.
+
+Under a reconnect storm every /users/connect and /users/disconnect would run
+its own single-row INSERT/UPDATE. With SESSION_WRITE_BEHIND=true those events
+are queued instead and flushed every SESSION_FLUSH_INTERVAL seconds or once
+SESSION_FLUSH_SIZE events are waiting, as two statements per flush:
+
+  1. one UPDATE ... SET disconnected_at = CASE user_id ... closing sessions
+     that were already in the table
+  2. one multi-row INSERT for new sessions (a connect followed by a
+     disconnect within the same batch becomes a single closed row)
+
+Events are applied in arrival order per user, and the close runs before the
+insert, so a user's new session is never closed by their own older
+disconnect. Until a flush lands, `pending_state()` lets handlers read their
+own writes (/me/connection, "already connected" checks).
+
+Read-your-writes only holds within one worker. The buffer is per process,
+so for up to one flush interval a connect queued on worker A is invisible
+to worker B. A second connect landing on B in that window passes B's
+"already connected" check (which falls back to the DB) and opens a second
+session; a disconnect landing on B answers "no active connection". Only
+enable write-behind where clients stick to a worker, or where that window
+is acceptable.
+
+A failing flush keeps its events for retry, with backoff, up to
+SESSION_FLUSH_MAX_ATTEMPTS times in a row; then that batch is logged and
+dropped (session_events_dropped_total) so a broken DB can't grow the queue
+without bound. The final flush on shutdown is best-effort.
+"""
+import asyncio
+import datetime
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import case
+
+from app.models import connections
+from app.utils import metrics
+
+log = logging.getLogger(__name__)
+
+SESSION_WRITE_BEHIND = os.getenv("SESSION_WRITE_BEHIND", "false").lower() == "true"
+SESSION_FLUSH_SIZE = int(os.getenv("SESSION_FLUSH_SIZE", "500"))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "0.05"))  # seconds
+SESSION_FLUSH_MAX_ATTEMPTS = int(os.getenv("SESSION_FLUSH_MAX_ATTEMPTS", "5"))
+_MAX_BACKOFF = 5.0  # seconds between retries of a failing flush
+
+# (kind, user_id, server_id, timestamp) with kind "connect" / "disconnect"
+_Event = Tuple[str, int, Optional[int], datetime.datetime]
+
+
+class SessionWriteBuffer:
+    def __init__(self, database, flush_size: int = SESSION_FLUSH_SIZE, flush_interval: float = SESSION_FLUSH_INTERVAL):
+        self.database = database
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._events: List[_Event] = []
+        # user_id -> latest not-yet-flushed state, {"open": bool, ...}
+        self._pending: Dict[int, dict] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._failures = 0  # consecutive failed flushes
+
+    # -- handler API ------------------------------------------------------
+
+    def pending_state(self, user_id: int) -> Optional[dict]:
+        """Unflushed session state for this user, or None if the DB is current.
+
+        {"open": True, "server_id", "connected_at"} or {"open": False, "disconnected_at"}
+        """
+        return self._pending.get(user_id)
+
+    def connect(self, user_id: int, server_id: int) -> datetime.datetime:
+        now = datetime.datetime.utcnow()
+        self._add(("connect", user_id, server_id, now))
+        self._pending[user_id] = {"open": True, "server_id": server_id, "connected_at": now}
+        return now
+
+    def disconnect(self, user_id: int) -> datetime.datetime:
+        now = datetime.datetime.utcnow()
+        self._add(("disconnect", user_id, None, now))
+        self._pending[user_id] = {"open": False, "disconnected_at": now}
+        return now
+
+    def _add(self, event: _Event) -> None:
+        self._events.append(event)
+        metrics.inc("session_events_buffered_total")
+        if len(self._events) >= self.flush_size:
+            self._wakeup.set()
+
+    # -- flushing ---------------------------------------------------------
+
+    @staticmethod
+    def plan(events: List[_Event]) -> Tuple[Dict[int, datetime.datetime], List[dict]]:
+        """Turn an ordered event list into (closes, inserts).
+
+        closes:  user_id -> disconnected_at for sessions already in the table
+        inserts: rows for sessions that started in this batch
+        """
+        closes: Dict[int, datetime.datetime] = {}
+        inserts: List[dict] = []
+        open_row: Dict[int, dict] = {}  # user_id -> row opened in this batch
+        for kind, user_id, server_id, ts in events:
+            if kind == "connect":
+                row = {"user_id": user_id, "server_id": server_id, "connected_at": ts, "disconnected_at": None}
+                inserts.append(row)
+                open_row[user_id] = row
+            elif user_id in open_row:
+                open_row.pop(user_id)["disconnected_at"] = ts
+            elif user_id not in closes:
+                closes[user_id] = ts
+        return closes, inserts
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            events, self._events = self._events, []
+            if not events:
+                return 0
+            closes, inserts = self.plan(events)
+            try:
+                async with self.database.transaction():
+                    if closes:
+                        await self.database.execute(
+                            connections.update()
+                            .where(connections.c.user_id.in_(list(closes)))
+                            .where(connections.c.disconnected_at.is_(None))
+                            .values(disconnected_at=case(closes, value=connections.c.user_id))
+                        )
+                    if inserts:
+                        await self.database.execute(connections.insert().values(inserts))
+            except Exception:
+                self._failures += 1
+                if self._failures >= SESSION_FLUSH_MAX_ATTEMPTS:
+                    log.exception("session flush failed %d times; dropping %d events", self._failures, len(events))
+                    metrics.inc("session_events_dropped_total", len(events))
+                    self._failures = 0
+                    self._forget(events)
+                else:
+                    # Keep ordering: failed events go back in front of newer ones
+                    self._events = events + self._events
+                    log.exception("session flush failed; %d events kept for retry", len(events))
+                raise
+
+            self._failures = 0
+            metrics.inc("session_flush_total")
+            metrics.inc("session_flush_statements_total", int(bool(closes)) + int(bool(inserts)))
+            self._forget(events)
+            return len(events)
+
+    def _forget(self, events: List[_Event]) -> None:
+        """Drop read-your-writes overlays for users whose events are no longer
+        queued (flushed or dropped), so handlers read the DB again."""
+        still_queued = {e[1] for e in self._events}
+        for user_id in {e[1] for e in events} - still_queued:
+            self._pending.pop(user_id, None)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(min(self.flush_interval * 2 ** self._failures, _MAX_BACKOFF))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Best-effort: shutdown must go on to close the DB pool either way
+        try:
+            await self.flush()
+        except Exception:
+            log.error("final session flush failed; %d events not written", len(self._events))
+
+
+_buffer: Optional[SessionWriteBuffer] = None
+
+
+def get_session_buffer() -> Optional[SessionWriteBuffer]:
+    """The worker's buffer, or None when write-behind is off."""
+    return _buffer
+
+
+def init(database) -> Optional[SessionWriteBuffer]:
+    global _buffer
+    if SESSION_WRITE_BEHIND and _buffer is None:
+        _buffer = SessionWriteBuffer(database)
+        _buffer.start()
+    return _buffer
+
+
+async def shutdown() -> None:
+    global _buffer
+    if _buffer is not None:
+        await _buffer.close()
+        _buffer = None
@@ -0,0 +1,327 @@
+"""Fixed-size in-memory time series for per-node throughput and peer counts.
+
+One series per (server_id, metric). Each series is a set of ring buffers,
+one per tier (10s slots for the last hour, 1m for 6 hours, 10m for 24
+hours); a sample is added to the current slot of every tier, so coarser
+tiers are downsampled as they go and nothing is ever rescanned. A slot
+holds a float32 sum, a uint16 count and the slot number it belongs to, so a
+stale slot left over from a previous lap of the ring reads as a gap rather
+than old data. That is 10 bytes per slot, about 8.6 KB per series and 35 KB
+per node for the four metrics.
+
+Samples come from `sample_nodes`, a leader job that polls each agent's
+/agent/wg/stats once per interval for the whole fleet and appends the
+answers to node_samples. Every worker runs `pull`, a local job that reads
+the rows past the last id it has seen into its own store, so all workers
+serve the same graphs while each agent is asked once. Rates are computed
+from the rx/tx counter deltas; a counter that went down (peer removed,
+interface reset) gives no sample for that interval.
+
+Each worker writes its store to TIMESERIES_SNAPSHOT.<pid> on shutdown. On
+startup the newest snapshot is read back (they hold the same samples, so
+the newest covers the others) and pulling resumes from the last id it had
+seen, so a restart doesn't blank the graphs. Set it to "" to
+disable.
+"""
+import glob
+import json
+import logging
+import os
+import re
+import time
+from array import array
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.models import node_samples, vpn_servers
+from app.utils import agent_client, fanout, metrics
+
+log = logging.getLogger(__name__)
+
+TIMESERIES_SAMPLE_INTERVAL = float(os.getenv("TIMESERIES_SAMPLE_INTERVAL", "10"))
+TIMESERIES_SNAPSHOT = os.getenv("TIMESERIES_SNAPSHOT", "timeseries.snapshot")
+TIMESERIES_SHARE_RETENTION = float(os.getenv("TIMESERIES_SHARE_RETENTION", "900"))  # seconds kept in node_samples
+
+# (slot seconds, slots): 1h of 10s, 6h of 1m, 24h of 10m
+TIERS: Tuple[Tuple[int, int], ...] = ((10, 360), (60, 360), (600, 144))
+MAX_RETENTION = max(step * size for step, size in TIERS)
+METRICS = ("rx_bytes_per_sec", "tx_bytes_per_sec", "peers", "active_peers")
+
+_MAGIC = b"ARTS1\n"
+_PULL_BATCH = 5000
+
+
+class Ring:
+    """One tier: `size` slots of `step` seconds, each a running sum and count."""
+
+    __slots__ = ("step", "size", "stamps", "sums", "counts")
+
+    def __init__(self, step: int, size: int):
+        self.step = step
+        self.size = size
+        self.stamps = array("i", [-1]) * size  # slot number (t // step) held at each index
+        self.sums = array("f", [0.0]) * size
+        self.counts = array("H", [0]) * size
+
+    def add(self, t: float, value: float) -> None:
+        slot = int(t // self.step)
+        i = slot % self.size
+        if self.stamps[i] != slot:
+            self.stamps[i] = slot
+            self.sums[i] = 0.0
+            self.counts[i] = 0
+        self.sums[i] += value
+        if self.counts[i] < 0xFFFF:
+            self.counts[i] += 1
+
+    def points(self, start: float, end: float) -> List[Tuple[int, Optional[float]]]:
+        out = []
+        for slot in range(int(start // self.step), int(end // self.step) + 1):
+            i = slot % self.size
+            if self.stamps[i] == slot and self.counts[i]:
+                out.append((slot * self.step, round(self.sums[i] / self.counts[i], 3)))
+            else:
+                out.append((slot * self.step, None))
+        return out
+
+    def arrays(self) -> Tuple[array, array, array]:
+        return self.stamps, self.sums, self.counts
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.itemsize * len(a) for a in self.arrays())
+
+
+class Series:
+    __slots__ = ("tiers",)
+
+    def __init__(self):
+        self.tiers = [Ring(step, size) for step, size in TIERS]
+
+    def add(self, t: float, value: float) -> None:
+        for ring in self.tiers:
+            ring.add(t, value)
+
+
+def _tier(start: float, now: float, step: Optional[int] = None) -> int:
+    """The finest tier that still covers `start` and is at least `step` wide."""
+    for i, (width, size) in enumerate(TIERS):
+        if now - start <= width * size and (step is None or width >= step):
+            return i
+    return len(TIERS) - 1
+
+
+_series: Dict[Tuple[int, str], Series] = {}
+# server_id -> (agent clock, rx_bytes, tx_bytes) of the previous sample
+_last: Dict[int, Tuple[float, int, int]] = {}
+# last node_samples id ingested (restored from the snapshot on startup)
+_state: Dict[str, Any] = {"last_id": 0}
+
+
+def record(server_id: int, metric: str, value: float, t: Optional[float] = None) -> None:
+    key = (server_id, metric)
+    series = _series.get(key)
+    if series is None:
+        series = _series[key] = Series()
+    series.add(time.time() if t is None else t, value)
+
+
+def query(
+    server_id: int,
+    names: Iterable[str],
+    start: float,
+    end: float,
+    step: Optional[int] = None,
+) -> Tuple[int, Dict[str, List[Tuple[int, Optional[float]]]]]:
+    """Downsampled points for each metric over [start, end]; None marks a gap.
+
+    All metrics come from the same tier, so their timestamps line up.
+    """
+    tier = _tier(start, time.time(), step)
+    width = TIERS[tier][0]
+    out = {}
+    for name in names:
+        series = _series.get((server_id, name))
+        if series is None:
+            out[name] = [(slot * width, None) for slot in range(int(start // width), int(end // width) + 1)]
+        else:
+            out[name] = series.tiers[tier].points(start, end)
+    return width, out
+
+
+def ingest(server_id: int, stats: Dict[str, Any], t: Optional[float] = None) -> None:
+    """Record one /agent/wg/stats answer for a server."""
+    t = time.time() if t is None else t
+    record(server_id, "peers", stats["peers"], t)
+    record(server_id, "active_peers", stats["active_peers"], t)
+    at = stats.get("at", t)
+    rx, tx = stats["rx_bytes"], stats["tx_bytes"]
+    previous = _last.get(server_id)
+    _last[server_id] = (at, rx, tx)
+    if previous is None:
+        return
+    dt = at - previous[0]
+    if dt <= 0 or rx < previous[1] or tx < previous[2]:
+        return  # clock went backwards or a counter was reset
+    record(server_id, "rx_bytes_per_sec", (rx - previous[1]) / dt, t)
+    record(server_id, "tx_bytes_per_sec", (tx - previous[2]) / dt, t)
+
+
+async def sample_nodes(database) -> int:
+    """Poll every active node's counters once and publish them (a leader job)."""
+    rows = await database.fetch_all(
+        select(vpn_servers.c.id, vpn_servers.c.agent_url).where(vpn_servers.c.is_active == True)  # noqa: E712
+    )
+    # Servers sharing an agent get the same numbers; ask each agent once
+    by_url: Dict[str, List[int]] = defaultdict(list)
+    for r in rows:
+        by_url[r["agent_url"] or agent_client.AGENT_URL].append(r["id"])
+    if not by_url:
+        return 0
+
+    result = await fanout.fan_out(
+        [{"server_id": ids[0], "agent_url": url} for url, ids in by_url.items()],
+        lambda target: agent_client.node_stats(target["agent_url"]),
+        canary=0,
+        timeout=max(1.0, TIMESERIES_SAMPLE_INTERVAL / 2),
+    )
+    now = time.time()
+    samples = []
+    for row in result["results"]:
+        if row["status"] != "ok":
+            metrics.inc("timeseries_sample_failures_total", agent=row["agent_url"])
+            continue
+        stats = row["result"]
+        for server_id in by_url[row["agent_url"]]:
+            samples.append({
+                "server_id": server_id, "sampled_at": now, "agent_at": stats.get("at", now),
+                "peers": stats["peers"], "active_peers": stats["active_peers"],
+                "rx_bytes": stats["rx_bytes"], "tx_bytes": stats["tx_bytes"],
+            })
+    if samples:
+        await database.execute(node_samples.insert().values(samples))
+    await database.execute(node_samples.delete().where(node_samples.c.sampled_at < now - TIMESERIES_SHARE_RETENTION))
+    return len(samples)
+
+
+async def pull(database) -> int:
+    """Ingest the samples published since the last pull (a local job); returns how many."""
+    pulled = 0
+    while True:
+        rows = await database.fetch_all(
+            select(node_samples)
+            .where(node_samples.c.id > _state["last_id"])
+            .order_by(node_samples.c.id)
+            .limit(_PULL_BATCH)
+        )
+        for r in rows:
+            ingest(r["server_id"], {
+                "peers": r["peers"], "active_peers": r["active_peers"], "at": r["agent_at"],
+                "rx_bytes": r["rx_bytes"], "tx_bytes": r["tx_bytes"],
+            }, r["sampled_at"])
+        if rows:
+            _state["last_id"] = rows[-1]["id"]
+        pulled += len(rows)
+        if len(rows) < _PULL_BATCH:
+            return pulled
+
+
+# --- snapshot ---
+
+def _snapshots(path: str) -> List[str]:
+    pattern = re.compile(re.escape(os.path.basename(path)) + r"\.\d+$")
+    return [p for p in glob.glob(f"{glob.escape(path)}.*") if pattern.match(os.path.basename(p))]
+
+
+def save(path: str = TIMESERIES_SNAPSHOT) -> None:
+    """Write the store to `path`.<pid>, atomically, so workers don't overwrite each other."""
+    if not path or not _series:
+        return
+    keys = list(_series)
+    header = {
+        "tiers": TIERS,
+        "itemsizes": [a.itemsize for a in Ring(1, 1).arrays()],
+        "series": keys,
+        "saved_at": time.time(),
+        "last_sample_id": _state["last_id"],
+    }
+    target = f"{path}.{os.getpid()}"
+    tmp = f"{target}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(_MAGIC)
+        fh.write(json.dumps(header).encode() + b"\n")
+        for key in keys:
+            for ring in _series[key].tiers:
+                for a in ring.arrays():
+                    a.tofile(fh)
+    os.replace(tmp, target)
+    log.info("saved %d time series to %s", len(keys), target)
+
+
+def _read(path: str) -> Tuple[Dict[str, Any], Dict[Tuple[int, str], Series]]:
+    with open(path, "rb") as fh:
+        if fh.readline() != _MAGIC:
+            raise ValueError("not a time-series snapshot")
+        header = json.loads(fh.readline())
+        if [tuple(t) for t in header["tiers"]] != list(TIERS) or \
+                header["itemsizes"] != [a.itemsize for a in Ring(1, 1).arrays()]:
+            raise ValueError("another layout")
+        restored = {}
+        for server_id, metric in header["series"]:
+            series = Series()
+            for ring in series.tiers:
+                for a in ring.arrays():
+                    fresh = array(a.typecode)
+                    fresh.fromfile(fh, ring.size)
+                    a[:] = fresh
+            restored[(server_id, metric)] = series
+    return header, restored
+
+
+def load(path: str = TIMESERIES_SNAPSHOT) -> int:
+    """Read the newest snapshot written by `save`; returns how many series were restored.
+
+    Snapshots older than the longest tier are deleted.
+    """
+    if not path:
+        return 0
+    now = time.time()
+    candidates = []
+    for snapshot in _snapshots(path):
+        try:
+            if os.path.getmtime(snapshot) < now - MAX_RETENTION:
+                os.remove(snapshot)
+            else:
+                candidates.append((os.path.getmtime(snapshot), snapshot))
+        except OSError:
+            continue  # another worker removed it
+    for _, snapshot in sorted(candidates, reverse=True):
+        try:
+            header, restored = _read(snapshot)
+        except (OSError, ValueError, EOFError, KeyError) as exc:
+            log.warning("could not load time-series snapshot %s: %s", snapshot, exc)
+            continue
+        _series.update(restored)
+        _state["last_id"] = header.get("last_sample_id", 0)
+        return len(restored)
+    return 0
+
+
+def store_state() -> Dict[str, Any]:
+    return {
+        "series": len(_series),
+        "servers": len({server_id for server_id, _ in _series}),
+        "bytes": sum(ring.nbytes for s in _series.values() for ring in s.tiers),
+        "last_sample_id": _state["last_id"],
+    }
+
+
+def _collect() -> None:
+    state = store_state()
+    metrics.set_gauge("timeseries_series", state["series"])
+    metrics.set_gauge("timeseries_bytes", state["bytes"])
+
+
+metrics.register_collector(_collect)
@@ -0,0 +1,216 @@
+"""Lightweight request tracing, no external collector.
+
+A sampled request gets a trace id (or keeps the one it came in with, in
+X-Trace-Id) and records spans into it: the request itself, pool waits and
+every DB statement, agent calls, bcrypt and QR rendering. Agent calls carry
+X-Trace-Id / X-Parent-Span-Id (or the same fields on channel commands), so
+the agent's own spans join the trace and can be fetched from it later.
+
+Finished traces go to an in-memory ring buffer (TRACE_BUFFER_SIZE traces,
+served by /debug/traces) and, when TRACE_FILE is set, are buffered and
+appended to that file by a writer thread every TRACE_FLUSH_SECONDS, one
+JSON object per line, so no request waits on file I/O.
+
+TRACE_SAMPLE_RATE picks the fraction of requests that are traced. An
+incoming X-Trace-Id forces tracing and is kept only on internal requests
+(carrying the agent shared secret) and only if it looks like one of our ids
+(16-32 hex characters); anything else is ignored, so outside callers can't
+skip sampling or put their own strings into the trace file and agent URLs.
+"""
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import Request
+
+log = logging.getLogger(__name__)
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "500"))
+TRACE_FILE = os.getenv("TRACE_FILE")  # optional JSONL export
+TRACE_FLUSH_SECONDS = float(os.getenv("TRACE_FLUSH_SECONDS", "1"))
+
+TRACE_HEADER = "X-Trace-Id"
+PARENT_HEADER = "X-Parent-Span-Id"
+_ID = re.compile(r"[0-9a-f]{16,32}")
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Dict[str, Any]] = []
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_span_id: ContextVar[Optional[str]] = ContextVar("trace_span_id", default=None)
+_finished: Deque[Dict[str, Any]] = deque(maxlen=TRACE_BUFFER_SIZE)
+_lock = threading.Lock()        # guards _pending and the writer
+_file_lock = threading.Lock()   # keeps batches in order between the writer thread and close()
+_stop = threading.Event()
+_pending: List[str] = []
+_writer: Dict[str, Optional[threading.Thread]] = {"thread": None}
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _trace.get()
+    return trace.trace_id if trace else None
+
+
+def context() -> Optional[Dict[str, str]]:
+    """{"trace_id", "parent_span_id"} for linking a downstream call, or None."""
+    trace = _trace.get()
+    if trace is None:
+        return None
+    return {"trace_id": trace.trace_id, "parent_span_id": _span_id.get() or ""}
+
+
+def propagation() -> Dict[str, str]:
+    """Headers that link a downstream call to the current span ({} if untraced)."""
+    ctx = context()
+    if ctx is None:
+        return {}
+    return {TRACE_HEADER: ctx["trace_id"], PARENT_HEADER: ctx["parent_span_id"]}
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Time a block as a child of the current span; a no-op when not tracing."""
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = _new_id()
+    parent = _span_id.get()
+    token = _span_id.set(span_id)
+    started_at = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as exc:
+        error = exc.__class__.__name__
+        raise
+    finally:
+        _span_id.reset(token)
+        trace.spans.append({
+            "span_id": span_id,
+            "parent_id": parent,
+            "name": name,
+            "service": "backend",
+            "start": started_at,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+            "attrs": attrs,
+            "error": error,
+        })
+
+
+def _export(trace: Trace) -> None:
+    spans = sorted(trace.spans, key=lambda s: s["start"])
+    root = spans[0]  # the request span starts first
+    record = {
+        "trace_id": trace.trace_id,
+        "name": root["name"],
+        "start": root["start"],
+        "duration_ms": root["duration_ms"],
+        "spans": spans,
+    }
+    _finished.append(record)
+    if TRACE_FILE:
+        line = json.dumps(record, default=str) + "\n"
+        with _lock:
+            _pending.append(line)
+            if _writer["thread"] is None and not _stop.is_set():
+                _writer["thread"] = threading.Thread(target=_writer_loop, name="trace-writer", daemon=True)
+                _writer["thread"].start()
+
+
+def flush() -> None:
+    """Append the buffered traces to TRACE_FILE in one write."""
+    with _file_lock:
+        with _lock:
+            lines = _pending[:]
+            _pending.clear()
+        if not lines:
+            return
+        try:
+            with open(TRACE_FILE, "a", encoding="utf-8") as fh:
+                fh.writelines(lines)
+        except OSError:
+            log.exception("could not write %d traces to %s", len(lines), TRACE_FILE)
+
+
+def _writer_loop() -> None:
+    while not _stop.wait(TRACE_FLUSH_SECONDS):
+        flush()
+
+
+def close() -> None:
+    """Stop the writer thread and write what is still buffered."""
+    _stop.set()
+    thread = _writer["thread"]
+    if thread is not None:
+        thread.join(timeout=5)
+    flush()
+
+
+def recent_traces(limit: int = 50) -> List[Dict[str, Any]]:
+    """Newest first, without the span lists."""
+    rows = list(_finished)[-limit:][::-1]
+    return [{k: v for k, v in r.items() if k != "spans"} | {"spans": len(r["spans"])} for r in rows]
+
+
+def get_trace(trace_id: str) -> Optional[Dict[str, Any]]:
+    return next((r for r in reversed(_finished) if r["trace_id"] == trace_id), None)
+
+
+def _internal(request: Request) -> bool:
+    secret = os.getenv("AGENT_SHARED_SECRET")
+    given = request.headers.get("X-Agent-Secret")
+    return bool(secret and given) and hmac.compare_digest(given.encode(), secret.encode())
+
+
+def _valid_id(value: Optional[str]) -> Optional[str]:
+    return value if value and _ID.fullmatch(value) else None
+
+
+async def tracing_middleware(request: Request, call_next):
+    incoming = parent = None
+    if TRACE_HEADER in request.headers and _internal(request):
+        incoming = _valid_id(request.headers.get(TRACE_HEADER))
+        parent = _valid_id(request.headers.get(PARENT_HEADER))
+    if incoming is None and random.random() >= TRACE_SAMPLE_RATE:
+        return await call_next(request)
+
+    trace = Trace(incoming or uuid.uuid4().hex)
+    _trace.set(trace)
+    _span_id.set(parent if incoming else None)
+    status = 500
+    try:
+        with span("http.request", method=request.method, path=request.url.path):
+            response = await call_next(request)
+            status = response.status_code
+    finally:
+        # Name the root span after the matched route template, not the raw path
+        route = request.scope.get("route")
+        root = next(s for s in reversed(trace.spans) if s["name"] == "http.request")
+        root["name"] = f"{request.method} {getattr(route, 'path', request.url.path)}"
+        root["attrs"]["status"] = status
+        _export(trace)
+    response.headers[TRACE_HEADER] = trace.trace_id
+    return response
@@ -0,0 +1,116 @@
+"""Startup warmup that gates readiness.
+
+Heavy dependencies (bcrypt, pyotp, qrcode/PIL, httpx, jose) are imported
+lazily by the code that needs them, so a new worker gets through `import
+app.main` quickly. Warmup then pays those costs once, in the background,
+before the worker reports ready:
+
+  1. prefill the DB pool (min_size connections) and check it with SELECT 1
+  2. import the deferred modules in a thread
+  3. run one JWT encode/decode round so jose's key handling is set up
+  4. probe each known agent once, and give the agent channel a moment to connect
+
+/health/ready answers 503 until warmup has finished. A failing step is
+recorded but does not block readiness forever; the worker can still serve
+what it can and the step's error is shown on /health/ready.
+"""
+import asyncio
+import importlib
+import logging
+import os
+import time
+from typing import Any, Dict, List
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from app.utils import metrics
+
+log = logging.getLogger(__name__)
+
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))  # seconds per step
+WARMUP_MODULES = ("bcrypt", "pyotp", "jose.jwt", "httpx", "qrcode", "PIL.PngImagePlugin")
+
+_state: Dict[str, Any] = {"ready": False, "started_at": None, "duration_ms": None, "steps": []}
+
+
+def is_ready() -> bool:
+    return _state["ready"]
+
+
+def warmup_state() -> Dict[str, Any]:
+    return _state
+
+
+def _import_modules() -> List[str]:
+    missing = []
+    for name in WARMUP_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            missing.append(name)
+    return missing
+
+
+async def _prefill_db(database) -> None:
+    await database.fetch_val(text("SELECT 1"))
+
+
+async def _import_deferred() -> None:
+    missing = await run_in_threadpool(_import_modules)
+    if missing:
+        log.warning("warmup: optional modules not installed: %s", ", ".join(missing))
+
+
+async def _prime_jwt() -> None:
+    from app.auth import _user_from_token, create_access_token
+
+    token = create_access_token({"sub": "warmup"})
+    try:
+        await _user_from_token(token)  # no user_id -> 401 before any DB query
+    except Exception:
+        pass
+
+
+async def _prefill_agents(database, agent_url: str) -> None:
+    import httpx
+
+    from app.utils import agent_health
+    from app.utils.agent_channel import get_channel
+
+    urls = await agent_health.known_agents(database, agent_url)
+    async with httpx.AsyncClient() as client:
+        await asyncio.gather(*(agent_health.check_agent(client, u) for u in urls))
+
+    channel = get_channel(agent_url)
+    while channel is not None and not channel.connected:
+        await asyncio.sleep(0.05)
+
+
+async def run(database, agent_url: str) -> None:
+    """Run every warmup step, then mark the worker ready."""
+    started = time.perf_counter()
+    _state["started_at"] = time.time()
+    steps = (
+        ("db_pool", lambda: _prefill_db(database)),
+        ("imports", _import_deferred),
+        ("jwt", _prime_jwt),
+        ("agents", lambda: _prefill_agents(database, agent_url)),
+    )
+    for name, step in steps:
+        step_started = time.perf_counter()
+        row: Dict[str, Any] = {"name": name, "ok": True}
+        try:
+            await asyncio.wait_for(step(), WARMUP_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            row.update(ok=False, error=str(exc) or exc.__class__.__name__)
+            log.warning("warmup step %s failed: %s", name, row["error"])
+        row["duration_ms"] = round((time.perf_counter() - step_started) * 1000, 1)
+        _state["steps"].append(row)
+
+    _state["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    _state["ready"] = True
+    metrics.set_gauge("warmup_duration_seconds", _state["duration_ms"] / 1000)
+    log.info("warmup finished in %.0f ms", _state["duration_ms"])
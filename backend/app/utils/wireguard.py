@@ -3,25 +3,33 @@ from __future__ import annotations
 
 This module centralizes the small pieces we need to:
 - generate a client keypair (simulation for now),
+- convert addresses and keys between their API form and the compact
+  column form (IPv4 as an int, keys as raw 32 bytes),
 - find the next free /32 tunnel IP on a server,
-- render a client .conf file from DB rows,
+- render a client .conf file from DB rows (via a per-server ConfigTemplate),
+- package it as compact JSON or a gzip bundle for download,
 - encode the config as a QR (data URL) for mobile WireGuard apps.
 
 In Step 4 (real server integration), we'll swap the key generation to use
 real Curve25519 keys and push peers via an agent or SSH.
 """
 import base64
+import hashlib
 import io
 import os
 import re
 import secrets
-from ipaddress import ip_network, ip_address
-from typing import Optional, Tuple, Iterable, Set
+import socket
+import tarfile
+import time
+from ipaddress import IPv4Address, ip_network, ip_address
+from typing import Any, Dict, List, Optional, Tuple, Iterable, Set
 
 from databases import Database
 from sqlalchemy import select
 
 from app.models import wg_allocations, vpn_servers
+from app.utils import tracing
 
 
 # -----------------------------
@@ -50,6 +58,35 @@ def generate_keypair() -> Tuple[str, str]:
     return priv, pub
 
 
+# -----------------------------
+# Compact column encodings
+# -----------------------------
+
+def ip_to_int(address: str) -> int:
+    """"10.8.0.10" or "10.8.0.10/32" -> 168296458 (wg_allocations.client_addr)."""
+    return int(IPv4Address(address.split("/", 1)[0].strip()))
+
+
+def int_to_ip(value: int) -> str:
+    """168296458 -> "10.8.0.10"."""
+    return socket.inet_ntoa(value.to_bytes(4, "big"))
+
+
+def key_to_bytes(key: str) -> bytes:
+    """Base64 WireGuard key -> its raw 32 bytes; ValueError if it isn't one."""
+    try:
+        raw = base64.b64decode(key, validate=True)
+    except (ValueError, TypeError) as exc:
+        raise ValueError("WireGuard key is not valid base64") from exc
+    if len(raw) != 32:
+        raise ValueError("WireGuard key must decode to 32 bytes")
+    return raw
+
+
+def bytes_to_key(raw: bytes) -> str:
+    return base64.standard_b64encode(raw).decode("ascii")
+
+
 # ----------------------------------
 # IP allocation (10.8.0.0/24 by default)
 # ----------------------------------
@@ -71,31 +108,23 @@ async def next_free_ip(
     Returns the IP *with* "/32" suffix (WireGuard Address format), e.g. "10.8.0.10/32".
     Raises RuntimeError if no free address is available.
     """
-    # Fetch allocated IPs for this server (only active allocations)
+    net = ip_network(base_cidr)
+    first = int(net.network_address) + start_host_index
+    last = int(net.broadcast_address) - 1  # hosts only, like net.hosts()
+
+    # Taken addresses in this subnet (only active allocations): a range scan
+    # on the (server_id, client_addr) unique index
     query = (
-        select(wg_allocations.c.client_ip)
+        select(wg_allocations.c.client_addr)
         .where(wg_allocations.c.server_id == server_id)
+        .where(wg_allocations.c.client_addr.between(first, last))
         .where(wg_allocations.c.revoked_at.is_(None))
     )
-    rows = await database.fetch_all(query)
+    taken: Set[int] = {r[0] for r in await database.fetch_all(query)}
 
-    # Normalize to bare IP strings (strip optional /32)
-    taken: Set[str] = set()
-    for r in rows:
-        ip_str = str(r[0])
-        if "/" in ip_str:
-            ip_str = ip_str.split("/", 1)[0]
-        taken.add(ip_str)
-
-    net = ip_network(base_cidr)
-
-    # Iterate hosts, skip the first (start_host_index-1) hosts
-    for idx, host in enumerate(net.hosts(), start=1):
-        if idx < start_host_index:
-            continue
-        candidate = str(host)
+    for candidate in range(first, last + 1):
         if candidate not in taken:
-            return f"{candidate}/32"
+            return f"{int_to_ip(candidate)}/32"
 
     raise RuntimeError("No free WireGuard client IPs available in this subnet")
 
@@ -107,51 +136,133 @@ async def next_free_ip(
 _DEF_ALLOWED = "0.0.0.0/0, ::/0"
 
 
+def _split(value: Optional[str]) -> List[str]:
+    return [v.strip() for v in (value or "").split(",") if v.strip()]
+
+
+class ConfigTemplate:
+    """A server's half of every client config, compiled once.
+
+    Everything that comes from the server row is baked into two string
+    pieces; rendering a client config is then a handful of concatenations
+    around the client key, address and endpoint. Build one per server with
+    `compile_template` and rebuild it when the server row changes.
+    """
+    __slots__ = (
+        "public_key", "endpoint", "allowed_ips", "dns", "persistent_keepalive",
+        "etag", "_interface_tail", "_peer_head", "_peer_tail",
+    )
+
+    def __init__(self, server_row: dict, persistent_keepalive: int = 25):
+        self.public_key = bytes_to_key(server_row["wg_key"]) if server_row.get("wg_key") else None
+        self.endpoint = server_row.get("wg_endpoint")
+        if not self.public_key or not self.endpoint:
+            raise ValueError("Server is missing WireGuard configuration (public key/endpoint)")
+        allowed = server_row.get("wg_allowed_ips") or _DEF_ALLOWED
+        dns = server_row.get("wg_dns")
+        self.allowed_ips = _split(allowed)
+        self.dns = _split(dns)
+        self.persistent_keepalive = persistent_keepalive
+
+        self._interface_tail = (f"\nDNS = {dns}" if dns else "") + "\n\n[Peer]\n"
+        self._peer_head = f"PublicKey = {self.public_key}\nAllowedIPs = {allowed}\nEndpoint = "
+        self._peer_tail = f"\nPersistentKeepalive = {persistent_keepalive}\n" if persistent_keepalive else "\n"
+        fingerprint = "|".join([self.public_key, self.endpoint, allowed, dns or "", str(persistent_keepalive)])
+        self.etag = '"' + hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16] + '"'
+
+    def render(self, client_private_key: str, client_ip_with_prefix: str, endpoint: Optional[str] = None) -> str:
+        return (
+            "[Interface]\nPrivateKey = " + client_private_key
+            + "\nAddress = " + client_ip_with_prefix
+            + self._interface_tail
+            + self._peer_head + (endpoint or self.endpoint) + self._peer_tail
+        )
+
+    def peer(self, endpoint: Optional[str] = None) -> Dict[str, Any]:
+        """The server side of the config: what clients with their own keys need."""
+        return {
+            "public_key": self.public_key,
+            "endpoint": endpoint or self.endpoint,
+            "allowed_ips": self.allowed_ips,
+            "persistent_keepalive": self.persistent_keepalive or None,
+        }
+
+    def compact(self, client_private_key: str, client_ip_with_prefix: str, endpoint: Optional[str] = None) -> Dict[str, Any]:
+        """Structured form of `render` for mobile clients that build the tunnel themselves."""
+        return {
+            "v": 1,
+            "interface": {"private_key": client_private_key, "address": client_ip_with_prefix, "dns": self.dns},
+            "peer": self.peer(endpoint),
+        }
+
+
+def compile_template(server_row: dict, persistent_keepalive: int = 25) -> ConfigTemplate:
+    return ConfigTemplate(server_row, persistent_keepalive)
+
+
 def render_client_config(
     server_row: dict,
     client_private_key: str,
     client_ip_with_prefix: str,
     persistent_keepalive: int = 25,
+    endpoint: Optional[str] = None,
 ) -> str:
     """Build a WireGuard client .conf text using server fields and client keys.
 
     server_row is expected to expose keys:
-      - wg_public_key (required)
+      - wg_key (required; raw 32 bytes)
       - wg_endpoint (required)
       - wg_allowed_ips (optional; defaults to full-tunnel)
       - wg_dns (optional)
+
+    `endpoint` overrides wg_endpoint, e.g. when the agent placed the peer on a
+    shard listening on a different port (see `shard_endpoint`). Hot paths
+    should keep a compiled template instead of calling this per request.
+    """
+    return compile_template(server_row, persistent_keepalive).render(
+        client_private_key, client_ip_with_prefix, endpoint
+    )
+
+
+def config_bundle(name: str, config_text: str, qr_png: Optional[bytes] = None) -> bytes:
+    """A .tar.gz holding `<name>.conf` and, when given, `<name>.png` (the QR)."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for filename, data in ((f"{name}.conf", config_text.encode("utf-8")), (f"{name}.png", qr_png)):
+            if data is None:
+                continue
+            info = tarfile.TarInfo(filename)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o600
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def shard_endpoint(server_endpoint: str, shard: Optional[dict]) -> str:
+    """Return the Endpoint a client should dial for the given agent shard.
+
+    Prefers the shard's own "host:port"; otherwise keeps the server host and
+    swaps in the shard's listen port. Without a shard the server endpoint is
+    returned unchanged.
     """
-    pubkey = server_row.get("wg_public_key")
-    endpoint = server_row.get("wg_endpoint")
-    allowed = server_row.get("wg_allowed_ips") or _DEF_ALLOWED
-    dns = server_row.get("wg_dns")
-
-    if not pubkey or not endpoint:
-        raise ValueError("Server is missing WireGuard configuration (public key/endpoint)")
-
-    lines = []
-    lines.append("[Interface]")
-    lines.append(f"PrivateKey = {client_private_key}")
-    lines.append(f"Address = {client_ip_with_prefix}")
-    if dns:
-        lines.append(f"DNS = {dns}")
-    lines.append("")
-    lines.append("[Peer]")
-    lines.append(f"PublicKey = {pubkey}")
-    lines.append(f"AllowedIPs = {allowed}")
-    lines.append(f"Endpoint = {endpoint}")
-    if persistent_keepalive:
-        lines.append(f"PersistentKeepalive = {persistent_keepalive}")
-
-    return "\n".join(lines) + "\n"
+    if not shard:
+        return server_endpoint
+    if shard.get("endpoint"):
+        return shard["endpoint"]
+    port = shard.get("listen_port")
+    if not port:
+        return server_endpoint
+    host = server_endpoint.rsplit(":", 1)[0] if ":" in server_endpoint else server_endpoint
+    return f"{host}:{port}"
 
 
 # ----------------------------------
 # QR generation (data URL)
 # ----------------------------------
 
-def config_to_qr_data_url(config_text: str) -> str:
-    """Return a data URL PNG QR for the given config text.
+def config_to_qr_png(config_text: str) -> bytes:
+    """Return a PNG QR code for the given config text.
 
     Requires the `qrcode` package with PIL backend: `pip install qrcode[pil]`.
     If the dependency is missing, we raise a clear error so the route can handle it.
@@ -163,8 +274,14 @@ def config_to_qr_data_url(config_text: str) -> str:
             "QR generation requires the 'qrcode[pil]' package. Install with: pip install qrcode[pil]"
         ) from exc
 
-    img = qrcode.make(config_text)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-    return f"data:image/png;base64,{b64}"
\ No newline at end of file
+    with tracing.span("qr.render", chars=len(config_text)):
+        img = qrcode.make(config_text)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def config_to_qr_data_url(config_text: str) -> str:
+    """Return a data URL PNG QR for the given config text (see `config_to_qr_png`)."""
+    b64 = base64.b64encode(config_to_qr_png(config_text)).decode("ascii")
+    return f"data:image/png;base64,{b64}"
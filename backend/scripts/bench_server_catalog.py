@@ -0,0 +1,107 @@
+"""Benchmark: server catalog response size and serialization time.
+
+Builds a synthetic catalog (N servers over a few dozen countries) and
+compares, per request:
+
+  before   every active server through response_model (pydantic validation
+           + jsonable_encoder + json.dumps), what GET /servers used to do
+  full     the same rows through app/utils/catalog.py (no filters)
+  country  ?country=<one country>
+  page     ?limit=100 (first page)
+  sparse   ?fields=id,name,country
+
+Run from backend/:
+    python -m scripts.bench_server_catalog --servers 5000 --repeat 50
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+for _var in ("DB_USER", "DB_PASSWORD", "DB_HOST", "DB_NAME"):
+    os.environ.setdefault(_var, "bench")
+os.environ.setdefault("DB_PORT", "3306")
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+from app.schemas import VPNServerOut  # noqa: E402
+from app.utils import catalog  # noqa: E402
+
+COUNTRIES = [f"Country{i:02d}" for i in range(40)]
+_ADAPTER = TypeAdapter(List[VPNServerOut])
+
+
+def make_rows(n: int) -> List[dict]:
+    return [
+        {
+            "id": i,
+            "name": f"node-{i:05d}",
+            "country": COUNTRIES[i % len(COUNTRIES)],
+            "ip_address": f"198.51.{i // 250}.{i % 250 + 1}",
+            "config_path": f"/etc/wireguard/node-{i}.conf",
+            "is_active": 1 if i % 10 else 0,
+            "wg_key": bytes(32),
+            "wg_endpoint": f"198.51.{i // 250}.{i % 250 + 1}:51820",
+            "wg_allowed_ips": "0.0.0.0/0, ::/0",
+            "wg_dns": "1.1.1.1",
+            "agent_url": f"http://10.0.{i // 250}.{i % 250 + 1}:8001",
+            "capacity": 250 + (i % 4) * 250,
+        }
+        for i in range(1, n + 1)
+    ]
+
+
+def _state(row: dict) -> str:
+    return "closed"
+
+
+def before(rows: List[dict]) -> bytes:
+    active = [{**r, "agent_state": _state(r)} for r in rows if r["is_active"]]
+    validated = _ADAPTER.validate_python(active)
+    # Starlette's JSONResponse encoding
+    return json.dumps(jsonable_encoder(validated), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def after(rows: List[dict], country=None, limit=None, fields=None) -> bytes:
+    matched = catalog.filter_servers(rows, countries=[country] if country else None, is_active=True)
+    matched, _ = catalog.page(matched, None, limit)
+    return catalog.dumps(catalog.project(matched, catalog.parse_fields(fields), _state))
+
+
+def timeit(fn, repeat: int):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return body, statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    rows = make_rows(args.servers)
+    cases = {
+        "before": lambda: before(rows),
+        "full": lambda: after(rows),
+        "country": lambda: after(rows, country=COUNTRIES[3]),
+        "page": lambda: after(rows, limit=100),
+        "sparse": lambda: after(rows, fields="id,name,country"),
+    }
+    print(f"{args.servers} servers, encoder: {'orjson' if catalog.orjson else 'json'}")
+    print(f"{'case':<10}{'bytes':>12}{'median ms':>12}")
+    for name, fn in cases.items():
+        body, ms = timeit(fn, args.repeat)
+        print(f"{name:<10}{len(body):>12,}{ms:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark: direct session writes vs the write-behind buffer.
+
+Simulates a reconnect storm (every user disconnects, then reconnects) and
+counts the statements each strategy sends to the database. The database is
+a stand-in that charges a fixed latency per statement, which is what
+dominates tiny single-row transactions on a real MySQL.
+
+Run from backend/:
+    python -m scripts.bench_session_buffer --users 5000 --latency-ms 1
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+for _var in ("DB_USER", "DB_PASSWORD", "DB_HOST", "DB_NAME"):
+    os.environ.setdefault(_var, "bench")
+os.environ.setdefault("DB_PORT", "3306")
+
+from app.models import connections  # noqa: E402
+from app.utils.session_buffer import SessionWriteBuffer  # noqa: E402
+
+
+class CountingDatabase:
+    """Accepts statements, sleeps `latency` per statement and counts them."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.statements = 0
+
+    async def execute(self, query, values=None):
+        self.statements += 1
+        await asyncio.sleep(self.latency)
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+async def run_direct(users: int, concurrency: int, latency: float) -> dict:
+    db = CountingDatabase(latency)
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(user_id: int):
+        async with sem:
+            await db.execute(connections.update().where(connections.c.user_id == user_id))
+            await db.execute(connections.insert().values(user_id=user_id, server_id=1))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in range(users)))
+    return {"statements": db.statements, "seconds": time.perf_counter() - started}
+
+
+async def run_buffered(users: int, latency: float, flush_size: int, flush_interval: float) -> dict:
+    db = CountingDatabase(latency)
+    buf = SessionWriteBuffer(db, flush_size=flush_size, flush_interval=flush_interval)
+    buf.start()
+    started = time.perf_counter()
+    for u in range(users):
+        buf.disconnect(u)
+        buf.connect(u, 1)
+        if u % 100 == 0:
+            await asyncio.sleep(0)  # let the flusher run, like a live event loop would
+    await buf.close()
+    return {"statements": db.statements, "seconds": time.perf_counter() - started}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="per-statement DB latency")
+    parser.add_argument("--concurrency", type=int, default=20, help="DB connections for the direct path")
+    parser.add_argument("--flush-size", type=int, default=500)
+    parser.add_argument("--flush-interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    events = args.users * 2
+    direct = asyncio.run(run_direct(args.users, args.concurrency, latency))
+    buffered = asyncio.run(run_buffered(args.users, latency, args.flush_size, args.flush_interval))
+
+    print(f"{events} session events ({args.users} users reconnecting), {args.latency_ms} ms/statement")
+    print(f"{'strategy':<12}{'statements':>12}{'seconds':>10}{'stmts/s':>12}{'events/s':>12}")
+    for name, r in (("direct", direct), ("buffered", buffered)):
+        print(
+            f"{name:<12}{r['statements']:>12}{r['seconds']:>10.3f}"
+            f"{r['statements'] / r['seconds']:>12.0f}{events / r['seconds']:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
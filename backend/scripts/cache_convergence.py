@@ -0,0 +1,127 @@
+"""Check that per-worker caches converge after a write.
+
+Starts several worker processes, each with its own database connection and
+an invalidation poller (app/utils/invalidation.py) like a uvicorn worker
+has. Every worker fills a "convergence_probe" cache entry, then this
+process publishes invalidations through the database and measures how long
+each worker takes to drop its entry. Exits 1 if any worker is slower than
+--bound seconds (or never converges).
+
+Run from backend/ with the usual DB_* environment, against a database that
+has the cache_invalidations table:
+    python -m scripts.cache_convergence --workers 4 --rounds 5 --bound 2.5
+"""
+import argparse
+import asyncio
+import multiprocessing as mp
+import statistics
+import sys
+import time
+
+NAMESPACE = "convergence_probe"
+
+
+def _worker(index: int, interval: float, events: "mp.Queue", commands: "mp.Queue") -> None:
+    async def main():
+        from app.database import database
+        from app.utils import invalidation
+
+        await database.connect()
+        probe = invalidation.cache(NAMESPACE, ttl=3600)  # only invalidation may clear it
+        poller = asyncio.create_task(invalidation.poll_forever(database, interval=interval))
+        while invalidation.invalidation_state()["last_id"] is None:
+            await asyncio.sleep(0.01)
+        events.put(("ready", index, None))
+
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await loop.run_in_executor(None, commands.get)
+            if command == "stop":
+                break
+            probe.set("value", command)
+            events.put(("filled", index, command))
+            while probe.get("value") is not None:
+                await asyncio.sleep(0.005)
+            events.put(("dropped", index, time.time()))
+
+        poller.cancel()
+        await database.disconnect()
+
+    asyncio.run(main())
+
+
+async def _publish() -> float:
+    from app.database import database
+    from app.utils import invalidation
+
+    await database.connect()
+    try:
+        await invalidation.publish(database, NAMESPACE, "value")
+        return time.time()
+    finally:
+        await database.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--interval", type=float, default=1.0, help="poll interval per worker (seconds)")
+    parser.add_argument("--bound", type=float, default=2.5, help="max seconds from commit to convergence")
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    events = ctx.Queue()
+    commands = [ctx.Queue() for _ in range(args.workers)]
+    procs = [
+        ctx.Process(target=_worker, args=(i, args.interval, events, commands[i]), daemon=True)
+        for i in range(args.workers)
+    ]
+    for p in procs:
+        p.start()
+
+    def wait_for(kind: str, timeout: float) -> dict:
+        seen, deadline = {}, time.monotonic() + timeout
+        while len(seen) < args.workers:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                event, index, value = events.get(timeout=remaining)
+            except Exception:
+                break
+            if event == kind:
+                seen[index] = value
+        return seen
+
+    if len(wait_for("ready", 30)) < args.workers:
+        sys.exit("workers did not start; is the database reachable?")
+
+    lags, failed = [], False
+    for round_no in range(1, args.rounds + 1):
+        for q in commands:
+            q.put(round_no)
+        wait_for("filled", 10)
+        published_at = asyncio.run(_publish())
+        dropped = wait_for("dropped", args.bound * 4)
+        round_lags = [dropped[i] - published_at for i in sorted(dropped)]
+        lags.extend(round_lags)
+        slow = len(dropped) < args.workers or max(round_lags) > args.bound
+        failed |= slow
+        print(
+            f"round {round_no}: {len(dropped)}/{args.workers} converged, "
+            f"max {max(round_lags, default=float('nan')):.3f}s{'  SLOW' if slow else ''}"
+        )
+
+    for q in commands:
+        q.put("stop")
+    for p in procs:
+        p.join(timeout=5)
+
+    if lags:
+        print(f"lag p50 {statistics.median(lags):.3f}s  max {max(lags):.3f}s  bound {args.bound}s")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
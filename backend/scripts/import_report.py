@@ -0,0 +1,99 @@
+"""Import-time report for the backend (or agent) app module.
+
+Runs `python -X importtime -c "import app.main"` in a fresh interpreter and
+prints the slowest imports by cumulative time. With --budget-ms the script
+exits 1 when the total goes over budget, and it always exits 1 when one of
+the modules that are supposed to load lazily shows up at import time, so it
+can run in CI to catch startup regressions.
+
+Run from backend/:
+    python -m scripts.import_report --top 25 --budget-ms 1500
+    python -m scripts.import_report --app-dir ../agent --no-forbid
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# Loaded by request handlers / warmup, never by `import app.main`
+DEFERRED = ("bcrypt", "pyotp", "qrcode", "PIL", "httpx", "jose")
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure(app_dir: str, module: str):
+    env = dict(os.environ)
+    for var in ("DB_USER", "DB_PASSWORD", "DB_HOST", "DB_NAME", "AGENT_SHARED_SECRET"):
+        env.setdefault(var, "report")
+    env.setdefault("DB_PORT", "3306")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=app_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit(f"importing {module} failed")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if m:
+            self_us, cumulative_us, indent, name = m.groups()
+            rows.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return rows
+
+
+def imported_by(rows):
+    """Yield (module, parent) pairs. -X importtime lists children before their parent."""
+    for i, (name, _, _, depth) in enumerate(rows):
+        parent = next((r[0] for r in rows[i + 1:] if r[3] < depth), "<main>")
+        yield name, parent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", default=os.path.join(os.path.dirname(__file__), ".."))
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--budget-ms", type=float, help="fail if the total import time exceeds this")
+    parser.add_argument("--no-forbid", action="store_true", help="don't check for deferred modules")
+    args = parser.parse_args()
+
+    rows = measure(args.app_dir, args.module)
+    total_ms = next((cum for name, _, cum, depth in rows if name == args.module and depth == 0), 0) / 1000
+
+    # Largest cumulative time per top-level package, so submodules aren't counted twice
+    root = args.module.split(".")[0]
+    packages = {}
+    for name, _, cum, _ in rows:
+        top = name.split(".")[0]
+        if top != root:
+            packages[top] = max(packages.get(top, 0), cum)
+
+    print(f"import {args.module}: {total_ms:.1f} ms ({len(rows)} modules)")
+    print(f"{'cumulative ms':>14}  module")
+    for top, cum in sorted(packages.items(), key=lambda kv: -kv[1])[: args.top]:
+        print(f"{cum / 1000:>14.1f}  {top}")
+
+    failed = False
+    if not args.no_forbid:
+        loaded = sorted(
+            f"{name} (from {parent})"
+            for name, parent in imported_by(rows)
+            if name in DEFERRED and parent.split(".")[0] == root
+        )
+        if loaded:
+            print(f"FAIL: app imports deferred modules at startup: {', '.join(loaded)}")
+            failed = True
+    if args.budget_ms is not None and total_ms > args.budget_ms:
+        print(f"FAIL: {total_ms:.1f} ms exceeds budget of {args.budget_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
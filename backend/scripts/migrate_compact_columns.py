@@ -0,0 +1,200 @@
+"""Move WireGuard addresses and keys to compact columns.
+
+wg_allocations.client_ip ("10.8.0.10/32") becomes client_addr INT UNSIGNED,
+wg_allocations.client_public_key (base64) becomes client_key BINARY(32)
+with a unique index, and vpn_servers.wg_public_key becomes wg_key
+BINARY(32). The API still speaks dotted addresses and base64 keys; the
+conversion happens in app/utils/wireguard.py.
+
+Runs in two phases so a deploy can go: migrate, roll out the new backend,
+then drop the old columns once nothing reads them:
+
+  1. (default) add the new columns, backfill them in batches with
+     INET_ATON / FROM_BASE64, check every row converted and no key is
+     duplicated, then make them NOT NULL, add the new unique indexes and
+     make the old columns nullable (the new code no longer writes them)
+  2. --drop-legacy: drop the old columns and their unique index
+
+Config generation on a backend older than this change fails between phase
+1 and its rollout (it doesn't fill the new NOT NULL columns), so run phase
+1 as part of the deploy.
+
+Every step checks information_schema first, so re-running is safe, and a
+batch only touches rows that aren't converted yet. The backfill walks the
+table once by id, so rows MySQL can't convert (a malformed address or key)
+are left NULL and listed by the check that follows instead of retried.
+
+Run from backend/ with the usual DB_* settings:
+    python -m scripts.migrate_compact_columns --dry-run
+    python -m scripts.migrate_compact_columns
+    python -m scripts.migrate_compact_columns --drop-legacy
+"""
+import argparse
+import os
+import sys
+import time
+
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.database import get_sync_engine  # noqa: E402
+
+
+class Migration:
+    def __init__(self, conn, dry_run: bool):
+        self.conn = conn
+        self.dry_run = dry_run
+
+    def _scalar(self, sql: str, **params):
+        return self.conn.execute(text(sql), params).scalar()
+
+    def has_column(self, table: str, column: str) -> bool:
+        return bool(self._scalar(
+            "SELECT COUNT(*) FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = :t AND column_name = :c",
+            t=table, c=column,
+        ))
+
+    def is_nullable(self, table: str, column: str) -> bool:
+        return self._scalar(
+            "SELECT is_nullable FROM information_schema.columns "
+            "WHERE table_schema = DATABASE() AND table_name = :t AND column_name = :c",
+            t=table, c=column,
+        ) == "YES"
+
+    def has_index(self, table: str, index: str) -> bool:
+        return bool(self._scalar(
+            "SELECT COUNT(*) FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND table_name = :t AND index_name = :i",
+            t=table, i=index,
+        ))
+
+    def run(self, sql: str, **params) -> int:
+        print(("[dry-run] " if self.dry_run else "") + sql)
+        if self.dry_run:
+            return 0
+        result = self.conn.execute(text(sql), params)
+        self.conn.commit()
+        return result.rowcount
+
+    def backfill(self, table: str, assignments: str, pending: str, batch: int) -> None:
+        """UPDATE pending rows in id ranges of `batch` so no lock is held long.
+
+        Each range is visited once: a row the assignments leave pending is
+        not retried, so the loop ends however many rows fail to convert.
+        """
+        if self.dry_run:
+            print(f"[dry-run] UPDATE {table} SET {assignments} WHERE {pending} (id ranges of {batch})")
+            return
+        total, started = 0, time.perf_counter()
+        last_id = self._scalar(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+        cursor = self._scalar(f"SELECT COALESCE(MIN(id) - 1, 0) FROM {table} WHERE {pending}")
+        while cursor < last_id:
+            result = self.conn.execute(
+                text(f"UPDATE {table} SET {assignments} WHERE id > :lo AND id <= :hi AND ({pending})"),
+                {"lo": cursor, "hi": cursor + batch},
+            )
+            self.conn.commit()
+            total += result.rowcount
+            cursor += batch
+        print(f"backfilled {total} {table} rows in {time.perf_counter() - started:.1f}s")
+
+    def check(self, label: str, sql: str) -> None:
+        if self.dry_run:
+            return
+        bad = self.conn.execute(text(sql)).fetchall()
+        if bad:
+            print(f"{label}: {len(bad)} row(s), e.g. {[tuple(r) for r in bad[:5]]}")
+            raise SystemExit("fix these rows and re-run; nothing past the backfill was applied")
+
+
+def expand(m: Migration, batch: int) -> None:
+    # 1) new columns, nullable until the backfill is done
+    if not m.has_column("wg_allocations", "client_addr"):
+        m.run("ALTER TABLE wg_allocations ADD COLUMN client_addr INT UNSIGNED NULL AFTER server_id, "
+              "ADD COLUMN client_key BINARY(32) NULL AFTER client_addr")
+    if not m.has_column("vpn_servers", "wg_key"):
+        m.run("ALTER TABLE vpn_servers ADD COLUMN wg_key BINARY(32) NULL AFTER is_active")
+
+    # 2) backfill from the string columns (converted by MySQL, not per row in Python)
+    if m.has_column("wg_allocations", "client_ip"):
+        m.backfill(
+            "wg_allocations",
+            "client_addr = INET_ATON(SUBSTRING_INDEX(TRIM(client_ip), '/', 1)), client_key = FROM_BASE64(client_public_key)",
+            "client_addr IS NULL OR client_key IS NULL",
+            batch,
+        )
+        m.check(
+            "allocations that didn't convert",
+            "SELECT id, client_ip, client_public_key FROM wg_allocations "
+            "WHERE client_addr IS NULL OR client_key IS NULL OR LENGTH(client_key) != 32 LIMIT 100",
+        )
+    if m.has_column("vpn_servers", "wg_public_key"):
+        m.backfill("vpn_servers", "wg_key = FROM_BASE64(wg_public_key)",
+                   "wg_key IS NULL AND wg_public_key IS NOT NULL", batch)
+        m.check(
+            "servers whose key didn't convert",
+            "SELECT id, wg_public_key FROM vpn_servers WHERE wg_public_key IS NOT NULL "
+            "AND (wg_key IS NULL OR LENGTH(wg_key) != 32)",
+        )
+    m.check(
+        "public keys used by more than one allocation",
+        "SELECT HEX(client_key), COUNT(*) FROM wg_allocations GROUP BY client_key HAVING COUNT(*) > 1 LIMIT 100",
+    )
+
+    # 3) constraints on the new columns
+    if m.dry_run or m.is_nullable("wg_allocations", "client_addr"):
+        m.run("ALTER TABLE wg_allocations MODIFY client_addr INT UNSIGNED NOT NULL, MODIFY client_key BINARY(32) NOT NULL")
+    if not m.has_index("wg_allocations", "uq_wg_alloc_server_addr"):
+        m.run("ALTER TABLE wg_allocations ADD UNIQUE INDEX uq_wg_alloc_server_addr (server_id, client_addr)")
+    if not m.has_index("wg_allocations", "uq_wg_alloc_client_key"):
+        m.run("ALTER TABLE wg_allocations ADD UNIQUE INDEX uq_wg_alloc_client_key (client_key)")
+
+    # 4) the new backend doesn't write the old columns
+    if m.has_column("wg_allocations", "client_ip") and not m.is_nullable("wg_allocations", "client_ip"):
+        m.run("ALTER TABLE wg_allocations MODIFY client_ip VARCHAR(32) NULL, MODIFY client_public_key VARCHAR(64) NULL")
+
+
+def contract(m: Migration) -> None:
+    if not m.has_index("wg_allocations", "uq_wg_alloc_client_key"):
+        raise SystemExit("run the migration without --drop-legacy first")
+    if m.has_index("wg_allocations", "uq_wg_alloc_server_ip"):
+        m.run("ALTER TABLE wg_allocations DROP INDEX uq_wg_alloc_server_ip")
+    if m.has_column("wg_allocations", "client_ip"):
+        m.run("ALTER TABLE wg_allocations DROP COLUMN client_ip, DROP COLUMN client_public_key")
+    if m.has_column("vpn_servers", "wg_public_key"):
+        m.run("ALTER TABLE vpn_servers DROP COLUMN wg_public_key")
+
+
+def report(m: Migration) -> None:
+    rows = m.conn.execute(text(
+        "SELECT index_name, ROUND(stat_value * @@innodb_page_size / 1024) AS kb "
+        "FROM mysql.innodb_index_stats WHERE database_name = DATABASE() "
+        "AND table_name = 'wg_allocations' AND stat_name = 'size' ORDER BY index_name"
+    )).fetchall()
+    for name, kb in rows:
+        print(f"  {name:<28}{kb:>10} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drop-legacy", action="store_true", help="phase 2: drop the old string columns")
+    parser.add_argument("--batch", type=int, default=5000, help="rows per backfill UPDATE")
+    parser.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    args = parser.parse_args()
+
+    with get_sync_engine().connect() as conn:
+        m = Migration(conn, args.dry_run)
+        if args.drop_legacy:
+            contract(m)
+        else:
+            expand(m, args.batch)
+        if not args.dry_run:
+            m.run("ANALYZE TABLE wg_allocations")
+            print("wg_allocations index sizes:")
+            report(m)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Schema for the usage rollups (app/utils/rollups.py).
+
+Creates usage_server_hourly, usage_server_daily and usage_user_daily, and
+gives `connections` the two columns the rollup job and the archiver need:
+
+  - updated_at DATETIME, set on insert and bumped by the backend on every
+    write (existing rows get the time of the migration)
+  - rolled_up TINYINT(1), set once a closed session has been counted, with
+    idx_connections_rollup (rolled_up, id) for the job's scan
+
+Run it before rolling out the backend that has the rollup job. Every step
+checks information_schema first, so re-running is safe.
+
+Run from backend/ with the usual DB_* settings:
+    python -m scripts.migrate_usage_rollups --dry-run
+    python -m scripts.migrate_usage_rollups
+"""
+import argparse
+import os
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.database import get_sync_engine  # noqa: E402
+from app.models import usage_server_daily, usage_server_hourly, usage_user_daily  # noqa: E402
+
+ROLLUP_TABLES = (usage_server_hourly, usage_server_daily, usage_user_daily)
+
+
+def has_table(conn, table: str) -> bool:
+    return bool(conn.execute(text(
+        "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = :t"
+    ), {"t": table}).scalar())
+
+
+def has_column(conn, table: str, column: str) -> bool:
+    return bool(conn.execute(text(
+        "SELECT COUNT(*) FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = :t AND column_name = :c"
+    ), {"t": table, "c": column}).scalar())
+
+
+def run(conn, sql: str, dry_run: bool) -> None:
+    print(("[dry-run] " if dry_run else "") + sql)
+    if not dry_run:
+        conn.execute(text(sql))
+        conn.commit()
+
+
+def migrate(conn, dry_run: bool) -> None:
+    # 1) rollup tables
+    for table in ROLLUP_TABLES:
+        if not has_table(conn, table.name):
+            run(conn, str(CreateTable(table).compile(dialect=conn.dialect)).strip(), dry_run)
+
+    # 2) connections columns
+    if not has_column(conn, "connections", "updated_at"):
+        run(conn, "ALTER TABLE connections ADD COLUMN updated_at DATETIME NULL DEFAULT CURRENT_TIMESTAMP", dry_run)
+    if not has_column(conn, "connections", "rolled_up"):
+        run(conn, "ALTER TABLE connections ADD COLUMN rolled_up TINYINT(1) NOT NULL DEFAULT 0, "
+                  "ADD INDEX idx_connections_rollup (rolled_up, id)", dry_run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="print the statements without running them")
+    args = parser.parse_args()
+
+    with get_sync_engine().connect() as conn:
+        migrate(conn, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""What the sampling profiler costs the code it profiles.
+
+Pegs the event loop with `next_free_ip` on a large, nearly full subnet (the
+database is a stand-in that reports every address but the last as taken)
+and times it with and without a profile running from a worker thread, the
+way /debug/profile takes one, then prints the top functions. That the
+profiler finds this hotspot is checked by tests/test_profiler.py.
+
+Run from backend/:
+    python -m scripts.profile_check --cidr 10.0.0.0/12 --seconds 3 --rate 200
+    python -m scripts.profile_check --out hot.folded   # then: flamegraph.pl hot.folded > hot.svg
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from ipaddress import ip_network
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+for _var in ("DB_USER", "DB_PASSWORD", "DB_HOST", "DB_NAME"):
+    os.environ.setdefault(_var, "bench")
+os.environ.setdefault("DB_PORT", "3306")
+
+from app.utils import profiler  # noqa: E402
+from app.utils.wireguard import next_free_ip  # noqa: E402
+
+HOTSPOT = "wireguard:next_free_ip"  # what the profile should put on top
+
+
+class TakenDatabase:
+    """Answers next_free_ip's query with every host address but the last."""
+
+    def __init__(self, cidr: str, start_host_index: int = 10):
+        net = ip_network(cidr)
+        first = int(net.network_address) + start_host_index
+        last = int(net.broadcast_address) - 1
+        self.rows = [(n,) for n in range(first, last)]
+
+    async def fetch_all(self, query, values=None):
+        return self.rows
+
+
+async def hammer(db: TakenDatabase, cidr: str, seconds: float) -> float:
+    """Call next_free_ip back to back for `seconds`; returns ms per call."""
+    calls, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        await next_free_ip(db, 1, base_cidr=cidr)
+        calls += 1
+    return (time.perf_counter() - started) * 1000 / calls
+
+
+async def main_async(args) -> None:
+    db = TakenDatabase(args.cidr)
+    print(f"{len(db.rows):,} taken addresses in {args.cidr}")
+
+    baseline = await hammer(db, args.cidr, args.seconds)
+
+    result = {}
+    sampler = threading.Thread(target=lambda: result.update(profiler.sample(args.seconds, args.rate)))
+    sampler.start()
+    profiled = await hammer(db, args.cidr, args.seconds)
+    sampler.join()
+
+    print(f"next_free_ip: {baseline:.1f} ms/call idle, {profiled:.1f} ms/call while sampling "
+          f"({(profiled / baseline - 1) * 100:+.1f}%)")
+    print(f"{result['samples']} samples at {result['achieved_rate']}/s (asked {result['rate']}/s)")
+    top = profiler.top_functions(result["stacks"], limit=args.top)
+    print(f"{'function':<60}{'self':>8}{'total':>8}")
+    for row in top:
+        print(f"{row['function']:<60}{row['self']:>8}{row['total']:>8}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            fh.write(profiler.collapsed(result["stacks"]))
+        print(f"collapsed stacks written to {args.out}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cidr", default="10.0.0.0/12")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--rate", type=int, default=200)
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--out", help="write collapsed stacks here")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Register the fleet simulator's virtual agents as vpn_servers rows.
+
+Reads /sim/fleet from a running simulator (agent/app/simulator.py) and
+upserts one server per virtual agent, with agent_url pointing at
+<sim-url>/a/<id>, so the backend load-balances, health-checks, samples and
+provisions against thousands of nodes on one machine. Rows are matched on
+agent_url, so re-running after a simulator restart (new keys, new
+capacities) updates them in place. Addresses come from 198.18.0.0/15, the
+benchmarking range, so they can't collide with real servers.
+
+Then writes a "servers" event to cache_invalidations so every worker drops
+its server catalog within a poll interval.
+
+Run from backend/ with the usual DB_* settings and the simulator's secret:
+    python -m scripts.register_sim_fleet --sim-url http://127.0.0.1:8100
+    python -m scripts.register_sim_fleet --sim-url http://127.0.0.1:8100 --remove
+"""
+import argparse
+import os
+import sys
+from ipaddress import ip_address
+
+import httpx
+from sqlalchemy import insert, select, update
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.database import get_sync_engine  # noqa: E402
+from app.models import cache_invalidations, vpn_servers  # noqa: E402
+from app.utils.wireguard import key_to_bytes  # noqa: E402
+
+SIM_NET = ip_address("198.18.0.0")
+
+
+def fetch_fleet(sim_url: str) -> list:
+    response = httpx.get(
+        f"{sim_url}/sim/fleet",
+        headers={"X-Agent-Secret": os.getenv("AGENT_SHARED_SECRET", "")},
+        timeout=30,
+    )
+    response.raise_for_status()
+    return response.json()["agents"]
+
+
+def server_row(sim_url: str, agent: dict) -> dict:
+    ip = str(SIM_NET + agent["id"])
+    return {
+        "name": f"sim-{agent['id']:05d}",
+        "country": agent.get("country"),
+        "ip_address": ip,
+        "wg_key": key_to_bytes(agent["public_key"]),
+        "wg_endpoint": f"{ip}:{agent['listen_port']}",
+        "agent_url": f"{sim_url}/a/{agent['id']}",
+        "capacity": agent["capacity"],
+        "is_active": True,
+    }
+
+
+def register(conn, sim_url: str, agents: list) -> tuple:
+    existing = dict(conn.execute(
+        select(vpn_servers.c.agent_url, vpn_servers.c.id)
+        .where(vpn_servers.c.agent_url.like(f"{sim_url}/a/%"))
+    ).fetchall())
+    added = updated = 0
+    new_rows = []
+    for agent in agents:
+        row = server_row(sim_url, agent)
+        server_id = existing.get(row["agent_url"])
+        if server_id is None:
+            new_rows.append(row)
+            added += 1
+        else:
+            conn.execute(update(vpn_servers).where(vpn_servers.c.id == server_id).values(**row))
+            updated += 1
+    if new_rows:
+        conn.execute(insert(vpn_servers), new_rows)
+    return added, updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sim-url", default="http://127.0.0.1:8100")
+    parser.add_argument("--remove", action="store_true", help="deactivate this simulator's servers instead")
+    args = parser.parse_args()
+    sim_url = args.sim_url.rstrip("/")
+
+    with get_sync_engine().begin() as conn:
+        if args.remove:
+            result = conn.execute(
+                update(vpn_servers)
+                .where(vpn_servers.c.agent_url.like(f"{sim_url}/a/%"))
+                .values(is_active=False)
+            )
+            print(f"deactivated {result.rowcount} simulated servers")
+        else:
+            agents = fetch_fleet(sim_url)
+            added, updated = register(conn, sim_url, agents)
+            print(f"{len(agents)} virtual agents: {added} servers added, {updated} updated")
+        conn.execute(insert(cache_invalidations).values(namespace="servers", cache_key=None))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""Re-drive a traffic capture against a backend and report latency per endpoint.
+
+Reads a file written by the capture middleware (app/utils/capture.py,
+enabled with CAPTURE_FILE) and sends the same requests in the same order
+with the same spacing, divided by --speed. Captures hold shapes, not
+values, so bodies are rebuilt from them:
+
+  - every captured actor becomes a replay user (<namespace>_<actor>) with a
+    deterministic password; they are registered and logged in before the
+    timed run, except actors whose own registration is part of the capture
+  - logins that failed in the capture are sent with a wrong password, so
+    failure mixes (and rate limiting) are reproduced
+  - ids and knobs kept in the capture (server_id, limit, ...) are sent as
+    they were; user_id is swapped for the replay user's id
+  - other fields get filler of the recorded type and length from a seeded
+    RNG, so two runs with the same --seed send identical requests
+
+Point the backend at a dry-run agent (agent with DRY_RUN=true) or the fleet
+simulator so agent calls are cheap and side-effect free. The streaming
+endpoint is skipped.
+
+Every replay request comes from this one client IP, where the capture had
+many, so start the replay backend with the per-IP limits (app/utils/
+rate_limit.py) raised out of the way, or registration stops at 10 actors:
+
+    export REGISTER_IP_LIMIT=1000000/3600 LOGIN_IP_LIMIT=1000000/60 TWOFA_IP_LIMIT=1000000/60
+    uvicorn app.main:app
+
+The per-username limits stay as they are, so failed logins are still
+limited per replay user. Setup stops with an error if any actor can't be
+registered or logged in.
+
+Run from backend/:
+    python -m scripts.replay capture.jsonl --base-url http://localhost:8000 --speed 10
+    python -m scripts.replay capture.jsonl --json > build-a.json   # compare builds
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.utils.capture import KEEP_VALUES  # noqa: E402
+
+_SKIP_ROUTES = {"/users/me/connection/stream"}
+_REGISTER_ROUTES = {"/users/register", "/users/signup"}
+_LOGIN_ROUTE = "/users/login"
+
+
+def load(path: str, max_requests: Optional[int]) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            if rec.get("r") in _SKIP_ROUTES:
+                continue
+            records.append(rec)
+    records.sort(key=lambda r: r["t"])
+    return records[:max_requests] if max_requests else records
+
+
+class Replayer:
+    def __init__(self, base_url: str, namespace: str, seed: int, concurrency: int, timeout: float):
+        self.base_url = base_url
+        self.namespace = namespace
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.sem = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.tokens: Dict[str, str] = {}
+        self.user_ids: Dict[str, int] = {}
+        self.results: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+
+    def username(self, actor: str) -> str:
+        return f"{self.namespace}_{actor}"
+
+    def password(self, actor: str) -> str:
+        return f"replay-{actor}-{self.seed}"
+
+    # --- request building ---
+
+    def _filler(self, key: str, shape: Any, actor: Optional[str]) -> Any:
+        if key in KEEP_VALUES:
+            return shape  # recorded as is
+        if isinstance(shape, dict):
+            return {k: self._filler(k, v, actor) for k, v in shape.items()}
+        if not isinstance(shape, str):
+            return shape
+        if key == "username" and actor:
+            return self.username(actor)
+        if key == "email" and actor:
+            return f"{self.username(actor)}@example.com"
+        if key == "password" and actor:
+            return self.password(actor)
+        if key in ("code", "twofa_code"):
+            return "000000"
+        if key.endswith("public_key"):
+            return base64.b64encode(self.rng.randbytes(32)).decode()
+        if key == "client_ip":
+            return f"10.8.{self.rng.randrange(256)}.{self.rng.randrange(1, 255)}/32"
+        if key == "server_endpoint":
+            return "127.0.0.1:51820"
+        kind, _, size = shape.partition(":")
+        if kind == "str":
+            return "".join(self.rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(int(size or 8)))
+        if kind == "list":
+            return ["0.0.0.0/0"] * int(size or 0) if key == "allowed_ips" else []
+        return {"int": 0, "float": 0.0, "bool": False}.get(kind)
+
+    def build(self, rec: Dict[str, Any]) -> Dict[str, Any]:
+        actor = rec.get("a")
+        path = rec["r"]
+        for name, value in (rec.get("p") or {}).items():
+            path = path.replace("{" + name + "}", str(value))
+        query = {k: self._filler(k, v, actor) for k, v in (rec.get("q") or {}).items()}
+        body = None
+        if rec.get("b") is not None:
+            body = {k: self._filler(k, v, actor) for k, v in rec["b"].items()}
+            if "user_id" in body and actor in self.user_ids:
+                body["user_id"] = self.user_ids[actor]
+            if rec["r"] == _LOGIN_ROUTE and rec.get("s") == 400:
+                body["password"] = "wrong-" + body.get("password", "")
+        headers = {}
+        if actor in self.tokens and rec["r"] not in _REGISTER_ROUTES and rec["r"] != _LOGIN_ROUTE:
+            headers["Authorization"] = f"Bearer {self.tokens[actor]}"
+        return {"method": rec["m"], "url": path, "params": query or None, "json": body, "headers": headers}
+
+    # --- phases ---
+
+    async def prepare(self, client: httpx.AsyncClient, records: List[Dict[str, Any]]) -> None:
+        """Register and log in every actor that doesn't register during the replay."""
+        actors = {r["a"] for r in records if r.get("a")}
+        self_registering = {r["a"] for r in records if r.get("a") and r["r"] in _REGISTER_ROUTES}
+        for actor in sorted(actors - self_registering):
+            name = self.username(actor)
+            res = await client.post("/users/register", json={
+                "username": name, "email": f"{name}@example.com", "password": self.password(actor),
+            })
+            # 400: registered by an earlier run with the same --namespace and --seed
+            if res.status_code not in (200, 400):
+                _setup_failed("register", name, res)
+            res = await client.post("/users/login", json={"username": name, "password": self.password(actor)})
+            if res.status_code != 200:
+                _setup_failed("log in", name, res)
+            data = res.json()
+            self.tokens[actor] = data["access_token"]
+            self.user_ids[actor] = data["user_id"]
+
+    async def send(self, client: httpx.AsyncClient, rec: Dict[str, Any], scheduled: float) -> None:
+        async with self.sem:
+            request = self.build(rec)
+            started = time.perf_counter()
+            try:
+                res = await client.request(**request)
+                status = res.status_code
+            except httpx.HTTPError as exc:
+                res, status = None, type(exc).__name__
+            elapsed = (time.perf_counter() - started) * 1000
+        if res is not None and rec["r"] == _LOGIN_ROUTE and status == 200 and rec.get("a"):
+            data = res.json()
+            self.tokens[rec["a"]] = data["access_token"]
+            self.user_ids[rec["a"]] = data["user_id"]
+        self.results[f"{rec['m']} {rec['r']}"].append({
+            "ms": elapsed,
+            "lag_ms": (started - scheduled) * 1000,
+            "status": status,
+            "captured_status": rec.get("s"),
+            "captured_ms": rec.get("d"),
+        })
+
+    async def run(self, records: List[Dict[str, Any]], speed: float) -> float:
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=limits) as client:
+            await self.prepare(client, records)
+            t0 = records[0]["t"]
+            start = time.perf_counter()
+            tasks = []
+            for rec in records:
+                scheduled = start + (rec["t"] - t0) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(self.send(client, rec, scheduled)))
+            await asyncio.gather(*tasks)
+            return time.perf_counter() - start
+
+
+def _setup_failed(action: str, username: str, res: httpx.Response) -> None:
+    hint = " (raise the backend's per-IP limits, see --help)" if res.status_code == 429 else ""
+    sys.exit(f"could not {action} replay user {username}: {res.status_code} {res.text[:200]}{hint}")
+
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def summarize(results: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    out = {}
+    for endpoint, rows in sorted(results.items()):
+        ms = [r["ms"] for r in rows]
+        captured = [r["captured_ms"] for r in rows if r["captured_ms"] is not None]
+        statuses: Dict[str, int] = defaultdict(int)
+        for r in rows:
+            statuses[str(r["status"])] += 1
+        out[endpoint] = {
+            "count": len(rows),
+            "p50": _pct(ms, 50),
+            "p90": _pct(ms, 90),
+            "p99": _pct(ms, 99),
+            "max": max(ms),
+            "captured_p50": statistics.median(captured) if captured else None,
+            "status_match": sum(r["status"] == r["captured_status"] for r in rows) / len(rows),
+            "statuses": dict(statuses),
+            "max_lag_ms": max(r["lag_ms"] for r in rows),
+        }
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = real time, 10 = ten times faster")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--namespace", default="rp", help="prefix for replay usernames")
+    parser.add_argument("--concurrency", type=int, default=256, help="max requests in flight")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--max-requests", type=int)
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args()
+
+    records = load(args.capture, args.max_requests)
+    if not records:
+        sys.exit("capture is empty")
+    replayer = Replayer(args.base_url, args.namespace, args.seed, args.concurrency, args.timeout)
+    wall = asyncio.run(replayer.run(records, args.speed))
+    summary = summarize(replayer.results)
+
+    if args.json:
+        print(json.dumps({"requests": len(records), "speed": args.speed, "seconds": wall, "endpoints": summary}, indent=2))
+        return
+    span = records[-1]["t"] - records[0]["t"]
+    print(f"{len(records)} requests, captured over {span:.1f}s, replayed in {wall:.1f}s at {args.speed}x")
+    print(f"{'endpoint':<44}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'cap p50':>9}{'status=':>9}")
+    for endpoint, s in summary.items():
+        cap = f"{s['captured_p50']:.1f}" if s["captured_p50"] is not None else "-"
+        print(
+            f"{endpoint:<44}{s['count']:>7}{s['p50']:>9.1f}{s['p90']:>9.1f}{s['p99']:>9.1f}"
+            f"{s['max']:>9.1f}{cap:>9}{s['status_match']:>8.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
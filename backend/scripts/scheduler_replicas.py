@@ -0,0 +1,118 @@
+"""Simulate several backend replicas sharing one scheduler lease table.
+
+Starts --replicas Scheduler instances in this process, each with its own
+database connection pool and replica id, all registering the same leader
+job (fires every --interval seconds) plus a local job. Then it:
+
+  1. runs for a while and checks every leader-job fire ran on exactly one
+     replica (no two runs closer together than half an interval)
+  2. asks a non-leader replica to run the job on demand and checks the
+     leader picks it up
+  3. kills the leader without releasing its lease (a crash) and checks
+     another replica takes over within the lease TTL
+
+Exits 1 if any check fails. Run from backend/ with the usual DB_* settings,
+against a database that has the job_leases and job_runs tables:
+    python -m scripts.scheduler_replicas --replicas 3 --seconds 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.database import DATABASE_URL  # noqa: E402
+from app.utils.db_pool import BoundedDatabase  # noqa: E402
+from app.utils.scheduler import Interval, Scheduler  # noqa: E402
+
+
+async def main_async(args) -> bool:
+    job = f"replica_probe_{uuid.uuid4().hex[:6]}"
+    leader_runs: List[Tuple[float, str]] = []
+    local_runs: Counter = Counter()
+    replicas: Dict[str, Tuple[Scheduler, BoundedDatabase]] = {}
+
+    for i in range(args.replicas):
+        db = BoundedDatabase(DATABASE_URL, min_size=1, max_size=3)
+        await db.connect()
+        sched = Scheduler(replica_id=f"sim-{i}", lease_seconds=args.lease)
+
+        def probe(name=sched.replica_id):
+            async def run():
+                leader_runs.append((time.monotonic(), name))
+            return run
+
+        def local(name=sched.replica_id):
+            async def run():
+                local_runs[name] += 1
+            return run
+
+        sched.add(job, probe(), Interval(args.interval))
+        sched.add(f"{job}_local", local(), Interval(args.interval), leader=False)
+        sched.start(db)
+        replicas[sched.replica_id] = (sched, db)
+
+    ok = True
+
+    def check(label: str, passed: bool, detail: str = "") -> None:
+        nonlocal ok
+        ok &= passed
+        print(f"[{'ok' if passed else 'FAIL'}] {label}{': ' + detail if detail else ''}")
+
+    # 1) steady state
+    await asyncio.sleep(args.seconds / 2)
+    owners = Counter(name for _, name in leader_runs)
+    gaps = [b[0] - a[0] for a, b in zip(leader_runs, leader_runs[1:])]
+    check("leader job ran", bool(leader_runs), f"{len(leader_runs)} runs by {dict(owners)}")
+    check("one replica per fire", all(g > args.interval / 2 for g in gaps),
+          f"min gap {min(gaps, default=0):.2f}s for interval {args.interval}s")
+    check("local job ran on every replica", len(local_runs) == args.replicas, str(dict(local_runs)))
+
+    # 2) on-demand run requested from a replica that isn't the leader
+    leader = next(name for name, (s, _) in replicas.items() if s.is_leader(s.jobs[job]))
+    other = next(name for name in replicas if name != leader)
+    before = len(leader_runs)
+    answer = await replicas[other][0].request_run(job)
+    await asyncio.sleep(args.lease / 3 + args.interval)
+    manual = [r for r in leader_runs[before:] if r[1] == leader]
+    check("manual run queued for the leader", answer.get("queued_for") == leader and bool(manual), str(answer))
+
+    # 3) crash the leader: stop its loops without releasing the lease
+    sched, db = replicas.pop(leader)
+    for task in sched._tasks:
+        task.cancel()
+    crashed_at = time.monotonic()
+    await asyncio.sleep(args.lease + args.interval * 2)
+    after = [r for r in leader_runs if r[0] > crashed_at]
+    takeover = after[0][0] - crashed_at if after else None
+    check("another replica took over", bool(after) and all(name != leader for _, name in after),
+          f"first run {takeover:.1f}s after crash (lease {args.lease}s)" if takeover is not None else "no runs")
+    if takeover is not None:
+        check("takeover within lease TTL + interval", takeover <= args.lease + args.interval * 1.5)
+
+    for s, d in replicas.values():
+        await s.stop()
+        await d.disconnect()
+    await db.disconnect()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--lease", type=float, default=3.0)
+    args = parser.parse_args()
+    if args.replicas < 2:
+        sys.exit("need at least 2 replicas")
+    sys.exit(0 if asyncio.run(main_async(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
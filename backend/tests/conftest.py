@@ -0,0 +1,129 @@
+"""Shared fixtures.
+
+Nothing here needs MySQL or a running agent. `db` swaps the app's database
+for FakeDatabase, an in-memory SQLite copy of the schema behind the same
+`databases` API the handlers use, which counts statements the way the
+pooled connection does (query_count.record per round trip).
+
+Run from backend/:
+    python -m pytest -q
+"""
+import os
+import sys
+from collections.abc import Mapping
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+for _var, _value in {
+    "DB_USER": "test", "DB_PASSWORD": "test", "DB_HOST": "localhost", "DB_PORT": "3306", "DB_NAME": "test",
+    "JWT_SECRET_KEY": "test-secret", "JWT_ALGORITHM": "HS256", "AGENT_SHARED_SECRET": "test-agent-secret",
+}.items():
+    os.environ.setdefault(_var, _value)
+
+from sqlalchemy import BigInteger, create_engine  # noqa: E402
+from sqlalchemy.ext.compiler import compiles  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+from app.database import database, metadata  # noqa: E402
+from app.utils import invalidation, query_count, rate_limit  # noqa: E402
+import app.models  # noqa: E402,F401  (registers the tables on metadata)
+
+
+@compiles(BigInteger, "sqlite")
+def _sqlite_bigint(type_, compiler, **kw):
+    # SQLite only auto-increments INTEGER PRIMARY KEY
+    return "INTEGER"
+
+
+class Record(Mapping):
+    """A result row that reads like a `databases` record: r["col"], r[0], dict(r)."""
+
+    def __init__(self, row):
+        self._row = row
+        self._mapping = row._mapping
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._row[key]
+        return self._mapping[key]
+
+    def __iter__(self):
+        return iter(self._mapping)
+
+    def __len__(self):
+        return len(self._mapping)
+
+
+class _Transaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeDatabase:
+    """SQLite stand-in for app.database.database. Statements apply at once;
+    transaction() only marks the block (enough for counting round trips)."""
+
+    def __init__(self):
+        self.engine = create_engine(
+            "sqlite://",
+            poolclass=StaticPool,
+            connect_args={"check_same_thread": False},
+            isolation_level="AUTOCOMMIT",
+        )
+        metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        self.statements = []
+
+    def _run(self, query):
+        query_count.record()
+        self.statements.append(query)
+        return self.conn.execute(query)
+
+    async def fetch_all(self, query):
+        return [Record(r) for r in self._run(query)]
+
+    async def fetch_one(self, query):
+        row = self._run(query).first()
+        return Record(row) if row is not None else None
+
+    async def fetch_val(self, query, column=0):
+        row = await self.fetch_one(query)
+        return None if row is None else row[column]
+
+    async def execute(self, query):
+        return self._run(query).lastrowid
+
+    def transaction(self):
+        return _Transaction()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDatabase()
+    for name in ("fetch_all", "fetch_one", "fetch_val", "execute", "transaction"):
+        monkeypatch.setattr(database, name, getattr(fake, name))
+    # Per-process state that would leak between tests
+    for cache in invalidation._caches.values():
+        cache.invalidate()
+    monkeypatch.setattr(rate_limit, "limiters", {
+        name: rate_limit.SlidingWindowLimiter(name, limiter.limit, limiter.window)
+        for name, limiter in rate_limit.limiters.items()
+    })
+    yield fake
+    fake.conn.close()
+
+
+@pytest.fixture
+def client(db):
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    # Not used as a context manager: startup (DB connect, pollers, agent
+    # channel) stays off
+    return TestClient(app)
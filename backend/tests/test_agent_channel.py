@@ -0,0 +1,59 @@
+"""When an agent op may fall back from the channel to REST (app/utils/agent_client.py)."""
+import asyncio
+
+import pytest
+
+from app.utils import agent_channel, agent_client, agent_health
+
+URL = "http://agent-test"
+
+
+class _Socket:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+
+    async def send(self, raw):
+        if self.fail:
+            raise ConnectionError("socket closed")
+        self.sent.append(raw)  # never acked
+
+
+@pytest.fixture
+def rest(monkeypatch):
+    calls = []
+
+    async def _request(method, path, payload, agent_url=None, timeout=None):
+        calls.append(path)
+        return {"ok": True}
+
+    monkeypatch.setattr(agent_client, "_request", _request)
+    return calls
+
+
+def _channel(monkeypatch, socket):
+    channel = agent_channel.AgentChannel(URL, "secret")
+    channel._ws = socket
+    monkeypatch.setitem(agent_channel._channels, URL, channel)
+    # Short ack timeout (the default is bound when the method is defined)
+    monkeypatch.setattr(agent_channel.AgentChannel.request, "__defaults__", (0.05, None))
+    monkeypatch.setattr(agent_health, "_breakers", {})
+    return channel
+
+
+def test_unacked_command_is_not_resent_over_rest(monkeypatch, rest):
+    socket = _Socket()
+    _channel(monkeypatch, socket)
+
+    with pytest.raises(agent_client.AgentError, match="not retried over REST"):
+        asyncio.run(agent_client.rotate_key(agent_url=URL))
+    assert len(socket.sent) == 1
+    assert rest == []
+
+
+def test_command_that_was_never_sent_falls_back_to_rest(monkeypatch, rest):
+    channel = _channel(monkeypatch, _Socket(fail=True))
+
+    asyncio.run(agent_client.rotate_key(agent_url=URL))
+    assert len(rest) == 1
+    assert channel._sent == {}  # not replayed on reconnect either
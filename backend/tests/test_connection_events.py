@@ -0,0 +1,35 @@
+"""Stream events reach subscribers on every worker (app/utils/connection_events.py).
+
+The publishing worker is the app's own modules; the worker serving the
+stream gets its own copy of the invalidation poller, like in
+test_invalidation.py, feeding the broker its subscriber waits on.
+"""
+import asyncio
+import importlib.util
+
+from app.utils import connection_events, invalidation
+from app.utils.pubsub import broker
+
+
+def _poller():
+    spec = importlib.util.spec_from_file_location("invalidation_stream_worker", invalidation.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.on_event(connection_events.STREAM_NAMESPACE, connection_events._deliver)
+    return module
+
+
+def test_event_published_on_one_worker_reaches_a_stream_on_another(db):
+    other = _poller()
+
+    async def scenario():
+        await other.poll_once(db)  # starts from the current end of the log
+        async with broker.subscribe(connection_events.user_topic(7)) as queue:
+            await connection_events.publish(db, 7, "connected", connection_id=1, server_id=2)
+            assert queue.empty()  # nothing is delivered until the poller sees it
+            assert await other.poll_once(db) == 1
+            return queue.get_nowait()
+
+    event = asyncio.run(scenario())
+    assert event["type"] == "connected"
+    assert (event["connection_id"], event["server_id"]) == (1, 2)
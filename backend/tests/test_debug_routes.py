@@ -0,0 +1,45 @@
+"""Admin debug endpoints (app/routes/debug_routes.py)."""
+import pytest
+
+from app import auth
+from app.models import users, vpn_servers
+from app.utils import agent_client
+
+
+@pytest.fixture
+def admin(client, db, monkeypatch):
+    monkeypatch.setattr(auth, "ADMIN_USERNAMES", {"root"})
+    user_id = db.conn.execute(
+        users.insert().values(username="root", email="root@example.com", hashed_password="x")
+    ).lastrowid
+    client.headers["Authorization"] = f"Bearer {auth.create_access_token({'sub': 'root', 'user_id': user_id})}"
+    return client
+
+
+@pytest.fixture
+def agent_profile(monkeypatch):
+    calls = []
+
+    async def profile(seconds, rate, idle=False, tasks=False, agent_url=None):
+        calls.append({"agent_url": agent_url, "tasks": tasks})
+        return {"stacks": {}, "samples": 0}
+
+    monkeypatch.setattr(agent_client, "profile", profile)
+    return calls
+
+
+def test_agent_profile_only_goes_to_known_agents(admin, db, agent_profile):
+    db.conn.execute(vpn_servers.insert().values(
+        name="n1", ip_address="198.18.0.1", is_active=True, agent_url="http://agent-1:8001",
+    ))
+
+    response = admin.get("/debug/profile/agent", params={"agent_url": "http://attacker.example", "seconds": 1})
+    assert response.status_code == 404
+    assert agent_profile == []
+
+    response = admin.get(
+        "/debug/profile/agent",
+        params={"agent_url": "http://agent-1:8001", "seconds": 1, "tasks": "true", "format": "json"},
+    )
+    assert response.status_code == 200
+    assert agent_profile == [{"agent_url": "http://agent-1:8001", "tasks": True}]
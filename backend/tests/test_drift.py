@@ -0,0 +1,99 @@
+"""Drift checks run per agent: servers sharing an agent must not report
+each other's peers as leaked (auto-repair would disconnect them)."""
+import asyncio
+import datetime
+
+import pytest
+
+from app.models import vpn_servers, wg_allocations
+from app.utils import agent_client, drift, peer_digest
+from app.utils.wireguard import ip_to_int, key_to_bytes
+
+OTHER_AGENT = "http://agent-b:8001"
+
+
+def _key(i):
+    return key_to_bytes(f"{i:042d}A=")
+
+
+class FakeAgents:
+    """Live peers per agent URL, answering the digest calls drift.py makes."""
+
+    def __init__(self):
+        self.peers = {}
+        self.removed = []
+        self.added = []
+
+    async def peer_digest(self, prefixes, agent_url=None):
+        tree = peer_digest.build_tree(self.peers.get(agent_url, {}).items())
+        return {p: tree.get(p) for p in prefixes}
+
+    async def bucket_peers(self, prefixes, agent_url=None):
+        return [
+            {"public_key": k, "allowed_ips": v}
+            for k, v in self.peers.get(agent_url, {}).items()
+            if peer_digest.bucket_of(k).startswith(tuple(prefixes))
+        ]
+
+    async def remove_peer(self, public_key, agent_url=None):
+        self.removed.append((agent_url, public_key))
+        self.peers[agent_url].pop(public_key, None)
+
+    async def add_peer(self, public_key, allowed_ips, agent_url=None, **kwargs):
+        self.added.append((agent_url, public_key))
+        self.peers.setdefault(agent_url, {})[public_key] = allowed_ips
+
+
+@pytest.fixture
+def agents(monkeypatch):
+    fake = FakeAgents()
+    for name in ("peer_digest", "bucket_peers", "remove_peer", "add_peer"):
+        monkeypatch.setattr(agent_client, name, getattr(fake, name))
+    return fake
+
+
+@pytest.fixture
+def fleet(db, agents):
+    """Servers 1 (no agent_url) and 2 (explicit AGENT_URL) share the default
+    agent; server 3 has its own. Every allocation is live where it belongs."""
+    for sid, url in ((1, None), (2, agent_client.AGENT_URL), (3, OTHER_AGENT)):
+        db.conn.execute(vpn_servers.insert().values(id=sid, name=f"s{sid}", ip_address=f"198.18.0.{sid}", agent_url=url))
+    for i in range(30):
+        sid = i % 3 + 1
+        key, addr = _key(i), ip_to_int(f"10.8.{sid}.{i + 2}")
+        db.conn.execute(wg_allocations.insert().values(user_id=i + 1, server_id=sid, client_addr=addr, client_key=key))
+        url = OTHER_AGENT if sid == 3 else agent_client.AGENT_URL
+        agents.peers.setdefault(url, {})[drift.bytes_to_key(key)] = f"10.8.{sid}.{i + 2}/32"
+    return db
+
+
+def test_servers_sharing_an_agent_are_checked_together(fleet, agents):
+    reports = asyncio.run(drift.check_fleet(fleet, auto_repair=True))
+
+    assert {r["agent_url"]: r["server_ids"] for r in reports} == {
+        agent_client.AGENT_URL: [1, 2],
+        OTHER_AGENT: [3],
+    }
+    assert all(r["in_sync"] and r["round_trips"] == 1 for r in reports)
+    assert agents.removed == []
+
+
+def test_only_real_strays_are_leaked_and_repaired(fleet, agents):
+    stray = drift.bytes_to_key(_key(999))
+    agents.peers[agent_client.AGENT_URL][stray] = "10.8.1.250/32"
+    missing = drift.bytes_to_key(_key(4))  # allocated on server 2
+    del agents.peers[agent_client.AGENT_URL][missing]
+
+    reports = {r["agent_url"]: r for r in asyncio.run(drift.check_fleet(fleet, auto_repair=True))}
+    default = reports[agent_client.AGENT_URL]
+    assert default["leaked"] == [stray]
+    assert [p["public_key"] for p in default["missing"]] == [missing]
+    assert agents.removed == [(agent_client.AGENT_URL, stray)]
+    assert agents.added == [(agent_client.AGENT_URL, missing)]
+    assert reports[OTHER_AGENT]["in_sync"]
+
+
+def test_revoked_allocations_count_as_leaked(fleet, agents):
+    fleet.conn.execute(wg_allocations.update().where(wg_allocations.c.user_id == 3).values(revoked_at=datetime.datetime(2026, 1, 1)))
+    report = asyncio.run(drift.check_agent(fleet, OTHER_AGENT))
+    assert report["leaked"] == [drift.bytes_to_key(_key(2))]
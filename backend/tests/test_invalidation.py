@@ -0,0 +1,103 @@
+"""Cross-worker cache invalidation over a shared event table.
+
+Each "worker" is its own copy of app/utils/invalidation.py (own caches, own
+poll state), all polling the same FakeDatabase, like uvicorn workers
+sharing MySQL.
+"""
+import asyncio
+import importlib.util
+
+import pytest
+
+from app.models import cache_invalidations
+from app.utils import invalidation
+
+
+def _worker(n):
+    spec = importlib.util.spec_from_file_location(f"invalidation_worker_{n}", invalidation.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def workers(db):
+    workers = [_worker(n) for n in range(3)]
+    for w in workers:
+        asyncio.run(w.poll_once(db))  # bootstrap: start at the current max id
+    return workers
+
+
+def _fill(workers, key="k"):
+    for w in workers:
+        w.cache("servers").set(key, "cached")
+
+
+def _poll_all(db, workers):
+    for w in workers:
+        asyncio.run(w.poll_once(db))
+
+
+def _commit_event(db, event_id, namespace="servers", key="k"):
+    """Make one event visible, as if its writer's transaction just committed."""
+    db.conn.execute(cache_invalidations.insert().values(id=event_id, namespace=namespace, cache_key=key))
+
+
+def test_publish_reaches_every_worker(db, workers):
+    _fill(workers)
+    asyncio.run(workers[0].publish(db, "servers", "k"))
+
+    assert workers[0].cache("servers").get("k") is None  # the publisher drops it right away
+    assert workers[1].cache("servers").get("k") == "cached"
+    _poll_all(db, workers)
+    assert all(w.cache("servers").get("k") is None for w in workers)
+
+
+def test_whole_namespace_and_int_keys(db, workers):
+    for w in workers:
+        w.cache("users").set(7, "alice")
+        w.cache("servers").set("a", 1)
+        w.cache("servers").set("b", 2)
+    asyncio.run(workers[0].publish(db, "users", 7))
+    asyncio.run(workers[0].publish(db, "servers"))
+    _poll_all(db, workers)
+    for w in workers:
+        assert w.cache("users").get(7) is None
+        assert len(w.cache("servers")) == 0
+
+
+def test_out_of_order_commit_is_not_skipped(db, workers):
+    """id N+1 commits (and is polled) before N; N must still be applied."""
+    _fill(workers, "late")
+    _fill(workers, "early")
+    _commit_event(db, 2, key="early")
+    _poll_all(db, workers)
+    assert all(w.cache("servers").get("early") is None for w in workers)
+    assert all(w.invalidation_state()["open_gaps"] == 1 for w in workers)
+
+    _commit_event(db, 1, key="late")
+    _poll_all(db, workers)
+    assert all(w.cache("servers").get("late") is None for w in workers)
+    assert all(w.invalidation_state()["open_gaps"] == 0 for w in workers)
+
+
+def test_gap_that_never_commits_expires(db, monkeypatch):
+    worker = _worker("gap")
+    asyncio.run(worker.poll_once(db))
+    monkeypatch.setattr(worker, "INVALIDATION_GAP_SECONDS", 0.0)
+    _commit_event(db, 5)  # ids 1-4 rolled back
+    asyncio.run(worker.poll_once(db))
+    assert worker.invalidation_state()["open_gaps"] == 4
+    asyncio.run(worker.poll_once(db))
+    assert worker.invalidation_state()["open_gaps"] == 0
+    assert worker.invalidation_state()["last_id"] == 5
+
+
+def test_new_worker_does_not_replay_history(db, workers):
+    asyncio.run(workers[0].publish(db, "servers", "old"))
+    late = _worker("late")
+    late.cache("servers").set("old", "fresh")
+    asyncio.run(late.poll_once(db))
+    asyncio.run(late.poll_once(db))
+    assert late.cache("servers").get("old") == "fresh"
+    assert late.invalidation_state()["applied"] == 0
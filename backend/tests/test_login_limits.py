@@ -0,0 +1,44 @@
+"""Failed-login limits (app/utils/rate_limit.py): guessing at an account from
+one client IP shuts that IP out without locking the owner out elsewhere."""
+from app.utils import rate_limit
+
+ATTACKER = {"X-Forwarded-For": "203.0.113.7"}
+OWNER = {"X-Forwarded-For": "198.51.100.20"}
+
+
+def _login(client, password, headers):
+    return client.post("/users/login", json={"username": "victim", "password": password}, headers=headers)
+
+
+def _register(client):
+    response = client.post(
+        "/users/register", json={"username": "victim", "email": "victim@example.com", "password": "pw-123456"}
+    )
+    assert response.status_code == 200
+
+
+def test_failures_from_one_ip_dont_lock_out_the_owner(client, monkeypatch):
+    monkeypatch.setattr(rate_limit, "client_ip", lambda request: request.headers.get("X-Forwarded-For", "testclient"))
+    _register(client)
+
+    limit = rate_limit.limiters["login_user_ip"].limit
+    for _ in range(limit):
+        assert _login(client, "wrong", ATTACKER).status_code == 400
+    assert _login(client, "wrong", ATTACKER).status_code == 429
+
+    assert _login(client, "pw-123456", OWNER).status_code == 200
+
+
+def test_per_username_backstop_applies_to_new_ips_but_not_trusted_ones(client, monkeypatch):
+    monkeypatch.setattr(rate_limit, "client_ip", lambda request: request.headers.get("X-Forwarded-For", "testclient"))
+    _register(client)
+    assert _login(client, "pw-123456", OWNER).status_code == 200
+    backstop = rate_limit.limiters["login_user"]
+    for _ in range(backstop.limit):
+        backstop.hit("victim")
+
+    # An IP's first guess at the account already hits the cap...
+    assert _login(client, "wrong", ATTACKER).status_code == 429
+    assert _login(client, "wrong", {"X-Forwarded-For": "203.0.113.8"}).status_code == 429
+    # ...while one that logged in to it lately still gets in
+    assert _login(client, "pw-123456", OWNER).status_code == 200
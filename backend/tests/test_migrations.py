@@ -0,0 +1,20 @@
+"""Batched backfill in the migration scripts (scripts/migrate_compact_columns.py)."""
+from sqlalchemy import create_engine, text
+
+from scripts.migrate_compact_columns import Migration
+
+
+def test_backfill_ends_when_rows_cannot_convert():
+    engine = create_engine("sqlite://")
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE t (id INTEGER PRIMARY KEY, raw TEXT, parsed INTEGER)"))
+        # More unconvertible rows than one batch, which used to be re-matched forever
+        for i in range(1, 21):
+            conn.execute(text("INSERT INTO t (id, raw) VALUES (:i, :raw)"), {"i": i, "raw": "bad" if i % 4 else str(i)})
+        conn.commit()
+
+        Migration(conn, dry_run=False).backfill("t", "parsed = NULLIF(CAST(raw AS INTEGER), 0)", "parsed IS NULL", 3)
+
+        converted = conn.execute(text("SELECT id FROM t WHERE parsed IS NOT NULL ORDER BY id")).scalars().all()
+        assert converted == [4, 8, 12, 16, 20]
+        assert conn.execute(text("SELECT COUNT(*) FROM t WHERE parsed IS NULL")).scalar() == 15
@@ -0,0 +1,51 @@
+"""The backend and the agent each ship a copy of the digest code
+(app/utils/peer_digest.py here, agent/app/utils/digest.py there); drift
+checks only work while both build identical trees."""
+import base64
+import importlib.util
+import os
+import random
+
+from app.utils import peer_digest
+
+AGENT_DIGEST = os.path.join(os.path.dirname(__file__), "..", "..", "agent", "app", "utils", "digest.py")
+
+
+def _agent_digest():
+    spec = importlib.util.spec_from_file_location("agent_digest", AGENT_DIGEST)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _peers(n, seed=7):
+    rng = random.Random(seed)
+    return [
+        (base64.b64encode(rng.randbytes(32)).decode(), f"10.8.{i // 250}.{i % 250 + 2}/32")
+        for i in range(n)
+    ]
+
+
+def test_agent_and_backend_trees_match():
+    agent = _agent_digest()
+    assert agent.DIGEST_DEPTH == peer_digest.DIGEST_DEPTH
+    assert agent.HASH_CHARS == peer_digest.HASH_CHARS
+    for n in (0, 1, 17, 5000):
+        peers = _peers(n)
+        assert agent.build_tree(peers) == peer_digest.build_tree(peers)
+        assert [agent.bucket_of(k) for k, _ in peers] == [peer_digest.bucket_of(k) for k, _ in peers]
+
+
+def test_allowed_ips_are_normalized_the_same_way():
+    agent = _agent_digest()
+    for ips in ("", "(none)", "10.8.0.2/32", " 10.8.0.3/32 , 10.8.0.2/32", "fd00::2/128,10.8.0.2/32"):
+        assert agent.normalize_ips(ips) == peer_digest.normalize_ips(ips)
+    assert agent.children("a") == peer_digest.children("a")
+
+
+def test_tree_is_order_independent_and_detects_changes():
+    peers = _peers(300)
+    tree = peer_digest.build_tree(peers)
+    assert peer_digest.build_tree(list(reversed(peers))) == tree
+    changed = peers[:-1] + [(peers[-1][0], "10.8.9.9/32")]
+    assert peer_digest.build_tree(changed)[""] != tree[""]
@@ -0,0 +1,28 @@
+"""The sampling profiler (app/utils/profiler.py) finds a known hotspot:
+next_free_ip on a large, nearly full subnet, profiled from a worker thread
+the way /debug/profile does it."""
+import asyncio
+import threading
+
+from app.utils import profiler
+from app.utils.wireguard import next_free_ip
+from scripts.profile_check import HOTSPOT, TakenDatabase
+
+CIDR = "10.0.0.0/14"
+
+
+def test_next_free_ip_tops_the_profile():
+    db = TakenDatabase(CIDR)
+    result = {}
+
+    async def hammer():
+        sampler = threading.Thread(target=lambda: result.update(profiler.sample(1.0, 200)))
+        sampler.start()
+        while sampler.is_alive():
+            await next_free_ip(db, 1, base_cidr=CIDR)
+        sampler.join()
+
+    asyncio.run(hammer())
+    top = profiler.top_functions(result["stacks"], limit=5)
+    assert result["samples"] > 0
+    assert top[0]["function"].startswith(HOTSPOT), top
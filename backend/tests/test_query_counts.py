@@ -0,0 +1,97 @@
+"""DB round trips per request for the hot endpoints.
+
+Walks one user through register -> login -> profile -> 2FA -> connect ->
+disconnect and checks the X-DB-Queries header (statements sent while
+handling the request, see app/utils/query_count.py) against a budget, so
+a handler that slips back into serial round trips fails here.
+"""
+import pytest
+
+from app.models import vpn_servers
+from app.utils import agent_client
+
+# endpoint -> max statements (auth lookup included where the route is
+# authenticated, and one insert per stream event relayed to other workers)
+BUDGET = {
+    "POST /users/register": 2,
+    "POST /users/login": 1,
+    "GET /users/profile": 1,
+    "GET /security/2fa/status": 1,
+    "POST /security/2fa/setup": 3,
+    "POST /security/2fa/recovery-codes": 3,
+    "POST /security/2fa/rotate": 4,
+    "POST /users/connect": 4,
+    "GET /users/me/connection": 2,
+    "POST /users/disconnect": 3,
+}
+
+
+@pytest.fixture
+def server_id(db):
+    return db.conn.execute(
+        vpn_servers.insert().values(name="test-1", country="DE", ip_address="198.18.0.1", is_active=True)
+    ).lastrowid
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    calls = []
+
+    async def add_peer(public_key, allowed_ips, persistent_keepalive=25, agent_url=None):
+        calls.append(("add_peer", public_key))
+        return {"ok": True}
+
+    monkeypatch.setattr(agent_client, "add_peer", add_peer)
+    monkeypatch.setattr(agent_client, "ensure_available", lambda agent_url=None: None)
+    return calls
+
+
+def test_hot_endpoints_stay_within_budget(client, db, server_id, agent):
+    counts = {}
+
+    def call(method, path, **kwargs):
+        response = client.request(method, path, **kwargs)
+        assert response.status_code == 200, (path, response.text)
+        counts[f"{method} {path}"] = int(response.headers["X-DB-Queries"])
+        return response
+
+    call("POST", "/users/register", json={"username": "qc", "email": "qc@example.com", "password": "pw-123456"})
+    login = call("POST", "/users/login", json={"username": "qc", "password": "pw-123456"}).json()
+    client.headers["Authorization"] = f"Bearer {login['access_token']}"
+
+    call("GET", "/users/profile")
+    call("GET", "/security/2fa/status")
+    call("POST", "/security/2fa/recovery-codes")
+    call("POST", "/security/2fa/setup")
+    call("POST", "/security/2fa/rotate")
+    call("POST", "/users/connect", json={
+        "user_id": login["user_id"],
+        "server_id": server_id,
+        "public_key": "A" * 43 + "=",
+        "client_ip": "10.8.0.250/32",
+    })
+    call("GET", "/users/me/connection")
+    call("POST", "/users/disconnect")
+
+    over = {k: (n, BUDGET[k]) for k, n in counts.items() if n > BUDGET[k]}
+    assert not over, f"over budget (queries, budget): {over}"
+    assert set(counts) == set(BUDGET)
+    assert agent == [("add_peer", "A" * 43 + "=")]
+
+
+def test_header_matches_statements_sent(client, db):
+    before = len(db.statements)
+    response = client.post(
+        "/users/register", json={"username": "hdr", "email": "hdr@example.com", "password": "pw-123456"}
+    )
+    assert response.status_code == 200
+    assert int(response.headers["X-DB-Queries"]) == len(db.statements) - before == 2
+
+
+def test_cached_user_lookup_costs_nothing(client, db):
+    client.post("/users/register", json={"username": "c", "email": "c@example.com", "password": "pw-123456"})
+    token = client.post("/users/login", json={"username": "c", "password": "pw-123456"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    assert client.get("/security/2fa/status", headers=headers).headers["X-DB-Queries"] == "1"
+    assert client.get("/security/2fa/status", headers=headers).headers["X-DB-Queries"] == "0"
@@ -0,0 +1,136 @@
+"""Leader jobs across replicas (app/utils/scheduler.py): several Scheduler
+instances share one lease store; a leader job runs on one of them at a
+time, moves when the leader dies, and never runs past a lapsed lease."""
+import asyncio
+import time
+
+from app.database import database
+from app.utils.scheduler import Interval, Scheduler
+
+LEASE = 0.6
+
+
+class MemoryLeaseStore:
+    """job_leases semantics (take over only once expired) on a local clock."""
+
+    def __init__(self):
+        self.rows = {}
+
+    async def acquire(self, name, owner, ttl):
+        now = time.monotonic()
+        row = self.rows.get(name)
+        if row is None or row["owner"] == owner or row["expires_at"] < now:
+            requested = row["run_requested_at"] if row else None
+            row = self.rows[name] = {"owner": owner, "expires_at": now + ttl, "run_requested_at": requested}
+        return {"owner": row["owner"], "run_requested_at": row["run_requested_at"]}
+
+    async def clear_request(self, name):
+        self.rows[name]["run_requested_at"] = None
+
+    async def request_run(self, name):
+        row = self.rows.get(name)
+        if row is None:
+            return None
+        row["run_requested_at"] = time.monotonic()
+        return row["owner"]
+
+    async def release(self, names, owner):
+        for name in names:
+            if self.rows.get(name, {}).get("owner") == owner:
+                self.rows[name]["expires_at"] = 0.0
+
+
+def _replicas(store, n, fn, interval=0.05):
+    replicas = []
+    for i in range(n):
+        sched = Scheduler(replica_id=f"r{i}", lease_seconds=LEASE, lease_store=store)
+        sched.add("job", fn(sched.replica_id), Interval(interval))
+        sched.start(database)
+        replicas.append(sched)
+    return replicas
+
+
+def _crash(sched):
+    # Stop renewing without releasing the lease, like a killed process
+    for task in sched._tasks:
+        task.cancel()
+
+
+def test_leader_job_runs_on_one_replica_at_a_time(db):
+    runs = []
+
+    def probe(name):
+        async def run():
+            started = time.monotonic()
+            await asyncio.sleep(0.02)
+            runs.append((started, time.monotonic(), name))
+        return run
+
+    async def scenario():
+        replicas = _replicas(MemoryLeaseStore(), 3, probe)
+        await asyncio.sleep(1.0)
+        for sched in replicas:
+            await sched.stop()
+
+    asyncio.run(scenario())
+    assert len(runs) > 5
+    assert len({name for _, _, name in runs}) == 1
+    ordered = sorted(runs)
+    assert all(a[1] <= b[0] for a, b in zip(ordered, ordered[1:])), "two runs overlapped"
+
+
+def test_another_replica_takes_over_when_the_leader_dies(db):
+    runs = []
+
+    def probe(name):
+        async def run():
+            runs.append((time.monotonic(), name))
+        return run
+
+    async def scenario():
+        replicas = _replicas(MemoryLeaseStore(), 3, probe)
+        await asyncio.sleep(0.5)
+        leader = runs[-1][1]
+        crashed = next(s for s in replicas if s.replica_id == leader)
+        _crash(crashed)
+        crashed_at = time.monotonic()
+        await asyncio.sleep(LEASE * 2)
+        for sched in replicas:
+            await sched.stop()
+        return leader, crashed_at
+
+    leader, crashed_at = asyncio.run(scenario())
+    # The dead leader's view lapses before its lease does, so it stops firing
+    after = [r for r in runs if r[0] > crashed_at + LEASE]
+    assert after and leader not in {name for _, name in after}
+    takeover = min(t for t, name in after) - crashed_at
+    assert takeover <= LEASE * 1.5
+
+
+def test_running_job_is_cancelled_when_its_lease_lapses(db):
+    cancelled = []
+
+    def slow(name):
+        async def run():
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.append((time.monotonic(), name))
+                raise
+        return run
+
+    async def scenario():
+        store = MemoryLeaseStore()
+        (sched,) = _replicas(store, 1, slow)
+        await asyncio.sleep(0.3)
+        assert sched.jobs["job"].running
+        _crash(sched)
+        await asyncio.sleep(LEASE)
+        lease_expiry = store.rows["job"]["expires_at"]
+        await sched.stop()
+        return sched, lease_expiry
+
+    sched, lease_expiry = asyncio.run(scenario())
+    assert len(cancelled) == 1
+    assert cancelled[0][0] < lease_expiry, "job outlived the lease"
+    assert sched.jobs["job"].last_run["status"] == "lease_lost"
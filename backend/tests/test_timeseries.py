@@ -0,0 +1,69 @@
+"""Node time series (app/utils/timeseries.py): the leader asks each agent
+once and every worker ingests the same samples; each worker snapshots to
+its own file and a restart reads the newest one back."""
+import asyncio
+import time
+
+import pytest
+
+from app.models import vpn_servers
+from app.utils import agent_client, timeseries
+
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setattr(timeseries, "_series", {})
+    monkeypatch.setattr(timeseries, "_last", {})
+    monkeypatch.setattr(timeseries, "_state", {"last_id": 0})
+
+
+@pytest.fixture
+def agents(db, monkeypatch):
+    # Two servers behind one agent, one behind another
+    for name, url in (("a1", "http://agent-a"), ("a2", "http://agent-a"), ("b1", "http://agent-b")):
+        db.conn.execute(vpn_servers.insert().values(name=name, ip_address="198.18.0.1", is_active=True, agent_url=url))
+    calls = []
+    counters = {"http://agent-a": 0, "http://agent-b": 0}
+
+    async def node_stats(agent_url=None):
+        calls.append(agent_url)
+        counters[agent_url] += 1000
+        return {"peers": 3, "active_peers": 2, "rx_bytes": counters[agent_url], "tx_bytes": 0, "at": counters[agent_url] / 100}
+
+    monkeypatch.setattr(agent_client, "node_stats", node_stats)
+    return calls
+
+
+def _points(server_id, metric):
+    now = time.time()
+    _, series = timeseries.query(server_id, [metric], now - 600, now)
+    return [v for _, v in series[metric] if v is not None]
+
+
+def test_leader_polls_each_agent_once_and_workers_pull(db, store, agents):
+    assert asyncio.run(timeseries.sample_nodes(db)) == 3
+    assert sorted(agents) == ["http://agent-a", "http://agent-b"]
+    assert asyncio.run(timeseries.pull(db)) == 3
+    assert asyncio.run(timeseries.pull(db)) == 0
+
+    asyncio.run(timeseries.sample_nodes(db))
+    assert asyncio.run(timeseries.pull(db)) == 3
+    assert _points(1, "peers") and _points(3, "peers")
+    assert _points(1, "rx_bytes_per_sec") == [100.0]
+
+
+def test_workers_snapshot_to_their_own_files(db, store, agents, tmp_path, monkeypatch):
+    path = str(tmp_path / "ts.snapshot")
+    asyncio.run(timeseries.sample_nodes(db))
+    asyncio.run(timeseries.pull(db))
+    for pid in (101, 102):
+        monkeypatch.setattr(timeseries.os, "getpid", lambda pid=pid: pid)
+        timeseries.save(path)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["ts.snapshot.101", "ts.snapshot.102"]
+
+    # A restarted worker reads one back and resumes after the samples it holds
+    monkeypatch.setattr(timeseries, "_series", {})
+    monkeypatch.setattr(timeseries, "_state", {"last_id": 0})
+    assert timeseries.load(path) == 6  # peers and active_peers for 3 servers
+    assert timeseries._state["last_id"] == 3
+    assert asyncio.run(timeseries.pull(db)) == 0
@@ -0,0 +1,46 @@
+"""Which requests are traced, and under what id (app/utils/tracing.py)."""
+import os
+import threading
+
+import pytest
+
+from app.utils import tracing
+
+TRACE_ID = "0123456789abcdef0123456789abcdef"
+
+
+@pytest.fixture
+def unsampled(monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_SAMPLE_RATE", 0.0)
+
+
+def test_outside_caller_cannot_force_a_trace(client, unsampled):
+    response = client.get("/health/ready", headers={"X-Trace-Id": TRACE_ID})
+    assert "X-Trace-Id" not in response.headers
+    assert tracing.get_trace(TRACE_ID) is None
+
+
+def test_internal_caller_joins_its_trace(client, unsampled):
+    headers = {"X-Trace-Id": TRACE_ID, "X-Agent-Secret": os.environ["AGENT_SHARED_SECRET"]}
+    response = client.get("/health/ready", headers=headers)
+    assert response.headers["X-Trace-Id"] == TRACE_ID
+    assert tracing.get_trace(TRACE_ID) is not None
+
+
+def test_malformed_trace_id_is_replaced(client, unsampled):
+    headers = {"X-Trace-Id": "../../etc", "X-Agent-Secret": os.environ["AGENT_SHARED_SECRET"]}
+    response = client.get("/health/ready", headers=headers)
+    assert "X-Trace-Id" not in response.headers  # not trusted, so not traced either
+
+
+def test_traces_are_written_by_the_writer_thread(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(path))
+    monkeypatch.setattr(tracing, "_stop", threading.Event())
+    monkeypatch.setattr(tracing, "_writer", {"thread": None})
+    trace = tracing.Trace(TRACE_ID)
+    trace.spans.append({"span_id": "a", "parent_id": None, "name": "GET /x", "start": 1.0, "duration_ms": 1.0})
+    tracing._export(trace)
+    assert not path.exists()  # nothing written on the request path
+    tracing.close()
+    assert TRACE_ID in path.read_text()
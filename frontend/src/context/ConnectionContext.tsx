@@ -112,6 +112,66 @@ export const ConnectionProvider: React.FC<{ children: React.ReactNode }> = ({ ch
     void refresh();
   }, [refresh]);
 
+  // Live updates: the backend pushes connection state changes over SSE,
+  // so we only re-fetch when something actually changed. EventSource can't
+  // send the access token, so each connection opens with a short-lived
+  // ticket; the browser's own retry would reuse an expired one, so on error
+  // we close and reconnect with a fresh ticket (backing off up to 30s).
+  useEffect(() => {
+    if (!localStorage.getItem("access_token") || typeof EventSource === "undefined") return;
+
+    const base = api.defaults.baseURL ?? "";
+    const onChange = () => void refresh();
+    let es: EventSource | null = null;
+    let retry: ReturnType<typeof setTimeout> | undefined;
+    let attempt = 0;
+    let stopped = false;
+
+    const reconnect = () => {
+      if (stopped) return;
+      const delay = Math.min(30_000, 1_000 * 2 ** attempt++);
+      retry = setTimeout(() => void open(), delay);
+    };
+
+    const open = async () => {
+      let ticket: string;
+      try {
+        const res = await api.post<{ ticket: string }>("/users/me/connection/stream-ticket");
+        ticket = res.data.ticket;
+      } catch (err) {
+        console.error("stream ticket failed:", err);
+        reconnect();
+        return;
+      }
+      if (stopped) return;
+
+      const source = new EventSource(
+        `${base}/users/me/connection/stream?ticket=${encodeURIComponent(ticket)}`
+      );
+      es = source;
+      source.addEventListener("open", () => {
+        // Events may have been missed while we were away
+        if (attempt > 0) onChange();
+        attempt = 0;
+      });
+      source.addEventListener("connected", onChange);
+      source.addEventListener("peer_applied", onChange);
+      source.addEventListener("disconnected", onChange);
+      source.onerror = () => {
+        source.close();
+        if (es === source) es = null;
+        reconnect();
+      };
+    };
+
+    void open();
+    return () => {
+      stopped = true;
+      clearTimeout(retry);
+      es?.close();
+    };
+  }, [refresh]);
+
   return (
     <ConnectionContext.Provider value={{ connection, loading, refresh, connect, disconnect }}>
       {children}